@@ -0,0 +1,295 @@
+"""
+Throughput benchmark for the displace filter, run headless against the
+in-memory node stand-ins.
+
+Covers the full-resolution apply (displace_core.apply_to_document), the
+preview path (convert_to_u8_rgba + displace_preview) and the zoomed detail
+preview (region_inputs + displace_region on a 100% view) over synthetic canvases
+for every size, color model, depth, direction, edge mode and interpolation requested, and reports
+megapixels per second and peak Python/NumPy allocation for each case.
+
+    python benchmarks/bench_displace.py --sizes 1 --save baseline.json
+    python benchmarks/bench_displace.py --sizes 1 --compare baseline.json
+"""
+import argparse
+import importlib
+import json
+import math
+import os
+import platform
+import struct
+import sys
+import time
+import tracemalloc
+import types
+from pathlib import Path
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent / "krita-displace-filter"
+
+MODELS = ["RGBA", "GRAYA", "CMYKA"]
+DEPTHS = ["U8", "U16", "F16", "F32"]
+DIRECTIONS = ["Horizontal", "Vertical", "Both", "Vector"]
+EDGES = ["Transparent", "Wrap", "Clamp"]
+INTERPOLATIONS = ["Nearest", "Bilinear", "Bicubic"]
+
+# Side of the preview label the detail view fills
+ROI_VIEW = 400
+
+
+def load_plugin():
+    """Imports the plugin's Krita-free modules without running its __init__ (which needs Krita)."""
+    pkg = types.ModuleType("displace_plugin")
+    pkg.__path__ = [str(PLUGIN_DIR)]
+    sys.modules["displace_plugin"] = pkg
+    core = importlib.import_module("displace_plugin.displace_core")
+    fake_nodes = importlib.import_module("displace_plugin.fake_nodes")
+    return core, fake_nodes
+
+
+def canvas_size(mp):
+    side = int(math.sqrt(mp * 1000000))
+    return side, side
+
+
+def make_canvas(w, h, depth, phase, model="RGBA"):
+    """
+    Builds a deterministic buffer in Krita's layout for model and depth: a
+    smooth sine pattern shifted per row, with blue v, green 1 - v and red
+    3v mod 1 (gray takes v; CMYK takes the inks of that colour, no black).
+    """
+    period = max(8, w // 7)
+    row_values = []
+    for x in range(w + h):
+        v = 0.5 + 0.5 * math.sin((x + phase) * 2.0 * math.pi / period)
+        b, g, r = v, 1.0 - v, (v * 3.0) % 1.0
+        if model == "GRAYA":
+            px = (v, 1.0)
+        elif model == "CMYKA":
+            px = (1.0 - r, 1.0 - g, 1.0 - b, 0.0, 1.0)
+        elif depth in ("F16", "F32"):
+            px = (r, g, b, 1.0)
+        else:
+            px = (b, g, r, 1.0)
+        row_values.append(px)
+
+    n = len(row_values[0])
+    # Float CMYK inks run 0..100, alpha 0..1
+    ink = 100.0 if model == "CMYKA" and depth in ("F16", "F32") else 1.0
+    scale = [ink] * (n - 1) + [1.0]
+    if depth == "U8":
+        pack = lambda px: bytes(int(c * 255 + 0.5) for c in px)
+    elif depth == "U16":
+        pack = lambda px: struct.pack(f'<{n}H', *(int(c * 65535 + 0.5) for c in px))
+    else:
+        code = 'e' if depth == "F16" else 'f'
+        pack = lambda px: struct.pack(f'<{n}{code}', *(c * k for c, k in zip(px, scale)))
+
+    long_row = b''.join(pack(px) for px in row_values)
+    ps = len(pack(row_values[0]))
+    return b''.join(long_row[(y % h) * ps:((y % h) + w) * ps] for y in range(h))
+
+
+def make_settings(direction, edge, interpolation="Nearest"):
+    return {
+        'strength': 40.0,
+        'scale': 1.0,
+        'channel': 0,
+        'strength_y': 25.0,
+        'channel_y': 1,
+        'direction': DIRECTIONS.index(direction),
+        'wrap_mode': EDGES.index(edge),
+        'interpolation': INTERPOLATIONS.index(interpolation),
+        'invert': False,
+        'center': True,
+        'memory_budget_mb': 1024,
+        'workers': os.cpu_count() or 1,
+        'layer_name': "{layer}_displaced",
+        'create_above': True,
+    }
+
+
+def measure(fn, repeat, with_memory):
+    """Returns (best seconds, peak MB). Memory is traced in a separate run so tracing does not skew timing."""
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak_mb = None
+    if with_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        fn()
+        peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+    return best, peak_mb
+
+
+def run_cases(args):
+    core, fake_nodes = load_plugin()
+    results = []
+
+    for mp in args.sizes:
+        w, h = canvas_size(mp)
+        for model, depth in ((m, d) for m in args.models for d in args.depths):
+            fmt = core.PIXEL_FORMATS[model, depth]
+            src = make_canvas(w, h, depth, 0, model)
+            dmap = make_canvas(w, h, depth, w // 3, model)
+
+            doc = fake_nodes.FakeDocument(w, h, depth, model)
+            src_node = doc.add_paint_layer("Source", src)
+            map_node = doc.add_paint_layer("Map", dmap)
+
+            # The preview conversion does not depend on direction or edge mode
+            if "preview" in args.paths:
+                seconds, peak = measure(lambda: core.convert_to_u8_rgba(src, w, h, fmt),
+                                        args.repeat, not args.skip_memory)
+                results.append(report("convert_to_u8_rgba", mp, w * h, model, depth, None, None, None,
+                                      seconds, peak))
+
+                src_u8 = core.convert_to_u8_rgba(src, w, h, fmt)
+                map_u8 = core.convert_to_u8_rgba(dmap, w, h, fmt)
+                pw = max(1, int(w * args.preview_scale))
+                ph = max(1, int(h * args.preview_scale))
+                src_small = decimate_u8(src_u8, w, h, pw, ph)
+                map_small = decimate_u8(map_u8, w, h, pw, ph)
+                del src_u8, map_u8
+
+            for direction in args.directions:
+                for edge in args.edges:
+                    for interpolation in args.interpolations:
+                        settings = make_settings(direction, edge, interpolation)
+                        case = (model, depth, direction, edge, interpolation)
+
+                        if "apply" in args.paths:
+                            def apply_once():
+                                new_node = core.apply_to_document(doc, src_node, map_node, settings)
+                                # Drop the output layer so repeated runs do not accumulate
+                                doc.rootNode()._children.remove(new_node)
+
+                            seconds, peak = measure(apply_once, args.repeat, not args.skip_memory)
+                            results.append(report("apply", mp, w * h, *case, seconds, peak))
+
+                        if "preview" in args.paths:
+                            seconds, peak = measure(
+                                lambda: core.displace_preview(src_small, map_small, pw, ph, settings, args.preview_scale),
+                                args.repeat, not args.skip_memory)
+                            results.append(report("displace_preview", mp, pw * ph, *case, seconds, peak))
+
+                        if "roi" in args.paths:
+                            region = core.zoom_region(w, h, (w / 2, h / 2), 1, ROI_VIEW, ROI_VIEW)
+
+                            def roi_once():
+                                src_data, disp_data, window = core.region_inputs(
+                                    src_node.pixelData, map_node.pixelData, w, h, region, settings)
+                                out = core.displace_region(src_data, disp_data, w, h, fmt, region, window, settings)
+                                core.convert_to_u8_rgba(out, region[2], region[3], fmt)
+
+                            seconds, peak = measure(roi_once, args.repeat, not args.skip_memory)
+                            results.append(report("displace_region", mp, region[2] * region[3], *case, seconds, peak))
+
+            del src, dmap, doc, src_node, map_node
+    return results
+
+
+def decimate_u8(data, w, h, pw, ph):
+    """Nearest-neighbour downscale of an 8-bit BGRA buffer, standing in for QImage.scaled(FastTransformation)."""
+    out = bytearray(pw * ph * 4)
+    for y in range(ph):
+        sy = y * h // ph
+        row = bytearray(pw * 4)
+        for x in range(pw):
+            sx = (sy * w + x * w // pw) * 4
+            row[x * 4:x * 4 + 4] = data[sx:sx + 4]
+        out[y * pw * 4:(y + 1) * pw * 4] = row
+    return bytes(out)
+
+
+def report(path, mp, pixels, model, depth, direction, edge, interpolation, seconds, peak_mb):
+    result = {
+        'path': path,
+        'size_mp': mp,
+        'model': model,
+        'depth': depth,
+        'direction': direction,
+        'edge': edge,
+        'interpolation': interpolation,
+        'pixels': pixels,
+        'seconds': seconds,
+        'mp_per_s': pixels / 1000000 / seconds if seconds > 0 else float('inf'),
+        'peak_mb': peak_mb,
+    }
+    peak = f"{peak_mb:9.1f} MB" if peak_mb is not None else "        -"
+    print(f"{path:20s} {mp:>4}MP {model:5s} {depth:4s} {direction or '-':10s} {edge or '-':11s} {interpolation or '-':8s} "
+          f"{result['mp_per_s']:10.2f} MP/s {peak}", flush=True)
+    return result
+
+
+def case_key(result):
+    # Baselines saved before interpolation (or color models) were benchmarked are Nearest (RGBA) runs
+    interpolation = result.get('interpolation', "Nearest" if result['direction'] else None)
+    return (result['path'], result['size_mp'], result.get('model', "RGBA"), result['depth'], result['direction'],
+            result['edge'], interpolation)
+
+
+def compare(results, baseline_path, tolerance):
+    """Prints cases slower than the baseline by more than tolerance; returns their count."""
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)['results']}
+
+    regressions = 0
+    for result in results:
+        base = baseline.get(case_key(result))
+        if not base:
+            continue
+        ratio = result['mp_per_s'] / base['mp_per_s']
+        if ratio < 1.0 - tolerance:
+            regressions += 1
+            print(f"REGRESSION {' '.join(str(k) for k in case_key(result) if k is not None)}: "
+                  f"{base['mp_per_s']:.2f} -> {result['mp_per_s']:.2f} MP/s ({ratio:.0%})")
+    return regressions
+
+
+def environment():
+    core, _ = load_plugin()
+    return {
+        'python': platform.python_version(),
+        'numpy': core.np.__version__ if core.np is not None else None,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 16, 64], help="canvas sizes in megapixels")
+    parser.add_argument('--models', nargs='+', default=["RGBA"], choices=MODELS)
+    parser.add_argument('--depths', nargs='+', default=DEPTHS, choices=DEPTHS)
+    parser.add_argument('--directions', nargs='+', default=DIRECTIONS, choices=DIRECTIONS)
+    parser.add_argument('--edges', nargs='+', default=EDGES, choices=EDGES)
+    parser.add_argument('--interpolations', nargs='+', default=INTERPOLATIONS, choices=INTERPOLATIONS)
+    parser.add_argument('--paths', nargs='+', default=["apply", "preview", "roi"], choices=["apply", "preview", "roi"])
+    parser.add_argument('--preview-scale', type=float, default=0.25)
+    parser.add_argument('--repeat', type=int, default=1, help="timed runs per case; the best is kept")
+    parser.add_argument('--skip-memory', action='store_true', help="skip the traced run that measures peak memory")
+    parser.add_argument('--save', metavar='JSON', help="write results as a baseline")
+    parser.add_argument('--compare', metavar='JSON', help="compare against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="allowed MP/s drop against the baseline (fraction)")
+    args = parser.parse_args(argv)
+
+    results = run_cases(args)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
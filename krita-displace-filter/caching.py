@@ -0,0 +1,56 @@
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    """
+    Least-recently-used cache bounded by the total size of its values.
+
+    size_of(value) gives the cost of an entry in bytes (len() by default).
+    An entry larger than the whole budget is not stored. Safe to share
+    between the GUI thread and worker threads.
+    """
+
+    def __init__(self, max_bytes, size_of=len):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._total += size
+            while self._total > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, key):
+        if key in self._entries:
+            del self._entries[key]
+            self._total -= self._sizes.pop(key)
@@ -0,0 +1,2078 @@
+"""
+Krita-independent displacement engine.
+
+Everything here works on raw BGRA buffers and on objects that expose the small
+part of the Krita node API the plugin uses (pixelData, setPixelData, clone,
+parentNode, addChildNode, ...), so the full data flow can be driven and timed
+outside Krita with the stand-ins from fake_nodes.
+"""
+import array
+import contextlib
+import math
+import struct
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    # Krita's bundled Python does not always ship NumPy
+    np = None
+
+from .caching import LRUCache
+from .instrumentation import NO_PROFILE
+from .scratch import scratch_reader, stage_layer
+from .pixel_formats import (PIXEL_FORMATS, PREVIEW_FORMAT, PixelFormat, channels_numpy,
+                            half_float_values, node_format, pixel_item_dtype, pixel_reader, rgb_reader,
+                            rgba_format, unit_rgb_numpy)
+
+
+# -------------------- Full-resolution engines --------------------
+
+def srgb_to_linear(val_norm):
+    """Applies sRGB EOTF (gamma removal) to get LINEAR value."""
+    if val_norm <= 0.04045:
+        return val_norm / 12.92
+    else:
+        return math.pow((val_norm + 0.055) / 1.055, 2.4)
+
+
+def normalize_displacement_float(value_float, center, invert):
+    """Normalize displacement float (0.0-1.0) value to range -1..1 or 0..1."""
+    dn = value_float # Already normalized to 0.0-1.0
+
+    if center:
+        dn = (dn - 0.5) * 2.0  # Range: -1..1
+
+    if invert:
+        dn = -dn
+
+    return dn
+
+
+def displacement_offset(value_float, settings):
+    """
+    Maps a 0.0-1.0 map value to a whole-pixel offset for the given settings,
+    or to a sub-pixel shift when an interpolating filter is selected.
+    """
+    dn = normalize_displacement_float(value_float, settings['center'], settings['invert'])
+    shift = settings['strength'] * settings['scale'] * dn
+    return shift if settings['interpolation'] else int(round(shift))
+
+
+def map_channel(fmt, channel):
+    """Index inside a map pixel of the selected channel (Red, Green, Blue; gray for every choice)."""
+    return fmt.rgb[channel] if fmt.model != "GRAYA" else 0
+
+# Direction index of the two-channel mode: X offsets from 'channel' and
+# 'strength', Y offsets from 'channel_y' and 'strength_y', in one pass
+VECTOR = 3
+
+
+def vector_axis_settings(settings):
+    """
+    (X, Y) settings of the Vector direction, each decoding one axis as a
+    plain Horizontal or Vertical displacement would.
+    """
+    return (dict(settings, direction=0),
+            dict(settings, direction=1, channel=settings['channel_y'], strength=settings['strength_y']))
+
+# Maps with at least this many pixels get a Luminosity table keyed on packed RGB
+RGB_TABLE_MIN_PIXELS = 1 << 24
+
+
+def build_offset_tables(fmt, settings, pixel_count=0):
+    """
+    Precomputes decoding of a map in format fmt once per apply. For U8, U16
+    and F16 RGBA and GRAYA maps every raw channel value (for F16, every bit
+    pattern) maps straight to a whole-pixel offset, or to a sub-pixel shift
+    when interpolating ('channel'; gray maps use it for Luminosity too).
+    RGBA Luminosity
+    gets per-channel weighted linear tables ('luminosity', in B, G, R order) and,
+    for large U8 maps with NumPy, an offset table keyed on the packed 24-bit RGB
+    value ('rgb'). Returns None for F32 and CMYKA maps, which are decoded
+    directly. The Vector direction gets {'x': tables, 'y': tables}, one set
+    per axis.
+    """
+    if settings['direction'] == VECTOR:
+        x_settings, y_settings = vector_axis_settings(settings)
+        return {'x': build_offset_tables(fmt, x_settings, pixel_count),
+                'y': build_offset_tables(fmt, y_settings, pixel_count)}
+
+    if fmt.bpc == 4 or fmt.model == "CMYKA":
+        return None
+    if fmt.bpc == 1:
+        # U8 Data (sRGB -> Linear)
+        unit = [srgb_to_linear(v / 255.0) for v in range(256)]
+    elif not fmt.is_float:
+        # U16 Data (Assumed Linear)
+        unit = [v / 65535.0 for v in range(65536)]
+    else:
+        # F16 Data (Assumed Linear), clamped to 0..1 like F32; NaN reads as 0
+        unit = [max(0.0, min(1.0, v)) if v == v else 0.0 for v in half_float_values()]
+
+    single = settings['channel'] != 3 or fmt.model == "GRAYA"
+    if np is None:
+        if single:
+            return {'channel': [displacement_offset(v, settings) for v in unit]}
+        return {'luminosity': tuple([k * v for v in unit] for k in (0.114, 0.587, 0.299))}
+
+    unit = np.array(unit)
+    if single:
+        offsets = offsets_from_unit_numpy(unit, settings)
+        return {'channel': offsets if settings['interpolation'] else offsets.astype(np.int32)}
+
+    tables = {'luminosity': tuple(k * unit for k in (0.114, 0.587, 0.299))}
+
+    if fmt is PIXEL_FORMATS["RGBA", "U8"] and pixel_count >= RGB_TABLE_MIN_PIXELS:
+        wb, wg, wr = tables['luminosity']
+        limit = abs(settings['strength'] * settings['scale'])
+        if settings['interpolation']:
+            rgb = np.empty(1 << 24, dtype=np.float32)
+        else:
+            rgb = np.empty(1 << 24, dtype=np.int16 if limit < 32000 else np.int32)
+        # Built in chunks to keep the float temporaries small
+        chunk = 1 << 20
+        for start in range(0, 1 << 24, chunk):
+            keys = np.arange(start, start + chunk, dtype=np.uint32)
+            lum = wr[keys >> 16] + wg[(keys >> 8) & 0xFF] + wb[keys & 0xFF]
+            rgb[start:start + chunk] = offsets_from_unit_numpy(lum, settings)
+        tables['rgb'] = rgb
+
+    return tables
+
+
+# -------------------- Sub-pixel sampling --------------------
+
+# Tap positions around floor(coordinate) for Bilinear (1) and Bicubic (2)
+FILTER_TAPS = {1: (0, 1), 2: (-1, 0, 1, 2)}
+
+# Pixels blended per NumPy chunk, sized so the float temporaries stay in cache
+FILTER_CHUNK_PIXELS = 1 << 14
+
+
+def filter_weights(t, interpolation):
+    """Tap weights for fractional positions t (floats or arrays): linear or Catmull-Rom."""
+    if interpolation == 1:
+        return (1.0 - t, t)
+    t2 = t * t
+    t3 = t2 * t
+    return ((-t3 + 2.0 * t2 - t) * 0.5,
+            (3.0 * t3 - 5.0 * t2 + 2.0) * 0.5,
+            (-3.0 * t3 + 4.0 * t2 + t) * 0.5,
+            (t3 - t2) * 0.5)
+
+
+def sample_filtered_python(src_mv, sx, sy, w, h, fmt, src_y0, wrap_mode, interpolation, read_px,
+                           src_x0=0, src_cols=None):
+    """
+    Blends the 2x2 (Bilinear) or 4x4 (Bicubic) source taps around (sx, sy)
+    in premultiplied alpha, so transparent neighbours do not darken edges,
+    and returns the packed pixel of format fmt. Taps outside the canvas
+    follow the edge mode; with Transparent they contribute nothing.
+    """
+    src_cols = w if src_cols is None else src_cols
+    taps = FILTER_TAPS[interpolation]
+    bx = math.floor(sx)
+    by = math.floor(sy)
+    weights_x = filter_weights(sx - bx, interpolation)
+    weights_y = filter_weights(sy - by, interpolation)
+    stride = fmt.pixel_size
+
+    # Premultiplied colour channels (alpha is always the last channel) and alpha
+    acc = [0.0] * fmt.alpha
+    a = 0.0
+    for ky, wy in zip(taps, weights_y):
+        if wy == 0.0:
+            continue
+        ty = by + ky
+        if not 0 <= ty < h:
+            if wrap_mode == 1:
+                ty %= h
+            elif wrap_mode == 2:
+                ty = max(0, min(h - 1, ty))
+            else:
+                continue
+        row = ((ty - src_y0) % h) * src_cols - src_x0
+        for kx, wx in zip(taps, weights_x):
+            if wx == 0.0:
+                continue
+            tx = bx + kx
+            if not 0 <= tx < w:
+                if wrap_mode == 1:
+                    tx %= w
+                elif wrap_mode == 2:
+                    tx = max(0, min(w - 1, tx))
+                else:
+                    continue
+            px = read_px(src_mv, (row + tx) * stride)
+            wa = px[-1] * wx * wy
+            acc = [s + v * wa for s, v in zip(acc, px)]
+            a += wa
+
+    # Fully transparent after rounding: keep the colour channels clean too
+    if a <= 0.0 or (not fmt.is_float and a < 0.5):
+        return bytes(stride)
+    if fmt.is_float:
+        return fmt.packer.pack(*[max(0.0, v / a) for v in acc], min(1.0, a))
+    top = int(fmt.top)
+    return fmt.packer.pack(*[max(0, min(top, int(round(v)))) for v in [c / a for c in acc] + [a]])
+
+
+def axis_taps_numpy(coord, size, wrap_mode, interpolation):
+    """
+    Resolves the taps along one axis to [(index, weight)] with the edge mode
+    applied. Integer coordinates (an axis that does not move) give one tap
+    with weight None. Transparent taps outside the canvas get weight 0.
+    """
+    if coord.dtype.kind in 'iu':
+        return [(coord, None)]
+
+    base = np.floor(coord)
+    weights = filter_weights((coord - base).astype(np.float32), interpolation)
+    base = base.astype(np.int64)
+
+    resolved = []
+    for k, weight in zip(FILTER_TAPS[interpolation], weights):
+        index = base + k
+        if wrap_mode == 1:  # Wrap
+            index = np.mod(index, size)
+        elif wrap_mode == 2:  # Clamp
+            # In place; np.clip's own overhead shows at this chunk size
+            np.maximum(index, 0, out=index)
+            np.minimum(index, size - 1, out=index)
+        else:
+            inside = (index >= 0) & (index < size)
+            if not inside.all():
+                weight = np.where(inside, weight, np.float32(0.0))
+        resolved.append((index, weight))
+    return resolved
+
+
+def sample_filtered_numpy(src_mv, sx, sy, w, h, fmt, src_y0, wrap_mode, interpolation, out,
+                          src_x0=0, src_cols=None):
+    """
+    Vectorized sample_filtered_python over whole arrays of coordinates. Works
+    in chunks small enough for the float temporaries to stay in cache; every
+    tap is one whole-pixel gather plus a weighted add per channel. Opaque
+    sources skip the premultiply passes, and outside Transparent the alpha
+    blend too, which gives the same result. The result is written into out
+    (channel values of the source dtype, one row per coordinate). The blend
+    runs in float32, so a value on a rounding tie can land one level away
+    from sample_filtered_python, and float results differ by float32
+    rounding.
+
+    Known limitation: every tap is a gather plus a float pass per channel,
+    where Nearest is one gather. Against displace_numpy with Nearest (4 MP
+    U8, Clamp) this kernel costs 3-4x for Bilinear and 4.5-5.5x for Bicubic
+    along one axis, 4-5x and 9-11x with Both. Gathering two-pixel items per
+    source row, or stacking the taps into one gather and weighting them in
+    one pass, measured no faster than this loop.
+    """
+    src_cols = w if src_cols is None else src_cols
+    n_ch, ai = fmt.channels, fmt.alpha
+    top = fmt.top
+    src_px = np.frombuffer(src_mv, dtype=pixel_item_dtype(fmt), count=len(src_mv) // fmt.pixel_size)
+    alpha = channels_numpy(src_mv, src_px.size, fmt)[:, ai]
+    premultiply = not (alpha == top).all()
+    # Catmull-Rom and linear weights sum to 1, so only dropped Transparent
+    # taps can leave an opaque result that needs renormalizing
+    normalize = premultiply or wrap_mode == 0
+    # Without renormalizing, the source is opaque and so is every result:
+    # alpha is not blended at all
+    blended = n_ch if normalize else ai
+
+    sx = sx.ravel()
+    sy = sy.ravel()
+    for start in range(0, sx.size, FILTER_CHUNK_PIXELS):
+        stop = start + FILTER_CHUNK_PIXELS
+        x_taps = axis_taps_numpy(sx[start:stop], w, wrap_mode, interpolation)
+        y_taps = []
+        for index, weight in axis_taps_numpy(sy[start:stop], h, wrap_mode, interpolation):
+            rel = np.mod(index - src_y0, h) if wrap_mode == 1 else index - src_y0
+            y_taps.append((rel * src_cols - src_x0, weight))
+
+        # One contiguous float row per channel: weighting whole pixels as
+        # (n, channels) rows runs NumPy's inner loop over only a few values
+        acc = None
+        for row, wy in y_taps:
+            for ix, wx in x_taps:
+                # mode='clip' only guards the zero-weight Transparent taps
+                px = np.take(src_px, row + ix, mode='clip').view(fmt.dtype).reshape(-1, n_ch)
+                if wy is None:
+                    weight = wx
+                elif wx is None:
+                    weight = wy
+                else:
+                    weight = wy * wx
+                tap = [px[:, c].astype(np.float32) for c in range(blended)]
+                if premultiply:
+                    for c in range(ai):
+                        tap[c] *= tap[ai]
+                if weight is not None:
+                    for channel in tap:
+                        channel *= weight
+                if acc is None:
+                    acc = tap
+                else:
+                    for total, channel in zip(acc, tap):
+                        total += channel
+
+        if normalize:
+            alpha = acc[ai]
+            transparent = alpha <= 0.0 if fmt.is_float else alpha < 0.5
+            coverage = np.where(transparent, np.float32(1.0), alpha)
+            if not premultiply:
+                coverage /= top
+            for c in range(ai):
+                acc[c] /= coverage
+            for channel in acc:
+                channel[transparent] = 0.0
+
+        values = out[start:stop]
+        if not normalize:
+            values[:, ai] = top
+        for c, channel in enumerate(acc):
+            if fmt.is_float:
+                np.maximum(channel, 0.0, out=channel)
+                if c == ai:
+                    np.minimum(channel, 1.0, out=channel)
+            else:
+                np.clip(channel, 0.0, top, out=channel)
+                np.rint(channel, out=channel)
+            values[:, c] = channel
+
+
+# -------------------- Constant-offset runs --------------------
+
+# Shortest run of equal offsets worth copying as one slice in the per-pixel loop
+MIN_RUN_PIXELS = 8
+
+
+def copy_run(out_mv, dst, src_mv, sx, sy, n, w, h, stride, wrap_mode, src_y0, src_x0, src_cols):
+    """
+    Copies the n source pixels starting at canvas (sx, sy) to out_mv[dst:],
+    one slice per contiguous piece. Pieces outside the canvas follow the
+    edge mode: Wrap copies from the other side, Clamp repeats the edge pixel
+    and Transparent leaves them alone, so out_mv must be zero-filled.
+    """
+    if 0 <= sy < h and 0 <= sx and sx + n <= w:
+        # Inside the canvas (the common case): one slice, no edge handling
+        lo = (((sy - src_y0) % h) * src_cols - src_x0 + sx) * stride
+        out_mv[dst:dst + n * stride] = src_mv[lo:lo + n * stride]
+        return
+    if not 0 <= sy < h:
+        if wrap_mode == 1:
+            sy %= h
+        elif wrap_mode == 2:
+            sy = max(0, min(h - 1, sy))
+        else:
+            return
+
+    row = ((sy - src_y0) % h) * src_cols - src_x0
+    x, end = sx, sx + n
+    while x < end:
+        if 0 <= x < w:
+            k = min(end, w) - x
+            piece = src_mv[(row + x) * stride:(row + x + k) * stride]
+        elif wrap_mode == 1:
+            xw = x % w
+            k = min(end - x, w - xw)
+            piece = src_mv[(row + xw) * stride:(row + xw + k) * stride]
+        else:
+            k = min(end, 0) - x if x < 0 else end - x
+            if wrap_mode != 2:
+                dst += k * stride
+                x += k
+                continue
+            edge = row + (0 if x < 0 else w - 1)
+            piece = bytes(src_mv[edge * stride:(edge + 1) * stride]) * k
+        out_mv[dst:dst + k * stride] = piece
+        dst += k * stride
+        x += k
+
+
+def offset_reader(disp_mv, fmt, settings, tables=None):
+    """
+    Returns get_offset(idx): the offset (or sub-pixel shift) of the map pixel
+    at byte index idx of disp_mv, decoded one pixel at a time. For the
+    Vector direction it returns the (x, y) pair.
+    """
+    if settings['direction'] == VECTOR:
+        tables = tables or {'x': None, 'y': None}
+        get_x, get_y = (offset_reader(disp_mv, fmt, axis, tables[key])
+                        for axis, key in zip(vector_axis_settings(settings), 'xy'))
+        return lambda idx: (get_x(idx), get_y(idx))
+
+    channel_idx = settings['channel']
+    if tables is None:
+        tables = build_offset_tables(fmt, settings)
+
+    # -------------------- СПЕЦИАЛИЗИРОВАННЫЙ ЧИТАТЕЛЬ (Оптимизация 2) --------------------
+
+    # Создаем функцию для чтения, специфичную для формата, чтобы избежать проверок if/else в цикле
+    if tables is not None:
+        # U8/U16: one table lookup per channel instead of pow/division per pixel
+        # Raw channel values (F16 as bit patterns), the keys of the tables
+        bpc = fmt.bpc
+        if bpc == 1:
+            read_raw = lambda idx: disp_mv[idx:idx + 3]
+        else:
+            read_raw = lambda idx: struct.unpack_from('<HHH', disp_mv, idx)
+
+        # Plain lists index much faster than NumPy arrays from Python code
+        as_list = lambda table: table if isinstance(table, list) else table.tolist()
+
+        if 'channel' in tables:
+            lut = as_list(tables['channel'])
+            ch = map_channel(fmt, channel_idx)
+            if bpc == 1:
+                def get_offset(idx):
+                    return lut[disp_mv[idx + ch]]
+            else:
+                def get_offset(idx):
+                    return lut[struct.unpack_from('<H', disp_mv, idx + 2 * ch)[0]]
+        else:
+            # Luminosity (RGBA only): offsets are memoized per packed RGB value as they are met
+            wb, wg, wr = (as_list(t) for t in tables['luminosity'])
+            ri, gi, bi = fmt.rgb
+            rgb_offsets = {}
+            key_len = 3 * bpc
+
+            def get_offset(idx):
+                key = disp_mv[idx : idx + key_len].tobytes()
+                off = rgb_offsets.get(key)
+                if off is None:
+                    px = read_raw(idx)
+                    off = displacement_offset(wr[px[ri]] + wg[px[gi]] + wb[px[bi]], settings)
+                    rgb_offsets[key] = off
+                return off
+
+    else:
+        # F32 (Assumed Linear) and CMYKA: RGB clamped to 0..1 for normalization
+        read_rgb = rgb_reader(fmt)
+
+        def get_offset(idx):
+            r, g, b = read_rgb(disp_mv, idx)
+            if channel_idx == 3: # Luminosity
+                value = 0.299 * r + 0.587 * g + 0.114 * b
+            elif channel_idx == 0: # Red
+                value = r
+            elif channel_idx == 1: # Green
+                value = g
+            else: # Blue
+                value = b
+            return displacement_offset(value, settings)
+
+    return get_offset
+
+
+def displace_python(src_mv, disp_mv, w, h, fmt, settings, y0=0, rows=None, src_y0=0, out=None, tables=None,
+                    x0=0, cols=None, src_x0=0, src_cols=None, offsets=None, map_fmt=None):
+    """
+    Per-pixel displacement loop, used when NumPy is not available.
+    See displace_numpy for the meaning of the arguments. Transparent pixels
+    are skipped rather than written, so out must be zero-filled.
+    """
+    # -------------------- ПРЕДВАРИТЕЛЬНЫЕ ВЫЧИСЛЕНИЯ --------------------
+
+    # Константы для цикла
+    wrap_mode = settings['wrap_mode']
+    direction = settings['direction']
+
+    stride = fmt.pixel_size
+    rows = h if rows is None else rows
+    cols = w if cols is None else cols
+    src_cols = w if src_cols is None else src_cols
+    data_len = rows * cols * stride
+
+    if offsets is None:
+        map_fmt = map_fmt or fmt
+        map_stride = map_fmt.pixel_size
+        get_offset = offset_reader(disp_mv, map_fmt, settings, tables)
+        if direction == VECTOR:
+            # Same interleaved x, y layout as the rows of a decoded vector field
+            row_offsets = lambda y: [v for x in range(cols) for v in get_offset((y * cols + x) * map_stride)]
+        else:
+            row_offsets = lambda y: [get_offset((y * cols + x) * map_stride) for x in range(cols)]
+    else:
+        row_offsets = offsets.__getitem__
+
+    # Per-row x and y shifts; an axis the direction does not move reads zeros
+    zeros = [0] * cols
+
+    def row_shifts(y):
+        line = row_offsets(y)
+        if direction == VECTOR:
+            return line[0::2], line[1::2]
+        return (line if direction != 1 else zeros), (line if direction != 0 else zeros)
+
+    out_data = bytearray(data_len) if out is None else out
+    out_mv = memoryview(out_data)
+
+    interpolation = settings['interpolation']
+    if interpolation:
+        # Sub-pixel shifts: blend the neighbouring taps instead of copying one pixel
+        read_px = pixel_reader(fmt)
+        for y in range(rows):
+            gy = y0 + y
+            dxs, dys = row_shifts(y)
+            for x in range(cols):
+                idx = (y * cols + x) * stride
+                out_mv[idx : idx + stride] = sample_filtered_python(
+                    src_mv, x0 + x + dxs[x], gy + dys[x], w, h, fmt, src_y0, wrap_mode, interpolation,
+                    read_px, src_x0, src_cols)
+        return out_data
+
+    # --- ГЛАВНЫЙ ЦИКЛ СМЕЩЕНИЯ (Ускоренный) ---
+    for y in range(rows):
+        row_base = y * cols
+        gy = y0 + y
+
+        # 1. Смещение в целых пикселях (табличное декодирование), вся строка сразу
+        dxs, dys = row_shifts(y)
+
+        x = 0
+        while x < cols:
+            dx, dy = dxs[x], dys[x]
+            run_end = x + 1
+            while run_end < cols and dxs[run_end] == dx and dys[run_end] == dy:
+                run_end += 1
+
+            # Flat map areas: the whole run reads one contiguous source segment
+            if run_end - x >= MIN_RUN_PIXELS:
+                copy_run(out_mv, (row_base + x) * stride, src_mv, x0 + x + dx, gy + dy, run_end - x,
+                         w, h, stride, wrap_mode, src_y0, src_x0, src_cols)
+                x = run_end
+                continue
+
+            for x in range(x, run_end):
+                idx = (row_base + x) * stride
+
+                # 2. Расчет координат
+                sx_i = x0 + x + dx
+                sy_i = gy + dy
+
+                # 3. Применение Wrap Mode (более чистый код)
+                if 0 <= sx_i < w and 0 <= sy_i < h:
+                    # В пределах границ, ничего не делаем (Clamping по умолчанию)
+                    pass
+                elif wrap_mode == 1:  # Wrap
+                    sx_i %= w
+                    sy_i %= h
+                elif wrap_mode == 2:  # Clamp (только если вышли за границы)
+                    sx_i = max(0, min(w - 1, sx_i))
+                    sy_i = max(0, min(h - 1, sy_i))
+
+                # 4. Сэмплирование Source Pixel и Запись
+                # Вне холста остается прозрачный пиксель: буфер уже обнулен
+                if 0 <= sx_i < w and 0 <= sy_i < h:
+                    src_idx = (((sy_i - src_y0) % h) * src_cols + sx_i - src_x0) * stride
+
+                    # КОПИРОВАНИЕ ЧЕРЕЗ СЛАЙСЫ memoryview (наиболее быстрое в Python)
+                    out_mv[idx : idx + stride] = src_mv[src_idx : src_idx + stride]
+            x = run_end
+
+
+    # --- КОНЕЦ ГЛАВНОГО ЦИКЛА СМЕЩЕНИЯ ---
+    return out_data
+
+
+def offsets_from_unit_numpy(dn, settings):
+    """Vectorized displacement_offset: 0.0-1.0 map values to whole-pixel offsets or sub-pixel shifts."""
+    if settings['center']:
+        dn = (dn - 0.5) * 2.0
+    if settings['invert']:
+        dn = -dn
+    shift = settings['strength'] * settings['scale'] * dn
+    if settings['interpolation']:
+        # float32 keeps well under 1/1000 px and halves a decoded offset field
+        return shift.astype(np.float32)
+    # np.rint rounds half to even, exactly like round()
+    return np.rint(shift).astype(np.int64)
+
+
+def decode_offsets_numpy(disp_mv, n, fmt, settings, tables=None):
+    """
+    Decodes n map pixels into an array of whole-pixel offsets, or of (x, y)
+    offset pairs, shape (n, 2), for the Vector direction.
+    """
+    if settings['direction'] == VECTOR:
+        tables = tables or {'x': None, 'y': None}
+        x_settings, y_settings = vector_axis_settings(settings)
+        x = decode_offsets_numpy(disp_mv, n, fmt, x_settings, tables['x'])
+        pairs = np.empty((n, 2), dtype=x.dtype)
+        pairs[:, 0] = x
+        pairs[:, 1] = decode_offsets_numpy(disp_mv, n, fmt, y_settings, tables['y'])
+        return pairs
+
+    channel_idx = settings['channel']
+    if tables is None:
+        tables = build_offset_tables(fmt, settings, n)
+
+    if tables is not None and 'rgb' in tables:
+        # Little-endian BGRA packs as 0xAARRGGBB; the low 24 bits are the key
+        packed = np.frombuffer(disp_mv, dtype='<u4', count=n)
+        return tables['rgb'][packed & 0xFFFFFF]
+
+    raw = channels_numpy(disp_mv, n, fmt)
+    if tables is None:
+        # F32 (Assumed Linear) and CMYKA, clamped to 0..1 like the per-pixel reader
+        rgb = unit_rgb_numpy(raw, fmt)
+        if channel_idx == 3: # Luminosity
+            value = 0.299 * rgb[:, 0] + 0.587 * rgb[:, 1] + 0.114 * rgb[:, 2]
+        else:
+            value = rgb[:, channel_idx]
+        return offsets_from_unit_numpy(value, settings)
+
+    if fmt.is_float:
+        # F16 tables are indexed by bit pattern
+        raw = raw.view('<u2')
+    if 'channel' in tables:
+        return tables['channel'][raw[:, map_channel(fmt, channel_idx)]]
+
+    ri, gi, bi = fmt.rgb
+    wb, wg, wr = tables['luminosity']
+    return offsets_from_unit_numpy(wr[raw[:, ri]] + wg[raw[:, gi]] + wb[raw[:, bi]], settings)
+
+
+# Output pixels per gather chunk, sized so the index temporaries stay in cache
+GATHER_CHUNK_PIXELS = 1 << 16
+
+
+# Shortest run of equal offsets the NumPy engine copies as one slice:
+# copying a run from Python costs about as much as gathering this many pixels
+SLICE_RUN_PIXELS = 256
+
+
+def constant_runs_numpy(values, min_run=SLICE_RUN_PIXELS):
+    """
+    Splits the rows of values (map pixels or offsets, shape (rows, cols) or
+    (rows, cols, k)) into runs of equal values. Returns (starts, lengths,
+    long): flat start indices and lengths of every run, and which are at
+    least min_run long. None when the long runs would cover less than half
+    of the pixels and gathering them all is cheaper.
+    """
+    rows, cols = values.shape[:2]
+    if cols < min_run:
+        return None
+    if values.ndim == 3:
+        # Component by component: any() over a short last axis is slow
+        steps = values[:, 1:, 0] != values[:, :-1, 0]
+        for k in range(1, values.shape[2]):
+            steps |= values[:, 1:, k] != values[:, :-1, k]
+    else:
+        steps = values[:, 1:] != values[:, :-1]
+    # Every pixel of a run but its first is a non-step: a cheap upper bound
+    if 2 * (steps.size - np.count_nonzero(steps)) < rows * cols:
+        return None
+
+    starts = np.ones((rows, cols), dtype=bool)
+    starts[:, 1:] = steps
+    # Rows start new runs, so no run spans two rows
+    starts = np.flatnonzero(starts)
+    lengths = np.diff(starts, append=rows * cols)
+    long = lengths >= min_run
+    if 2 * int(lengths[long].sum()) < rows * cols:
+        return None
+    return starts, lengths, long
+
+
+def run_pixels(starts, lengths):
+    """Flat indices of every pixel of the runs (starts, lengths), in order."""
+    if not starts.size:
+        return starts
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1]) + np.repeat(starts - (ends - lengths), lengths)
+
+
+def gather_both_numpy(src_px, out, offsets, xs, ys, w, h, wrap_mode, src_y0, src_x0, src_cols):
+    """
+    General 2D gather: out[r, c] = source pixel at (xs[c] + offset, ys[r] + offset)
+    with the edge mode applied. Vector offsets, shape (rows, cols, 2), move
+    x and y separately. out is a contiguous (rows, cols) pixel array; rows
+    are processed in chunks that keep the indices in cache.
+    """
+    if offsets.ndim == 3:
+        x_offsets, y_offsets = offsets[..., 0], offsets[..., 1]
+    else:
+        x_offsets = y_offsets = offsets
+    rows, cols = x_offsets.shape
+
+    # Canvas (x, y) lives at y * src_cols + x - window_base in the source window
+    window_base = src_y0 * src_cols + src_x0
+
+    step = max(1, GATHER_CHUNK_PIXELS // cols)
+    for r0 in range(0, rows, step):
+        r1 = min(rows, r0 + step)
+        sx = xs + x_offsets[r0:r1]
+        sy = ys[r0:r1] + y_offsets[r0:r1]
+
+        # mode='clip' keeps np.take from buffering the output; indices are in range
+        if wrap_mode == 1:  # Wrap
+            np.mod(sx, w, out=sx)
+            sy -= src_y0
+            np.mod(sy, h, out=sy)
+            sy *= src_cols
+            sy += sx
+            sy -= src_x0
+            np.take(src_px, sy, out=out[r0:r1], mode='clip')
+        elif wrap_mode == 2:  # Clamp
+            np.clip(sx, 0, w - 1, out=sx)
+            np.clip(sy, 0, h - 1, out=sy)
+            sy *= src_cols
+            sy += sx
+            sy -= window_base
+            np.take(src_px, sy, out=out[r0:r1], mode='clip')
+        else:
+            # Transparent: pixels sampled from outside the canvas are zeroed
+            invalid = (sx < 0) | (sx >= w) | (sy < 0) | (sy >= h)
+            sy *= src_cols
+            sy += sx
+            sy -= window_base
+            np.take(src_px, sy, out=out[r0:r1], mode='clip')
+            out[r0:r1].view(np.uint8).reshape(r1 - r0, cols, -1)[invalid] = 0
+
+
+def gather_horizontal_numpy(src_px, out, offsets, xs, ys, w, h, wrap_mode, src_y0, src_x0, src_cols):
+    """
+    Horizontal gather: every output row reads only its own source row. The
+    row term is worked out once per row, edge handling is applied to x alone,
+    and rows are processed in chunks that keep the indices in cache.
+    """
+    rows, cols = offsets.shape
+    # Output rows are always inside the canvas; only Wrap has to fold the window
+    row_term = (np.mod(ys - src_y0, h) if wrap_mode == 1 else ys - src_y0) * src_cols - src_x0
+
+    step = max(1, GATHER_CHUNK_PIXELS // cols)
+    for r0 in range(0, rows, step):
+        r1 = min(rows, r0 + step)
+        sx = xs + offsets[r0:r1]
+        if wrap_mode == 1:  # Wrap
+            np.mod(sx, w, out=sx)
+        elif wrap_mode == 2:  # Clamp
+            np.clip(sx, 0, w - 1, out=sx)
+        else:
+            invalid = (sx < 0) | (sx >= w)
+        sx += row_term[r0:r1]
+        np.take(src_px, sx, out=out[r0:r1], mode='clip')
+        if wrap_mode == 0:
+            out[r0:r1].view(np.uint8).reshape(r1 - r0, cols, -1)[invalid] = 0
+
+
+def gather_vertical_numpy(src_px, out, offsets, xs, ys, w, h, wrap_mode, src_y0, src_x0, src_cols):
+    """
+    Vertical gather: every output column reads only its own source column.
+    The column term is worked out once, edge handling is applied to y alone,
+    and rows are processed in chunks, so each chunk reads short contiguous
+    runs of a few neighbouring source rows.
+    """
+    rows, cols = offsets.shape
+    col_term = xs - src_x0
+
+    step = max(1, GATHER_CHUNK_PIXELS // cols)
+    for r0 in range(0, rows, step):
+        r1 = min(rows, r0 + step)
+        sy = ys[r0:r1] + offsets[r0:r1]
+        if wrap_mode == 1:  # Wrap
+            sy -= src_y0
+            np.mod(sy, h, out=sy)
+        elif wrap_mode == 2:  # Clamp
+            np.clip(sy, 0, h - 1, out=sy)
+            sy -= src_y0
+        else:
+            invalid = (sy < 0) | (sy >= h)
+            sy -= src_y0
+        sy *= src_cols
+        sy += col_term
+        np.take(src_px, sy, out=out[r0:r1], mode='clip')
+        if wrap_mode == 0:
+            out[r0:r1].view(np.uint8).reshape(r1 - r0, cols, -1)[invalid] = 0
+
+
+def displace_numpy(src_mv, disp_mv, w, h, fmt, settings, y0=0, rows=None, src_y0=0, out=None, tables=None,
+                   x0=0, cols=None, src_x0=0, src_cols=None, offsets=None, map_fmt=None):
+    """
+    Vectorized displacement: decodes the map into an offset array, computes
+    all source coordinates at once and gathers whole pixels with fancy indexing.
+    Produces the same pixels as displace_python.
+
+    disp_mv holds the map rows [y0, y0 + rows), columns [x0, x0 + cols) of a
+    w x h canvas (all columns by default); the result covers the same pixels.
+    src_mv holds consecutive source rows starting at canvas row src_y0 (taken
+    modulo h), each covering columns [src_x0, src_x0 + src_cols), enough to
+    cover every pixel the band can sample from (with Wrap, whole rows). If
+    out is given, the result is written into that writable, zero-filled
+    buffer (rows * cols pixels) and returned instead of a new one.
+    tables comes from build_offset_tables and is built here when omitted.
+    offsets, if given, is the already decoded (rows, cols) slice of an offset
+    field (see decode_offset_field); disp_mv is then not read. For the
+    Vector direction it is (rows, cols, 2), x and y offsets per pixel.
+    fmt is the PixelFormat of the source and the result; map_fmt, that of
+    the map when it differs.
+    """
+    rows = h if rows is None else rows
+    cols = w if cols is None else cols
+    src_cols = w if src_cols is None else src_cols
+    wrap_mode = settings['wrap_mode']
+    direction = settings['direction']
+    map_fmt = map_fmt or fmt
+
+    if tables is None and offsets is None:
+        tables = build_offset_tables(map_fmt, settings, rows * cols)
+
+    xs = np.arange(x0, x0 + cols, dtype=np.int64)[np.newaxis, :]
+    ys = np.arange(y0, y0 + rows, dtype=np.int64)[:, np.newaxis]
+
+    vector = direction == VECTOR
+    field_shape = (rows, cols, 2) if vector else (rows, cols)
+
+    if settings['interpolation']:
+        if offsets is None:
+            offsets = decode_offsets_numpy(disp_mv, rows * cols, map_fmt, settings, tables).reshape(field_shape)
+        # Shifts are fractional here; the axis that does not move stays integer
+        if vector:
+            sx, sy = xs + offsets[..., 0], ys + offsets[..., 1]
+        else:
+            sx = xs + offsets if direction != 1 else np.broadcast_to(xs, (rows, cols))
+            sy = ys + offsets if direction != 0 else np.broadcast_to(ys, (rows, cols))
+        out_data = bytearray(rows * cols * fmt.pixel_size) if out is None else out
+        out_values = channels_numpy(out_data, rows * cols, fmt)
+        sample_filtered_numpy(src_mv, sx, sy, w, h, fmt, src_y0, wrap_mode,
+                              settings['interpolation'], out_values, src_x0, src_cols)
+        return out_data
+
+    stride = fmt.pixel_size
+    out_data = bytearray(rows * cols * stride) if out is None else out
+
+    # Rows whose map pixels are all identical (flat map areas) share one
+    # offset: they are decoded from their first pixel and copied as slices.
+    # Only the remaining rows are decoded in full and gathered.
+    if vector and offsets is None:
+        # Two decodes per pixel: screening the decoded pairs is cheaper than the raw pixels twice
+        offsets = decode_offsets_numpy(disp_mv, rows * cols, map_fmt, settings, tables).reshape(field_shape)
+    if offsets is None:
+        # Map pixels as 32-bit words where they divide evenly, bytes otherwise
+        words = map_fmt.pixel_size // 4 if map_fmt.pixel_size % 4 == 0 else 0
+        raw = np.frombuffer(disp_mv, dtype='<u4' if words else np.uint8,
+                            count=rows * cols * (words or map_fmt.pixel_size)).reshape(rows, cols, -1)
+        # Cheap screen on three pixels per row before comparing whole rows
+        first = raw[:, 0]
+        flat = (first == raw[:, cols // 2]).all(axis=1) & (first == raw[:, -1]).all(axis=1)
+    else:
+        # A decoded field is screened the same way, on offsets instead of map pixels
+        first = offsets[:, 0]
+        flat = (first == offsets[:, cols // 2]) & (first == offsets[:, -1])
+        if vector:
+            flat = flat.all(axis=1)
+    candidates = np.flatnonzero(flat)
+    if candidates.size:
+        values = raw if offsets is None else offsets
+        # A fully flat map is compared in place rather than copied row by row
+        block = values if candidates.size == rows else values[candidates]
+        flat[candidates] = (block == block[:, :1]).reshape(candidates.size, -1).all(axis=1)
+    target = None
+    if flat.any():
+        flat_rows = np.flatnonzero(flat)
+        if offsets is None:
+            firsts = np.ascontiguousarray(raw[flat_rows, 0])
+            flat_offsets = decode_offsets_numpy(firsts, flat_rows.size, map_fmt, settings, tables)
+        else:
+            flat_offsets = offsets[flat_rows, 0]
+        out_mv = memoryview(out_data)
+        for y, off in zip(flat_rows.tolist(), flat_offsets.tolist()):
+            dx, dy = off if vector else (off if direction != 1 else 0, off if direction != 0 else 0)
+            copy_run(out_mv, y * cols * stride, src_mv, x0 + dx, y0 + y + dy,
+                     cols, w, h, stride, wrap_mode, src_y0, src_x0, src_cols)
+        if flat.all():
+            return out_data
+        target = np.flatnonzero(~flat)
+        ys = ys[target]
+        if offsets is None:
+            raw = raw[target]
+        else:
+            offsets = offsets[target]
+
+    n_rows = rows if target is None else target.size
+    band_rows = np.arange(rows) if target is None else target
+
+    # Whole pixels are moved as opaque items
+    pixel = pixel_item_dtype(fmt)
+    src_px = np.frombuffer(src_mv, dtype=pixel, count=len(src_mv) // stride)
+    out_px = np.frombuffer(out_data, dtype=pixel, count=rows * cols)
+
+    # Horizontal and Vertical only ever move along one axis
+    gather = {0: gather_horizontal_numpy, 1: gather_vertical_numpy}.get(direction, gather_both_numpy)
+
+    # Rows that are flat but for a few pixels (a stripe or a stroke across a
+    # flat map): long runs of one map value are copied as slices like flat
+    # rows, and only the pixels between them are decoded and gathered
+    values = raw if offsets is None else offsets
+    runs = constant_runs_numpy(values)
+    if runs is not None:
+        starts, lengths, long = runs
+        flat_values = values.reshape((n_rows * cols,) + values.shape[2:])
+
+        def offsets_at(indices):
+            if offsets is not None:
+                return flat_values[indices]
+            return decode_offsets_numpy(np.ascontiguousarray(flat_values[indices]), indices.size, map_fmt,
+                                        settings, tables)
+
+        run_starts, run_lengths = starts[long], lengths[long]
+        run_rows, run_cols = np.divmod(run_starts, cols)
+        out_mv = memoryview(out_data)
+        for c, n, y, off in zip(run_cols.tolist(), run_lengths.tolist(), band_rows[run_rows].tolist(),
+                                offsets_at(run_starts).tolist()):
+            dx, dy = off if vector else (off if direction != 1 else 0, off if direction != 0 else 0)
+            copy_run(out_mv, (y * cols + c) * stride, src_mv, x0 + c + dx, y0 + y + dy,
+                     n, w, h, stride, wrap_mode, src_y0, src_x0, src_cols)
+
+        rest = run_pixels(starts[~long], lengths[~long])
+        if rest.size:
+            # The leftover pixels are gathered as one row of scattered positions
+            rest_rows, rest_cols = np.divmod(rest, cols)
+            gathered = np.empty((1, rest.size), dtype=pixel)
+            gather(src_px, gathered, offsets_at(rest)[np.newaxis], xs[:, rest_cols], ys[rest_rows, 0][np.newaxis],
+                   w, h, wrap_mode, src_y0, src_x0, src_cols)
+            out_px.reshape(rows, cols)[band_rows[rest_rows], rest_cols] = gathered[0]
+        return out_data
+
+    if offsets is None:
+        offsets = decode_offsets_numpy(disp_mv if target is None else raw, n_rows * cols, map_fmt, settings,
+                                       tables).reshape(n_rows, cols)
+
+    gathered = out_px if target is None else np.empty(n_rows * cols, dtype=pixel)
+    gather(src_px, gathered.reshape(n_rows, cols), offsets, xs, ys, w, h, wrap_mode, src_y0, src_x0, src_cols)
+
+    if target is not None:
+        out_px.reshape(rows, cols)[target] = gathered.reshape(n_rows, cols)
+
+    return out_data
+
+
+def displacement_reach(settings):
+    """
+    Farthest a pixel can sample from its own position along a displaced
+    axis: the maximum displacement plus the reach of the interpolation filter.
+    """
+    if settings['direction'] == VECTOR:
+        return max(displacement_reach(axis) for axis in vector_axis_settings(settings))
+    reach = FILTER_TAPS[settings['interpolation']][-1] if settings['interpolation'] else 0
+    return int(math.ceil(abs(settings['strength'] * settings['scale']))) + reach
+
+
+def source_halo(settings):
+    """Maximum number of rows a pixel can sample from above or below its own."""
+    if settings['direction'] == 0:  # Horizontal never leaves its row
+        return 0
+    if settings['direction'] == VECTOR:
+        return displacement_reach(vector_axis_settings(settings)[1])
+    return displacement_reach(settings)
+
+
+def source_margin(settings):
+    """Maximum number of columns a pixel can sample from left or right of its own."""
+    if settings['direction'] == 1:  # Vertical never leaves its column
+        return 0
+    if settings['direction'] == VECTOR:
+        return displacement_reach(vector_axis_settings(settings)[0])
+    return displacement_reach(settings)
+
+
+def rect_tuple(rect):
+    """(x, y, width, height) of a QRect-like object, or None when it is empty."""
+    if rect is None or rect.width() <= 0 or rect.height() <= 0:
+        return None
+    return rect.x(), rect.y(), rect.width(), rect.height()
+
+
+def work_region(w, h, bounds, selection, settings):
+    """
+    Canvas rectangle (x, y, width, height) whose pixels the displacement can
+    change: the layer bounds grown by the reach along the displaced axes,
+    cut down to the selection and the canvas. With Wrap, an axis whose grown
+    bounds cross the canvas edge is taken whole. bounds and selection are
+    (x, y, width, height) tuples; selection may be None. Returns None when
+    nothing can change (outside the region the output stays transparent,
+    exactly like the cloned layer).
+    """
+    if bounds is None:
+        return None
+
+    def grow(start, length, margin, size):
+        lo, hi = start - margin, start + length + margin
+        if settings['wrap_mode'] == 1 and (lo < 0 or hi > size):
+            return 0, size
+        return max(0, lo), min(size, hi)
+
+    x_lo, x_hi = grow(bounds[0], bounds[2], source_margin(settings), w)
+    y_lo, y_hi = grow(bounds[1], bounds[3], source_halo(settings), h)
+
+    if selection is not None:
+        x_lo, x_hi = max(x_lo, selection[0]), min(x_hi, selection[0] + selection[2])
+        y_lo, y_hi = max(y_lo, selection[1]), min(y_hi, selection[1] + selection[3])
+
+    if x_lo >= x_hi or y_lo >= y_hi:
+        return None
+    return x_lo, y_lo, x_hi - x_lo, y_hi - y_lo
+
+
+def source_columns(x0, cols, w, settings):
+    """
+    Source columns (first, count) the output columns [x0, x0 + cols) can
+    sample from. Wrap takes whole rows once the samples can cross an edge.
+    """
+    margin = source_margin(settings)
+    lo, hi = x0 - margin, x0 + cols + margin
+    if settings['wrap_mode'] == 1 and (lo < 0 or hi > w):
+        return 0, w
+    lo, hi = max(0, lo), min(w, hi)
+    return lo, hi - lo
+
+
+def source_rows(y0, rows, h, settings):
+    """
+    Source rows (first, count) the output rows [y0, y0 + rows) can sample
+    from. Wrap takes every row once the samples can cross an edge.
+    """
+    halo = source_halo(settings)
+    lo, hi = y0 - halo, y0 + rows + halo
+    if settings['wrap_mode'] == 1 and (lo < 0 or hi > h):
+        return 0, h
+    lo, hi = max(0, lo), min(h, hi)
+    return lo, hi - lo
+
+
+def out_of_core(w, h, fmt, settings):
+    """
+    True when the apply should stage its inputs in scratch files: the canvas
+    is above settings['scratch_threshold_mp'] megapixels, or the source rows
+    a strip can sample above and below it would not fit in the strip budget
+    on their own (every strip would then re-read them for a single row).
+    A threshold of 0 (or none) turns scratch files off.
+    """
+    threshold = settings.get('scratch_threshold_mp', 0)
+    if threshold <= 0:
+        return False
+    halo_bytes = 2 * source_halo(settings) * w * fmt.pixel_size
+    budget = int(settings['memory_budget_mb'] * 1024 * 1024)
+    return w * h > threshold * 1000000 or halo_bytes > budget // PIPELINE_DEPTH
+
+
+def band_height(w, h, stride, halo, budget_bytes, filtered=False):
+    """
+    Picks the number of output rows per strip so that the map strip, the
+    halo-padded source strip, the output strip and the NumPy temporaries
+    (~48 bytes per pixel, ~160 with an interpolating filter) stay within
+    budget_bytes. stride is the larger of the source and map pixel sizes.
+    """
+    temporaries = 160 if filtered else 48
+    per_row = w * (3 * stride + (temporaries if np is not None else 0))
+    fixed = 2 * halo * w * stride
+    return max(1, min(h, (budget_bytes - fixed) // per_row))
+
+
+def read_rows(read, w, h, start, end, x=0):
+    """
+    Reads canvas rows [start, end) (columns [x, x + w)) through
+    read(x, y, width, height), e.g. a node's pixelData, wrapping row indices
+    around the canvas height. Returns (data, first_row).
+    """
+    if end - start >= h:
+        return read(x, 0, w, h), 0
+    pieces = []
+    y = start
+    while y < end:
+        gy = y % h
+        n = min(end - y, h - gy)
+        pieces.append(read(x, gy, w, n))
+        y += n
+    if len(pieces) == 1:
+        return pieces[0], start % h
+    return b''.join(bytes(p) for p in pieces), start % h
+
+
+def submit_bands(executor, engine, src_mv, disp_mv, out_mv, w, h, fmt, settings,
+                 y0, rows, src_y0, workers, tables=None, x0=0, cols=None, src_x0=0, src_cols=None,
+                 offsets=None, map_fmt=None):
+    """
+    Splits a strip into row bands, one per worker, and returns their futures.
+    Every band reads the shared source window and writes straight into its
+    slice of out_mv. With a decoded offsets slice, disp_mv may be None.
+    """
+    cols = w if cols is None else cols
+    map_fmt = map_fmt or fmt
+    row_bytes = cols * fmt.pixel_size
+    map_row_bytes = cols * map_fmt.pixel_size
+    band = max(1, -(-rows // workers))
+    futures = []
+    for off in range(0, rows, band):
+        n = min(band, rows - off)
+        lo, hi = off * row_bytes, (off + n) * row_bytes
+        disp_band = disp_mv[off * map_row_bytes:(off + n) * map_row_bytes] if disp_mv is not None else None
+        futures.append(executor.submit(
+            engine, src_mv, disp_band, w, h, fmt, settings,
+            y0=y0 + off, rows=n, src_y0=src_y0, out=out_mv[lo:hi], tables=tables,
+            x0=x0, cols=cols, src_x0=src_x0, src_cols=src_cols,
+            offsets=offsets[off:off + n] if offsets is not None else None, map_fmt=map_fmt))
+    return futures
+
+
+def offset_field_bytes(width, height, settings):
+    """Memory a decoded offset field of width x height takes (see decode_offset_field)."""
+    components = 2 if settings['direction'] == VECTOR else 1
+    if np is None:
+        return width * height * components * 8
+    return width * height * components * np.dtype(offset_field_dtype(settings)).itemsize
+
+
+def offset_field_dtype(settings):
+    """Narrowest NumPy dtype that holds every offset (or shift) the settings can produce."""
+    if settings['interpolation']:
+        return np.float32
+    return np.int16 if displacement_reach(settings) < 32767 else np.int32
+
+
+def decode_offset_field(read_map, region, w, map_fmt, settings, executor, workers, budget_bytes,
+                        profile=NO_PROFILE):
+    """
+    Decodes the map over region = (x, y, width, height) once, so every target
+    of a batch reuses the offsets instead of reading and decoding the map
+    again. Returns (field, crc): field is a (height, width) array with NumPy
+    (int16/int32 offsets, float32 shifts when interpolating), otherwise a
+    list of array rows. The Vector direction adds a trailing axis of two
+    (x, y); its array rows interleave x and y. crc is the region_crc of the
+    map pixels the field was decoded from.
+    Map rows, in format map_fmt, are read through read_map(x, y, width,
+    height) in strips of about budget_bytes.
+    """
+    rx, ry, rw, rh = region
+    stride = map_fmt.pixel_size
+    tables = build_offset_tables(map_fmt, settings, rw * rh)
+    strip = max(1, min(rh, budget_bytes // (rw * stride)))
+
+    vector = settings['direction'] == VECTOR
+    if np is not None:
+        field = np.empty((rh, rw, 2) if vector else (rh, rw), dtype=offset_field_dtype(settings))
+    else:
+        field = []
+        typecode = 'd' if settings['interpolation'] else 'q'
+
+    def decode_band(mv, top, n):
+        field[top:top + n] = decode_offsets_numpy(mv, n * rw, map_fmt, settings, tables).reshape(field[top:top + n].shape)
+
+    crc = 0
+    for y0 in range(0, rh, strip):
+        rows = min(strip, rh - y0)
+        with profile.stage("read map"):
+            data = read_map(rx, ry + y0, rw, rows)
+        if not data:
+            raise RuntimeError("Cannot read pixel data from one of the layers.")
+        crc = zlib.crc32(data, crc)
+        mv = memoryview(data)
+
+        with profile.stage("decode map"):
+            if np is None:
+                get_offset = offset_reader(mv, map_fmt, settings, tables)
+                for y in range(rows):
+                    base = y * rw
+                    if vector:
+                        line = [v for x in range(rw) for v in get_offset((base + x) * stride)]
+                    else:
+                        line = [get_offset((base + x) * stride) for x in range(rw)]
+                    field.append(array.array(typecode, line))
+                continue
+
+            band = max(1, -(-rows // workers))
+            futures = [executor.submit(decode_band, mv[off * rw * stride:(off + n) * rw * stride], y0 + off, n)
+                       for off, n in ((off, min(band, rows - off)) for off in range(0, rows, band))]
+            for future in futures:
+                future.result()
+
+    return field, crc
+
+
+def field_nbytes(field):
+    if np is not None:
+        return field.nbytes
+    return sum(len(line) * line.itemsize for line in field)
+
+
+# Memory cap for decoded offset fields kept between applies
+OFFSET_FIELD_CACHE_BYTES = 512 * 1024 * 1024
+
+# (map uuid, map format, decode settings) -> (field region, field, map crc).
+# Wrap mode, output name and the source layer do not affect decoding, so
+# applies that only change those reuse the field. As with the result cache,
+# the map pixels under the field region are compared by CRC on a hit.
+offset_field_cache = LRUCache(OFFSET_FIELD_CACHE_BYTES, size_of=lambda entry: field_nbytes(entry[1]))
+
+
+def offset_field_key(disp_node, map_fmt, settings):
+    """Cache key of the offset field decoded from disp_node (in format map_fmt) with these settings."""
+    decode = tuple(settings[k] for k in ('channel', 'center', 'invert', 'strength', 'scale'))
+    if settings['direction'] == VECTOR:
+        decode += (settings['channel_y'], settings['strength_y'])
+    return disp_node.uniqueId().toString(), map_fmt.key, decode, bool(settings['interpolation'])
+
+
+def rect_union(a, b):
+    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def field_slice(field, field_region, x0, y0, cols, rows):
+    """Offsets of canvas rows [y0, y0 + rows), columns [x0, x0 + cols) of a decoded field."""
+    fx, fy = field_region[0], field_region[1]
+    if np is not None:
+        return field[y0 - fy:y0 - fy + rows, x0 - fx:x0 - fx + cols]
+    # Vector rows hold two values per pixel
+    k = len(field[0]) // field_region[2] if field else 1
+    return [line[(x0 - fx) * k:(x0 - fx + cols) * k] for line in field[y0 - fy:y0 - fy + rows]]
+
+
+# Strips kept in flight: while one is displaced, the next one is read
+PIPELINE_DEPTH = 2
+
+
+class StripRunner:
+    """
+    Displaces canvas regions strip by strip on a shared thread pool, for one
+    target or for a batch of targets using the same map and settings.
+
+    Node reads and writes stay on the calling thread (the Krita API is not
+    thread-safe); only the displacement runs in the pool. Up to
+    PIPELINE_DEPTH strips are in flight, so reading the next strip, or the
+    first strip of the next target, overlaps with displacing the previous
+    one. Call flush() to finish and write everything still pending.
+    fmt is the PixelFormat of the targets; map_fmt, that of the map when
+    it differs. With staged=True the sources are scratch-backed (see
+    scratch.py): source windows then take whole rows, which are views
+    rather than copies, and do not count against budget_bytes.
+    """
+
+    def __init__(self, executor, workers, w, h, fmt, settings, budget_bytes, field=None, field_region=None,
+                 profile=NO_PROFILE, map_fmt=None, staged=False):
+        self.executor = executor
+        self.workers = workers
+        self.w, self.h, self.fmt = w, h, fmt
+        self.map_fmt = map_fmt or fmt
+        self.settings = settings
+        self.budget_bytes = budget_bytes
+        self.field = field
+        self.field_region = field_region
+        self.profile = profile
+        self.staged = staged
+        engine = displace_numpy if np is not None else displace_python
+        # Summed over the worker threads, so it can exceed the wall time
+        self.engine = profile.timed("displace (workers)", engine)
+        self.pending = deque()
+
+    def run(self, region, read_source, read_map, read_orig, write, selection=None):
+        """
+        Displaces region = (x, y, width, height). All node access goes through
+        the callables: read_source / read_map / read_orig(x, y, width, height)
+        return the source, map and current output pixels, and
+        write(data, x, y, width, height) stores a finished strip. The
+        selection mask, if given, is blended in before writing.
+        """
+        w, h, fmt, map_fmt, settings = self.w, self.h, self.fmt, self.map_fmt, self.settings
+        rx, ry, rw, rh = region
+        if self.staged:
+            src_x0, src_cols = 0, w
+        else:
+            src_x0, src_cols = source_columns(rx, rw, w, settings)
+
+        # Each strip reads its map rows plus the source rows it can sample
+        # from (padded by the maximum displacement), so peak memory follows
+        # the budget rather than the canvas size.
+        halo = source_halo(settings)
+        band_h = band_height(src_cols, rh, max(fmt.pixel_size, map_fmt.pixel_size), 0 if self.staged else halo,
+                             self.budget_bytes // PIPELINE_DEPTH, bool(settings['interpolation']))
+        tables = None
+        if self.field is None:
+            tables = build_offset_tables(map_fmt, settings, rw * rh)
+
+        for y0 in range(ry, ry + rh, band_h):
+            rows = min(band_h, ry + rh - y0)
+
+            if self.field is None:
+                with self.profile.stage("read map"):
+                    disp_data = read_map(rx, y0, rw, rows)
+                offsets = None
+            else:
+                disp_data = None
+                offsets = field_slice(self.field, self.field_region, rx, y0, rw, rows)
+            with self.profile.stage("read source"):
+                if settings['wrap_mode'] == 1:
+                    src_data, src_y0 = read_rows(read_source, src_cols, h, y0 - halo, y0 + rows + halo, src_x0)
+                else:
+                    start = max(0, y0 - halo)
+                    src_data = read_source(src_x0, start, src_cols, min(h, y0 + rows + halo) - start)
+                    src_y0 = start
+
+            if not src_data or (offsets is None and not disp_data):
+                raise RuntimeError("Cannot read pixel data from one of the layers.")
+
+            out_data = bytearray(rows * rw * fmt.pixel_size)
+            futures = submit_bands(self.executor, self.engine, memoryview(src_data),
+                                   memoryview(disp_data) if offsets is None else None,
+                                   memoryview(out_data), w, h, fmt, settings,
+                                   y0, rows, src_y0, self.workers, tables, rx, rw, src_x0, src_cols, offsets,
+                                   map_fmt)
+            del src_data, disp_data
+            self.pending.append((futures, out_data, (rx, y0, rw, rows), read_orig, write, selection))
+
+            while len(self.pending) >= PIPELINE_DEPTH:
+                self.finish_oldest()
+
+    def finish_oldest(self):
+        futures, out_data, rect, read_orig, write, selection = self.pending.popleft()
+        with self.profile.stage("wait for workers"):
+            for future in futures:
+                future.result()
+
+        if selection is not None:
+            with self.profile.stage("blend selection"):
+                blend_selection(out_data, read_orig(*rect), selection.pixelData(*rect), self.fmt)
+
+        # Write the resulting strip back to the new node
+        write(out_data, *rect)
+
+    def flush(self):
+        while self.pending:
+            self.finish_oldest()
+
+
+def blend_selection(out_data, orig_data, mask, fmt):
+    """
+    Applies an 8-bit selection mask (one byte per pixel) to a displaced
+    strip of format fmt in place: fully deselected pixels keep orig_data,
+    partially selected ones are mixed proportionally.
+    """
+    if np is not None:
+        n = len(mask)
+        out = channels_numpy(out_data, n, fmt)
+        orig = channels_numpy(orig_data, n, fmt)
+        m = np.frombuffer(mask, dtype=np.uint8, count=n)
+        if (m == 255).all():
+            return
+        k = (m.astype(np.float32) / 255.0)[:, np.newaxis]
+        mixed = orig + (out.astype(np.float32) - orig) * k
+        out[:] = mixed if fmt.is_float else np.rint(mixed)
+        return
+
+    stride = fmt.pixel_size
+    read_px = pixel_reader(fmt)
+    out_mv = memoryview(out_data)
+    for i, m in enumerate(bytes(mask)):
+        if m == 255:
+            continue
+        idx = i * stride
+        if m == 0:
+            out_mv[idx:idx + stride] = orig_data[idx:idx + stride]
+            continue
+        k = m / 255.0
+        values = [o + (d - o) * k for d, o in zip(read_px(out_mv, idx), read_px(orig_data, idx))]
+        if not fmt.is_float:
+            values = [int(round(v)) for v in values]
+        fmt.packer.pack_into(out_mv, idx, *values)
+
+
+# -------------------- Result cache --------------------
+
+# Memory cap for full-resolution results kept between the 100% preview and Apply
+RESULT_CACHE_BYTES = 512 * 1024 * 1024
+
+# (source uuid, map uuid, w, h, source and map formats, engine settings) -> (source crc, map crc, result).
+# The cheap part is the key; the contents are compared by CRC only on a hit.
+displace_result_cache = LRUCache(RESULT_CACHE_BYTES, size_of=lambda entry: len(entry[2]))
+
+# Settings the displaced pixels depend on (naming, placement and threading do not)
+RESULT_SETTING_KEYS = ('strength', 'channel', 'direction', 'wrap_mode', 'interpolation',
+                       'invert', 'center', 'scale')
+
+
+def result_key(main_node, disp_node, w, h, fmt, settings, map_fmt=None):
+    """Cache key of the full-resolution result of displacing main_node by disp_node."""
+    engine = tuple(settings[k] for k in RESULT_SETTING_KEYS)
+    if settings['direction'] == VECTOR:
+        engine += (settings['channel_y'], settings['strength_y'])
+    return (main_node.uniqueId().toString(), disp_node.uniqueId().toString(), w, h,
+            fmt.key, (map_fmt or fmt).key, engine)
+
+
+def region_crc(read, region, fmt, budget_bytes):
+    """
+    CRC32 of the pixels of a layer over region = (x, y, width, height), read
+    through read(x, y, width, height) in strips of about budget_bytes.
+    """
+    rx, ry, rw, rh = region
+    strip = max(1, min(rh, budget_bytes // (rw * fmt.pixel_size)))
+    crc = 0
+    for y0 in range(ry, ry + rh, strip):
+        data = read(rx, y0, rw, min(strip, ry + rh - y0))
+        if not data:
+            raise RuntimeError("Cannot read pixel data from one of the layers.")
+        crc = zlib.crc32(data, crc)
+    return crc
+
+
+def content_crc(read, w, h, fmt, budget_bytes):
+    """CRC32 of a whole layer (see region_crc)."""
+    return region_crc(read, (0, 0, w, h), fmt, budget_bytes)
+
+
+# Rows of a layer read for its change token
+CHANGE_TOKEN_ROWS = 64
+
+
+def node_change_token(node, w, h, rows=CHANGE_TOKEN_ROWS):
+    """
+    Cheap change token of a node on a w x h canvas: its bounds plus a CRC32
+    of rows evenly spaced over the canvas, so it reads only rows / h of the
+    layer. It moves with most edits but can miss one that touches no
+    sampled row without changing the bounds; caches that must never hand
+    back stale pixels compare a content_crc instead.
+    """
+    crc = 0
+    for y in sample_positions(min(rows, h), h):
+        data = node.pixelData(0, y, w, 1)
+        if not data:
+            raise RuntimeError("Cannot read pixel data from one of the layers.")
+        crc = zlib.crc32(data, crc)
+    return rect_tuple(node.bounds()), crc
+
+
+def cached_result(key, read_source, read_map, w, h, fmt, budget_bytes, map_fmt=None):
+    """The cached result for key if both inputs still hold the pixels it was made from, else None."""
+    entry = displace_result_cache.get(key)
+    if entry is None:
+        return None
+    if (content_crc(read_source, w, h, fmt, budget_bytes) != entry[0]
+            or content_crc(read_map, w, h, map_fmt or fmt, budget_bytes) != entry[1]):
+        return None
+    return entry[2]
+
+
+def write_result(result, region, w, h, fmt, read_orig, write, selection=None, budget_bytes=64 * 1024 * 1024):
+    """
+    Writes region = (x, y, width, height) of a whole-canvas result through
+    write(data, x, y, width, height), blending the selection mask in like
+    StripRunner does. A full-canvas region without a selection is written
+    in one call straight from the cached buffer.
+    """
+    rx, ry, rw, rh = region
+    stride = fmt.pixel_size
+    row_bytes = w * stride
+    if selection is None and region == (0, 0, w, h):
+        write(result, *region)
+        return
+
+    result_mv = memoryview(result)
+    strip = max(1, min(rh, budget_bytes // (rw * stride)))
+    for y0 in range(ry, ry + rh, strip):
+        rows = min(strip, ry + rh - y0)
+        out_data = bytearray(rows * rw * stride)
+        for y in range(rows):
+            lo = (y0 + y) * row_bytes + rx * stride
+            out_data[y * rw * stride:(y + 1) * rw * stride] = result_mv[lo:lo + rw * stride]
+        rect = (rx, y0, rw, rows)
+        if selection is not None:
+            blend_selection(out_data, read_orig(*rect), selection.pixelData(*rect), fmt)
+        write(out_data, *rect)
+
+
+# Pixels per worker band of displace_canvas; cancellation is checked between bands
+CANVAS_BAND_PIXELS = 1 << 16
+
+
+def displace_canvas(src_data, disp_data, w, h, fmt, settings, cancelled=None, map_fmt=None):
+    """
+    Displaces whole w x h canvases with the apply engine, in bands of rows,
+    so both the preview (at any scale) and the 100% result use the same
+    math. cancelled is polled between bands; when it returns True the
+    render stops and None is returned.
+    """
+    return displace_region(src_data, disp_data, w, h, fmt, (0, 0, w, h), (0, w, 0), settings, cancelled, map_fmt)
+
+
+def region_inputs(read_source, read_map, w, h, region, settings):
+    """
+    Reads what displacing region = (x, y, width, height) of a w x h canvas
+    needs, through read(x, y, width, height) callables like a node's
+    pixelData: the source over the region padded by the reach along the
+    displaced axes (whole rows or columns once Wrap crosses an edge), and the
+    map over the region alone. Returns (source, map, window), window being
+    the (first column, columns, first row) of the source for displace_region.
+    """
+    rx, ry, rw, rh = region
+    src_x0, src_cols = source_columns(rx, rw, w, settings)
+    halo = source_halo(settings)
+    if settings['wrap_mode'] == 1:
+        src_data, src_y0 = read_rows(read_source, src_cols, h, ry - halo, ry + rh + halo, src_x0)
+    else:
+        src_y0 = max(0, ry - halo)
+        src_data = read_source(src_x0, src_y0, src_cols, min(h, ry + rh + halo) - src_y0)
+    disp_data = read_map(rx, ry, rw, rh)
+    if not src_data or not disp_data:
+        raise RuntimeError("Cannot read pixel data from one of the layers.")
+    return src_data, disp_data, (src_x0, src_cols, src_y0)
+
+
+def displace_region(src_data, disp_data, w, h, fmt, region, window, settings, cancelled=None, map_fmt=None):
+    """
+    Displaces region = (x, y, width, height) of a w x h canvas at full
+    resolution from the buffers region_inputs reads, and returns its
+    width x height pixels. The cost follows the region, not the canvas, so a
+    detail preview stays cheap on any document. cancelled is polled between
+    bands as in displace_canvas.
+    """
+    engine = displace_numpy if np is not None else displace_python
+    workers = max(1, settings.get('workers', 1)) if np is not None else 1
+    map_fmt = map_fmt or fmt
+    rx, ry, rw, rh = region
+    src_x0, src_cols, src_y0 = window
+    stride, map_stride = fmt.pixel_size, map_fmt.pixel_size
+    src_mv, disp_mv = memoryview(src_data), memoryview(disp_data)
+    out_data = bytearray(rw * rh * stride)
+    out_mv = memoryview(out_data)
+    tables = build_offset_tables(map_fmt, settings, rw * rh)
+    # One band per worker between two checks of cancelled
+    step = max(1, CANVAS_BAND_PIXELS // rw) * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for y0 in range(0, rh, step):
+            if cancelled is not None and cancelled():
+                return None
+            rows = min(step, rh - y0)
+            lo, hi = y0 * rw * stride, (y0 + rows) * rw * stride
+            disp_band = disp_mv[y0 * rw * map_stride:(y0 + rows) * rw * map_stride]
+            for future in submit_bands(executor, engine, src_mv, disp_band, out_mv[lo:hi], w, h, fmt,
+                                       settings, ry + y0, rows, src_y0, workers, tables, rx, rw, src_x0, src_cols,
+                                       map_fmt=map_fmt):
+                future.result()
+    return out_data
+
+
+def displace_cached(key, src_data, disp_data, w, h, fmt, settings, cancelled=None, map_fmt=None):
+    """
+    displace_canvas through displace_result_cache: returns the stored result
+    when key and the input contents match, otherwise computes and stores it.
+    The result must not be modified afterwards.
+    """
+    crcs = zlib.crc32(src_data), zlib.crc32(disp_data)
+    entry = displace_result_cache.get(key)
+    if entry is not None and entry[:2] == crcs:
+        return entry[2]
+    result = displace_canvas(src_data, disp_data, w, h, fmt, settings, cancelled, map_fmt)
+    if result is not None:
+        displace_result_cache.put(key, crcs + (result,))
+    return result
+
+
+# -------------------- Drivers --------------------
+
+def displace(src_data, disp_data, w, h, depth, settings, map_fmt=None):
+    """
+    Displaces a whole w x h canvas in one call and returns the output
+    buffer. depth is a PixelFormat, or a doc.colorDepth() value or a
+    bytes-per-channel count for RGBA.
+    """
+    fmt = depth if isinstance(depth, PixelFormat) else rgba_format(depth)
+    engine = displace_numpy if np is not None else displace_python
+    return engine(memoryview(src_data), memoryview(disp_data), w, h, fmt, settings, map_fmt=map_fmt)
+
+
+def apply_to_document(doc, main_node, disp_node, settings, profile=NO_PROFILE):
+    """
+    Full-resolution apply: clones main_node into a new layer, then displaces
+    the part of it that can change strip by strip, using disp_node as the
+    map. Returns the new node.
+    """
+    return apply_batch(doc, [main_node], disp_node, settings, profile=profile)[0]
+
+
+def apply_batch(doc, targets, disp_node, settings, frames=None, profile=NO_PROFILE):
+    """
+    Displaces several targets with the same map. Every paint layer in
+    targets gets its own displaced copy; with frames = (first, last), the
+    single layer in targets is cloned once and each of its keyframes in that
+    range is displaced into the matching frame of the copy.
+
+    The map is decoded once into an offset field shared by all targets (when
+    it fits in half of the memory budget) and kept in offset_field_cache for
+    later applies with the same map and decode settings. A layer whose result
+    is already in displace_result_cache (from a 100% preview) is written from
+    there instead. The targets are pipelined
+    through one thread pool, so the setup is paid once per batch rather than
+    once per target; targets in different color spaces run as one batch per
+    pixel format, sharing the field. Returns the new nodes. profile, if given, records the
+    time (and memory) each stage takes.
+    """
+    w = doc.width()
+    h = doc.height()
+    if not targets:
+        return []
+    if frames is not None:
+        if len(targets) != 1:
+            raise ValueError("A frame range applies to exactly one layer.")
+        keyframes = animation_keyframes(targets[0], frames)
+        if not keyframes:
+            raise RuntimeError(f"Layer '{targets[0].name()}' has no keyframes in frames {frames[0]}-{frames[1]}.")
+
+    doc.setBatchmode(True)
+    try:
+        with profile.stage("pixel formats"):
+            map_fmt = layer_format(disp_node, w)
+            formats = [layer_format(main_node, w) for main_node in targets]
+
+        new_nodes = []
+        with profile.stage("clone layers"):
+            for main_node in targets:
+                new_node = main_node.clone()
+                layer_name = settings['layer_name'].replace('{layer}', main_node.name())
+                new_node.setName(layer_name)
+
+                parent = main_node.parentNode()
+                if settings['create_above']:
+                    parent.addChildNode(new_node, main_node)
+                else:
+                    parent.addChildNode(new_node, None)
+                new_nodes.append(new_node)
+
+        # Only the layer bounds (grown by the reach) inside the selection can
+        # change; the clone already holds every other pixel.
+        selection = doc.selection()
+        selection_rect = rect_tuple(selection) if selection is not None else None
+        # Pixel format -> jobs of the targets in that format
+        jobs = {}
+        if selection is None or selection_rect is not None:
+            if frames is None:
+                budget = int(settings['memory_budget_mb'] * 1024 * 1024)
+                for main_node, new_node, fmt in zip(targets, new_nodes, formats):
+                    with profile.stage("layer bounds"):
+                        bounds = rect_tuple(main_node.bounds())
+                    region = work_region(w, h, bounds, selection_rect, settings)
+                    if region is None:
+                        continue
+                    write = node_writer(doc, new_node, profile=profile)
+                    with profile.stage("result cache"):
+                        result = cached_result(result_key(main_node, disp_node, w, h, fmt, settings, map_fmt),
+                                               main_node.pixelData, disp_node.pixelData, w, h, fmt, budget,
+                                               map_fmt)
+                    if result is not None:
+                        write_result(result, region, w, h, fmt, new_node.pixelData, write, selection, budget)
+                    else:
+                        jobs.setdefault(fmt, []).append((region, main_node.pixelData, new_node.pixelData, write))
+            else:
+                # Bounds follow the current frame only, so every frame takes the whole canvas
+                region = work_region(w, h, (0, 0, w, h), selection_rect, settings)
+                if region is not None:
+                    for t in keyframes:
+                        read_frame = frame_reader(targets[0], t)
+                        jobs.setdefault(formats[0], []).append((region, read_frame, read_frame,
+                                                                node_writer(doc, new_nodes[0], t, profile)))
+
+        for fmt, fmt_jobs in jobs.items():
+            run_jobs(doc, fmt_jobs, disp_node, selection, w, h, fmt, settings, profile, map_fmt)
+
+        with profile.stage("refreshProjection"):
+            doc.refreshProjection()
+    finally:
+        doc.setBatchmode(False)
+
+    try:
+        with profile.stage("waitForDone"):
+            doc.waitForDone()
+    except:
+        pass
+
+    return new_nodes
+
+
+def layer_format(node, w):
+    """PixelFormat of a layer's pixel data, checked against the data it actually returns."""
+    try:
+        fmt = node_format(node)
+    except ValueError as e:
+        raise RuntimeError(f"Layer '{node.name()}': {e}") from None
+
+    # Проверка размера пикселя по одной строке, чтобы не читать весь холст
+    probe = node.pixelData(0, 0, w, 1)
+    if not probe:
+        raise RuntimeError("Cannot read pixel data from one of the layers.")
+    if len(probe) != w * fmt.pixel_size:
+        raise RuntimeError(f"Layer '{node.name()}' returned {len(probe) // w} bytes per pixel, "
+                           f"expected {fmt.pixel_size} for {fmt.model}/{fmt.depth}.")
+    return fmt
+
+
+def animation_keyframes(node, frames):
+    """Frames in the inclusive range frames = (first, last) that hold a keyframe of node."""
+    first, last = frames
+    return [t for t in range(first, last + 1) if node.hasKeyframeAtTime(t)]
+
+
+def frame_reader(node, t):
+    """read(x, y, w, h) returning the node's pixels at frame t."""
+    return lambda x, y, w, h: node.pixelDataAtTime(x, y, w, h, t)
+
+
+def node_writer(doc, node, t=None, profile=NO_PROFILE):
+    """
+    write(data, x, y, w, h) storing a strip into node; for an animated copy
+    (t is not None) the document is moved to frame t first, since
+    setPixelData writes the current frame. data goes to setPixelData as is:
+    PyQt takes a bytearray for a QByteArray without a bytes() copy first.
+    """
+    def write(data, x, y, w, h):
+        if t is not None and doc.currentTime() != t:
+            doc.setCurrentTime(t)
+        with profile.stage("setPixelData"):
+            node.setPixelData(data, x, y, w, h)
+    return write
+
+
+def run_jobs(doc, jobs, disp_node, selection, w, h, fmt, settings, profile=NO_PROFILE, map_fmt=None):
+    """
+    Runs (region, read_source, read_orig, write) jobs on targets of format
+    fmt through one StripRunner. The map (of format map_fmt, fmt by
+    default) is decoded once over the union of their regions, or taken from
+    offset_field_cache when an earlier apply already decoded it with the
+    same settings from the same map pixels.
+
+    Out of core (see out_of_core), each job's source rows are first staged
+    in a scratch file and its strips read views of it, so a large
+    displacement does not hold its halo rows in memory; a map that is not
+    decoded into a field is staged once too rather than read per target.
+    """
+    map_fmt = map_fmt or fmt
+    staged = out_of_core(w, h, fmt, settings)
+    scratch_dir = settings.get('scratch_dir') or None
+    budget = int(settings['memory_budget_mb'] * 1024 * 1024)
+
+    # The per-pixel loop holds the GIL, so only the NumPy engine gains from threads
+    workers = max(1, settings['workers']) if np is not None else 1
+
+    field_region = jobs[0][0]
+    for job in jobs[1:]:
+        field_region = rect_union(field_region, job[0])
+
+    # Fields that do not fit in half of the budget are decoded strip by strip instead
+    key = None
+    field = None
+    if offset_field_bytes(field_region[2], field_region[3], settings) <= budget // 2:
+        key = offset_field_key(disp_node, map_fmt, settings)
+        cached = offset_field_cache.get(key)
+        if cached is not None:
+            if rect_union(cached[0], field_region) == cached[0]:
+                # A map edited since is decoded again and replaces the entry
+                with profile.stage("map crc"):
+                    crc = region_crc(disp_node.pixelData, cached[0], map_fmt, budget // 2)
+                if crc == cached[2]:
+                    field_region, field = cached[0], cached[1]
+            else:
+                # Grow the cached area rather than trade one region for another
+                grown = rect_union(cached[0], field_region)
+                if offset_field_bytes(grown[2], grown[3], settings) <= budget // 2:
+                    field_region = grown
+
+    start_time = doc.currentTime()
+    with ThreadPoolExecutor(max_workers=workers) as executor, contextlib.ExitStack() as scratch:
+        if key is not None:
+            if field is None:
+                field, crc = decode_offset_field(disp_node.pixelData, field_region, w, map_fmt, settings,
+                                                 executor, workers, budget // 2, profile)
+                if np is not None:
+                    # Shared by every later apply: never written to again
+                    field.flags.writeable = False
+                offset_field_cache.put(key, (field_region, field, crc))
+            budget -= field_nbytes(field)
+        else:
+            field_region = None
+
+        read_map = disp_node.pixelData
+        if staged and field is None and len(jobs) > 1:
+            # Read the map from Krita once instead of once per target
+            map_buf = scratch.enter_context(stage_layer(read_map, w, h, map_fmt.pixel_size, budget, scratch_dir,
+                                                        profile, "stage map"))
+            read_map = scratch_reader(map_buf, w, map_fmt.pixel_size)
+
+        runner = StripRunner(executor, workers, w, h, fmt, settings, budget, field, field_region, profile, map_fmt,
+                             staged)
+        try:
+            for region, read_source, read_orig, write in jobs:
+                if not staged:
+                    runner.run(region, read_source, read_map, read_orig, write, selection)
+                    continue
+                first, count = source_rows(region[1], region[3], h, settings)
+                with stage_layer(read_source, w, count, fmt.pixel_size, budget, scratch_dir, profile,
+                                 "stage source", first) as source_buf:
+                    runner.run(region, scratch_reader(source_buf, w, fmt.pixel_size, first), read_map,
+                               read_orig, write, selection)
+                    # Strips in flight read views of the staged rows: finish them first
+                    runner.flush()
+            runner.flush()
+        finally:
+            if doc.currentTime() != start_time:
+                doc.setCurrentTime(start_time)
+
+
+# -------------------- Preview --------------------
+
+# Lazily built 65536-entry tables, indexed by a 16-bit linear value or,
+# for the half_ ones, by the bit pattern of an F16 value
+_srgb_u8_table = None
+_alpha_u8_table = None
+_half_srgb_u8_table = None
+_half_alpha_u8_table = None
+
+# Pixels converted per NumPy chunk, to keep float temporaries small
+CONVERT_CHUNK_PIXELS = 1 << 20
+
+
+def srgb_u8_table():
+    """Table mapping a 16-bit linear value v to linear_to_srgb_u8(v / 65535)."""
+    global _srgb_u8_table
+    if _srgb_u8_table is None:
+        _srgb_u8_table = bytes(linear_to_srgb_u8(v / 65535.0) for v in range(65536))
+    return _srgb_u8_table
+
+
+def alpha_u8_table():
+    """Table mapping a 16-bit alpha value to 8 bits (alpha stays linear)."""
+    global _alpha_u8_table
+    if _alpha_u8_table is None:
+        _alpha_u8_table = bytes(max(0, min(255, int(v / 65535.0 * 255 + 0.5))) for v in range(65536))
+    return _alpha_u8_table
+
+
+def half_srgb_u8_table():
+    """Table mapping an F16 bit pattern to 8-bit sRGB, clamped to 0..1 and quantized to 16 bits first."""
+    global _half_srgb_u8_table
+    if _half_srgb_u8_table is None:
+        srgb = srgb_u8_table()
+        _half_srgb_u8_table = bytes(srgb[int(min(1.0, max(0.0, v)) * 65535.0 + 0.5)] if v == v else 0
+                                    for v in half_float_values())
+    return _half_srgb_u8_table
+
+
+def half_alpha_u8_table():
+    """Table mapping an F16 alpha bit pattern to 8 bits."""
+    global _half_alpha_u8_table
+    if _half_alpha_u8_table is None:
+        _half_alpha_u8_table = bytes(int(min(1.0, max(0.0, v)) * 255 + 0.5) if v == v else 0
+                                     for v in half_float_values())
+    return _half_alpha_u8_table
+
+
+def convert_to_u8_rgba(raw_data, width, height, fmt, profile=NO_PROFILE):
+    """
+    Конвертирует пиксельные данные из различных форматов в 8-bit RGBA.
+    Применяет линейно-sRGB конверсию для корректного отображения.
+
+    fmt is a PixelFormat, or a doc.colorDepth() value for RGBA (ValueError
+    for a depth the plugin does not support). The result
+    is BGRA like Krita's U8 RGBA: float RGBA is swapped into that order and
+    gray is copied into all three colour channels. U16 goes through
+    65536-entry lookup tables, F16 through tables keyed on its bit
+    patterns; F32 values are clamped, quantized to 16 bits and sent through
+    the U16 tables. CMYK is converted naively,
+    without a profile, which is enough to judge the displacement.
+    """
+    pixel_count = width * height
+
+    if isinstance(fmt, str):
+        # ValueError for an unknown depth: callers report it like any failed read
+        fmt = rgba_format(fmt)
+
+    if fmt is PREVIEW_FORMAT:
+        # Уже в 8-bit формате, просто возвращаем
+        # Примечание: предполагаем, что U8 данные уже в sRGB.
+        return raw_data
+
+    with profile.stage("convert to 8-bit"):
+        if np is not None:
+            return _convert_to_u8_numpy(raw_data, pixel_count, fmt)
+        return _convert_to_u8_python(raw_data, pixel_count, fmt)
+
+
+def _convert_to_u8_numpy(raw_data, pixel_count, fmt):
+    src = channels_numpy(raw_data, pixel_count, fmt)
+    if fmt.depth == "F16":
+        # Bit patterns index the F16 tables just like U16 values index the U16 ones
+        src = src.view('<u2')
+        srgb = np.frombuffer(half_srgb_u8_table(), dtype=np.uint8)
+        alpha = np.frombuffer(half_alpha_u8_table(), dtype=np.uint8)
+    else:
+        srgb = np.frombuffer(srgb_u8_table(), dtype=np.uint8)
+        alpha = np.frombuffer(alpha_u8_table(), dtype=np.uint8)
+    result = np.empty((pixel_count, 4), dtype=np.uint8)
+    # Source channels of the output blue, green and red
+    bgr = list(reversed(fmt.rgb)) if fmt.rgb is not None else None
+
+    for start in range(0, pixel_count, CONVERT_CHUNK_PIXELS):
+        chunk = src[start:start + CONVERT_CHUNK_PIXELS]
+        out = result[start:start + CONVERT_CHUNK_PIXELS]
+        if fmt.model == "CMYKA":
+            inks = chunk.view(fmt.dtype) if fmt.depth == "F16" else chunk
+            out[:, :3] = np.rint(unit_rgb_numpy(inks, fmt)[:, ::-1] * 255.0)
+        elif fmt.bpc == 1:
+            # U8 данные уже в sRGB
+            out[:, :3] = chunk[:, bgr]
+        elif fmt.bpc == 2:
+            # U16 и F16: альфа остается линейной
+            out[:, :3] = srgb[chunk[:, bgr]]
+        else:
+            values = np.nan_to_num(chunk[:, bgr].astype(np.float32), nan=0.0)
+            np.clip(values, 0.0, 1.0, out=values)
+            out[:, :3] = srgb[np.rint(values * 65535.0).astype(np.uint16)]
+
+        if fmt.bpc == 1:
+            out[:, 3] = chunk[:, fmt.alpha]
+        elif fmt.bpc == 2:
+            out[:, 3] = alpha[chunk[:, fmt.alpha]]
+        else:
+            values = np.clip(np.nan_to_num(chunk[:, fmt.alpha].astype(np.float64), nan=0.0), 0.0, 1.0)
+            out[:, 3] = np.floor(values * 255.0 + 0.5).astype(np.uint8)
+
+    return result.tobytes()
+
+
+def _convert_to_u8_python(raw_data, pixel_count, fmt):
+    if fmt.depth == "F16":
+        srgb, alpha = half_srgb_u8_table(), half_alpha_u8_table()
+    else:
+        srgb, alpha = srgb_u8_table(), alpha_u8_table()
+    result = bytearray(pixel_count * 4)
+    n_ch = fmt.channels
+    count = pixel_count * n_ch
+
+    if fmt.bpc == 1:
+        values = bytes(raw_data[:count])
+        to_rgb = to_alpha = None
+    elif fmt.bpc == 2:
+        # F16 is read as bit patterns: array has no half-float type
+        values = array.array('H')
+        values.frombytes(bytes(raw_data[:count * 2]))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        to_rgb = srgb.__getitem__
+        to_alpha = alpha.__getitem__
+    else:
+        values = struct.unpack_from(f'<{count}f', raw_data)
+        to_rgb = lambda v: srgb[int(min(1.0, max(0.0, v)) * 65535.0 + 0.5)] if v == v else 0
+        to_alpha = lambda v: int(min(1.0, max(0.0, v)) * 255 + 0.5) if v == v else 0
+
+    if fmt.model == "CMYKA":
+        read_rgb = rgb_reader(fmt)
+        raw_mv = memoryview(raw_data)
+        for i in range(pixel_count):
+            r, g, b = read_rgb(raw_mv, i * fmt.pixel_size)
+            result[i * 4:i * 4 + 3] = bytes(int(v * 255.0 + 0.5) for v in (b, g, r))
+    else:
+        # Выход в формате BGRA: каждый канал переводится одним срезом
+        for c, ch in enumerate(reversed(fmt.rgb)):
+            picked = values[ch::n_ch]
+            result[c::4] = picked if to_rgb is None else bytes(map(to_rgb, picked))
+    picked = values[fmt.alpha::n_ch]
+    result[3::4] = picked if to_alpha is None else bytes(map(to_alpha, picked))
+    return bytes(result)
+
+
+def linear_to_srgb_u8(linear_val):
+    """Конвертирует линейное значение (0.0-1.0) в sRGB u8 (0-255)"""
+    # Клампим значение
+    linear_val = max(0.0, min(1.0, linear_val))
+
+    # Применяем sRGB гамма-коррекцию
+    if linear_val <= 0.0031308:
+        srgb = 12.92 * linear_val
+    else:
+        srgb = 1.055 * math.pow(linear_val, 1.0 / 2.4) - 0.055
+
+    # Конвертируем в 8-bit
+    return max(0, min(255, int(srgb * 255 + 0.5)))
+
+
+def preview_size(w, h, scale):
+    """Preview dimensions for a w x h canvas at the given scale."""
+    return max(1, int(w * scale)), max(1, int(h * scale))
+
+
+def zoom_region(w, h, center, zoom, view_w, view_h):
+    """
+    Canvas rectangle (x, y, width, height) a view_w x view_h preview shows at
+    an integer zoom (1 = 100%) around center = (x, y), moved to stay inside
+    the canvas.
+    """
+    rw = min(w, -(-view_w // zoom))
+    rh = min(h, -(-view_h // zoom))
+    x = min(max(0, int(round(center[0] - rw / 2))), w - rw)
+    y = min(max(0, int(round(center[1] - rh / 2))), h - rh)
+    return x, y, rw, rh
+
+
+def sample_positions(n_out, n_in):
+    """Nearest source index for each of n_out evenly spaced samples over n_in."""
+    return [min(n_in - 1, (2 * i + 1) * n_in // (2 * n_out)) for i in range(n_out)]
+
+
+def load_preview_buffer(node, w, h, fmt, pw, ph, profile=NO_PROFILE):
+    """
+    Reads a node whose pixels are in format fmt at preview size as 8-bit
+    BGRA. The native data is decimated first and only the reduced pixels
+    are converted: when at most every other row is needed, only the
+    sampled rows are read at all. Like Apply and the 100% preview, it reads
+    the layer's own pixelData, not its projection, so every preview scale
+    shows what Apply will displace.
+    """
+    pixel_size = fmt.pixel_size
+    rows = sample_positions(ph, h)
+    cols = sample_positions(pw, w)
+    row_bytes = w * pixel_size
+
+    with profile.stage("pixelData"):
+        if ph * 2 <= h:
+            picked = b''.join(bytes(node.pixelData(0, y, w, 1)) for y in rows)
+        else:
+            full = node.pixelData(0, 0, w, h)
+            if not full:
+                raise RuntimeError("Cannot read pixel data from one of the layers.")
+            if ph == h:
+                picked = full
+            else:
+                full_mv = memoryview(full)
+                picked = b''.join(full_mv[y * row_bytes:(y + 1) * row_bytes] for y in rows)
+            del full
+
+    if len(picked) < ph * row_bytes:
+        raise RuntimeError("Cannot read pixel data from one of the layers.")
+
+    if pw != w:
+        with profile.stage("decimate columns"):
+            if np is not None:
+                pixel = np.dtype((np.void, pixel_size))
+                grid = np.frombuffer(picked, dtype=pixel, count=ph * w).reshape(ph, w)
+                picked = grid[:, cols].tobytes()
+            else:
+                picked_mv = memoryview(picked)
+                picked = b''.join(picked_mv[(r * w + c) * pixel_size:(r * w + c + 1) * pixel_size]
+                                  for r in range(ph) for c in cols)
+
+    return convert_to_u8_rgba(picked, pw, ph, fmt, profile)
+
+
+def displace_preview(src_data, disp_data, pw, ph, settings, preview_scale, cancelled=None):
+    """
+    Displaces 8-bit BGRA preview buffers of pw x ph pixels with the apply
+    engine. Strength is scaled by preview_scale so the preview matches the
+    full-resolution result. cancelled is polled between row bands; when it
+    returns True the render stops and None is returned.
+    """
+    settings = dict(settings, scale=settings['scale'] * preview_scale)
+    return displace_canvas(src_data, disp_data, pw, ph, PREVIEW_FORMAT, settings, cancelled)
@@ -2,30 +2,53 @@ from krita import *
 from PyQt5.QtWidgets import (
     QDialog, QVBoxLayout, QHBoxLayout, QLabel,
     QDoubleSpinBox, QComboBox, QPushButton,
-    QCheckBox, QGroupBox, QSlider
+    QCheckBox, QGroupBox, QSlider, QSpinBox, QListWidget, QListWidgetItem, QLineEdit
 )
-from PyQt5.QtCore import Qt, QTimer, QSettings
-from PyQt5.QtGui import QImage, QPixmap
-import struct
+from PyQt5.QtCore import Qt, QEvent, QTimer, QSettings, QThreadPool
+from PyQt5.QtGui import QImage, QPixmap, QFontDatabase
 import time
-import math
-import array
+import os
+
+from . import displace_core
+from .caching import LRUCache
+from .node_registry import NodeRegistry, node_uuid
+from .instrumentation import NO_PROFILE, profile_for
+from .preview_worker import PreviewJob
+
+# Memory cap for cached preview-size layer data
+PREVIEW_CACHE_BYTES = 256 * 1024 * 1024
+
+# Scale of the quick first pass shown before the requested preview scale
+PROGRESSIVE_SCALE = 0.05
+
+# Zoom choices of the preview: 0 fits the whole canvas (at the preview scale),
+# the others show a full-resolution detail of the canvas enlarged that many times
+PREVIEW_ZOOMS = [("Fit", 0), ("100%", 1), ("200%", 2), ("400%", 4), ("800%", 8)]
 
 class DisplaceDialog(QDialog):
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, batch=False):
         super().__init__(parent)
-        self.setWindowTitle("Displace Map Filter")
+        self.setWindowTitle("Displace Map Filter (Batch)" if batch else "Displace Map Filter")
         self.setMinimumWidth(700)
 
         self.doc = None
-
-        # Caching for scaled (preview size) data
-        self.cached_src_scaled_data = None
-        self.cached_disp_scaled_data = None
-        self.cached_preview_scale = 0.0
-        self.cached_w = 0
-        self.cached_h = 0
+        self.batch = batch
+        # One index of the layer tree, rebuilt by populate_layers
+        self.registry = NodeRegistry()
+
+        # Scaled (preview size) layer data, keyed by node uuid and preview
+        # scale, so switching back to a viewed scale is instant. The dialog is
+        # modal: nothing can edit the layers until Refresh Preview Now clears it
+        self.preview_cache = LRUCache(PREVIEW_CACHE_BYTES, size_of=lambda entry: len(entry[0]))
+
+        # Background preview rendering: only the newest generation is painted
+        self.preview_generation = 0
+        self.pending_refine_generation = None
+        # Stage timings of the preview being rendered (coarse and refine pass)
+        self.preview_profile = NO_PROFILE
+        self.preview_pool = QThreadPool(self)
+        self.preview_pool.setMaxThreadCount(1)
 
         # Settings persistence
         self.settings = QSettings("Krita", "DisplaceMapFilter")
@@ -33,6 +56,15 @@ class DisplaceDialog(QDialog):
         self.preview_scale = 0.25
         self.preview_enabled = False
 
+        # Detail view: canvas point at the middle of the preview (None: canvas
+        # center), the canvas rectangle and zoom of the job being rendered, and
+        # (rectangle, pixmap width, pixmap height) of the image on screen
+        self.view_center = None
+        self.job_view = (None, 0)
+        self.shown_view = None
+        # (press position, view center at the press) while the detail view is dragged
+        self.drag_origin = None
+
         # Main horizontal layout: Preview | Settings
         main_layout = QHBoxLayout(self)
 
@@ -56,15 +88,24 @@ class DisplaceDialog(QDialog):
         # Manual update button
         self.manual_update_btn = QPushButton("Refresh Preview Now")
         self.manual_update_btn.setEnabled(False)
-        self.manual_update_btn.clicked.connect(lambda: self.schedule_preview_update(immediate=True))
+        self.manual_update_btn.clicked.connect(self.refresh_preview)
         preview_layout.addWidget(self.manual_update_btn)
 
         self.preview_label = QLabel()
         self.preview_label.setFixedSize(400, 400)
         self.preview_label.setAlignment(Qt.AlignCenter)
         self.preview_label.setText("Preview disabled.\nEnable checkbox above to see preview.")
+        self.preview_label.setToolTip("Double-click to zoom in there; drag to pan a zoomed preview.")
+        self.preview_label.installEventFilter(self)
         preview_layout.addWidget(self.preview_label)
 
+        # Stage timings of the last preview, when recording is enabled
+        self.profile_label = QLabel()
+        self.profile_label.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.profile_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.profile_label.setVisible(False)
+        preview_layout.addWidget(self.profile_label)
+
         # preview scale slider (5% .. 100%)
         slider_layout = QHBoxLayout()
         slider_layout.addWidget(QLabel("Scale:"))
@@ -85,6 +126,16 @@ class DisplaceDialog(QDialog):
             buttons_layout.addWidget(btn)
         preview_layout.addLayout(buttons_layout)
 
+        # Zoomed in, only the visible part of the canvas is displaced, at full resolution
+        zoom_layout = QHBoxLayout()
+        zoom_layout.addWidget(QLabel("Zoom:"))
+        self.zoom_combo = QComboBox()
+        for text, zoom in PREVIEW_ZOOMS:
+            self.zoom_combo.addItem(text, zoom)
+        self.zoom_combo.currentIndexChanged.connect(self.on_zoom_changed)
+        zoom_layout.addWidget(self.zoom_combo)
+        preview_layout.addLayout(zoom_layout)
+
         preview_group.setLayout(preview_layout)
         preview_container.addWidget(preview_group)
         preview_container.addStretch()
@@ -109,6 +160,35 @@ class DisplaceDialog(QDialog):
         layer_group.setLayout(layer_layout)
         settings_container.addWidget(layer_group)
 
+        # --- Batch targets: several layers, or the keyframes of the active one ---
+        if batch:
+            batch_group = QGroupBox("Batch Targets")
+            batch_layout = QVBoxLayout()
+
+            self.targets_list = QListWidget()
+            batch_layout.addWidget(self.targets_list)
+
+            self.frames_check = QCheckBox("Animation frames of the active layer")
+            self.frames_check.stateChanged.connect(self.on_frames_mode_changed)
+            batch_layout.addWidget(self.frames_check)
+
+            frames_layout = QHBoxLayout()
+            frames_layout.addWidget(QLabel("From:"))
+            self.frame_start_spin = QSpinBox()
+            self.frame_start_spin.setRange(0, 100000)
+            frames_layout.addWidget(self.frame_start_spin)
+            frames_layout.addWidget(QLabel("To:"))
+            self.frame_end_spin = QSpinBox()
+            self.frame_end_spin.setRange(0, 100000)
+            frames_layout.addWidget(self.frame_end_spin)
+            batch_layout.addLayout(frames_layout)
+
+            batch_group.setLayout(batch_layout)
+            settings_container.addWidget(batch_group)
+
+            self.populate_targets()
+            self.on_frames_mode_changed()
+
         # --- Settings ---
         settings_group = QGroupBox("Displacement Settings")
         settings_layout = QVBoxLayout()
@@ -134,11 +214,38 @@ class DisplaceDialog(QDialog):
         dir_layout = QHBoxLayout()
         dir_layout.addWidget(QLabel("Direction:"))
         self.direction_combo = QComboBox()
-        self.direction_combo.addItems(["Horizontal", "Vertical", "Both"])
+        self.direction_combo.addItems(["Horizontal", "Vertical", "Both", "Vector (X/Y Channels)"])
+        self.direction_combo.currentIndexChanged.connect(self.on_direction_changed)
         self.direction_combo.currentIndexChanged.connect(self.schedule_preview_update)
         dir_layout.addWidget(self.direction_combo)
         settings_layout.addLayout(dir_layout)
 
+        # Vector: Strength and Channel above move X, these move Y
+        self.vector_group = QGroupBox("Vertical (Y) Offsets")
+        vector_layout = QVBoxLayout()
+
+        sy_layout = QHBoxLayout()
+        sy_layout.addWidget(QLabel("Y Strength:"))
+        self.strength_y_spin = QDoubleSpinBox()
+        self.strength_y_spin.setRange(0.0, 5000.0)
+        self.strength_y_spin.setValue(100.0)
+        self.strength_y_spin.setSingleStep(1.0)
+        self.strength_y_spin.valueChanged.connect(self.schedule_preview_update)
+        sy_layout.addWidget(self.strength_y_spin)
+        vector_layout.addLayout(sy_layout)
+
+        chy_layout = QHBoxLayout()
+        chy_layout.addWidget(QLabel("Y Channel:"))
+        self.channel_y_combo = QComboBox()
+        self.channel_y_combo.addItems(["Red", "Green", "Blue", "Luminosity"])
+        self.channel_y_combo.setCurrentIndex(1)
+        self.channel_y_combo.currentIndexChanged.connect(self.schedule_preview_update)
+        chy_layout.addWidget(self.channel_y_combo)
+        vector_layout.addLayout(chy_layout)
+
+        self.vector_group.setLayout(vector_layout)
+        settings_layout.addWidget(self.vector_group)
+
         wrap_layout = QHBoxLayout()
         wrap_layout.addWidget(QLabel("Edge Handling:"))
         self.wrap_combo = QComboBox()
@@ -147,6 +254,14 @@ class DisplaceDialog(QDialog):
         wrap_layout.addWidget(self.wrap_combo)
         settings_layout.addLayout(wrap_layout)
 
+        interp_layout = QHBoxLayout()
+        interp_layout.addWidget(QLabel("Interpolation:"))
+        self.interpolation_combo = QComboBox()
+        self.interpolation_combo.addItems(["Nearest", "Bilinear", "Bicubic"])
+        self.interpolation_combo.currentIndexChanged.connect(self.schedule_preview_update)
+        interp_layout.addWidget(self.interpolation_combo)
+        settings_layout.addLayout(interp_layout)
+
         settings_group.setLayout(settings_layout)
         settings_container.addWidget(settings_group)
 
@@ -173,6 +288,56 @@ class DisplaceDialog(QDialog):
         scale_layout.addWidget(self.scale_spin)
         advanced_layout.addLayout(scale_layout)
 
+        # Caps peak memory of the full-resolution apply (processed in strips)
+        budget_layout = QHBoxLayout()
+        budget_layout.addWidget(QLabel("Memory Budget (MB):"))
+        self.budget_spin = QSpinBox()
+        self.budget_spin.setRange(64, 65536)
+        self.budget_spin.setValue(1024)
+        self.budget_spin.setSingleStep(64)
+        budget_layout.addWidget(self.budget_spin)
+        advanced_layout.addLayout(budget_layout)
+
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(QLabel("Worker Threads:"))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, 64)
+        self.workers_spin.setValue(os.cpu_count() or 1)
+        workers_layout.addWidget(self.workers_spin)
+        advanced_layout.addLayout(workers_layout)
+
+        # Out-of-core apply: huge canvases are staged in memory-mapped temporary files
+        scratch_layout = QHBoxLayout()
+        scratch_layout.addWidget(QLabel("Scratch Files Above (MP):"))
+        self.scratch_spin = QSpinBox()
+        self.scratch_spin.setRange(0, 100000)
+        self.scratch_spin.setValue(256)
+        self.scratch_spin.setSingleStep(64)
+        self.scratch_spin.setSpecialValueText("Never")
+        scratch_layout.addWidget(self.scratch_spin)
+        advanced_layout.addLayout(scratch_layout)
+
+        scratch_dir_layout = QHBoxLayout()
+        scratch_dir_layout.addWidget(QLabel("Scratch Folder:"))
+        self.scratch_edit = QLineEdit()
+        self.scratch_edit.setPlaceholderText("system temp folder")
+        scratch_dir_layout.addWidget(self.scratch_edit)
+        advanced_layout.addLayout(scratch_dir_layout)
+
+        # Diagnostics: per-stage wall time (and peak allocation) of previews and applies
+        self.profile_check = QCheckBox("Record stage timings")
+        advanced_layout.addWidget(self.profile_check)
+
+        self.profile_memory_check = QCheckBox("Include peak memory (slower)")
+        advanced_layout.addWidget(self.profile_memory_check)
+
+        trace_layout = QHBoxLayout()
+        trace_layout.addWidget(QLabel("JSON Trace File:"))
+        self.trace_edit = QLineEdit()
+        self.trace_edit.setPlaceholderText("optional, one JSON line per run")
+        trace_layout.addWidget(self.trace_edit)
+        advanced_layout.addLayout(trace_layout)
+
         advanced_group.setLayout(advanced_layout)
         settings_container.addWidget(advanced_group)
 
@@ -192,6 +357,10 @@ class DisplaceDialog(QDialog):
         self.create_above_check.setChecked(True)
         output_layout.addWidget(self.create_above_check)
 
+        # Re-displaces edited tiles while the document stays open
+        self.live_check = QCheckBox("Keep linked (update when source or map changes)")
+        output_layout.addWidget(self.live_check)
+
         output_group.setLayout(output_layout)
         settings_container.addWidget(output_group)
 
@@ -224,13 +393,22 @@ class DisplaceDialog(QDialog):
         self.strength_spin.setValue(self.settings.value("strength", 100.0, type=float))
         self.channel_combo.setCurrentIndex(self.settings.value("channel", 0, type=int))
         self.direction_combo.setCurrentIndex(self.settings.value("direction", 0, type=int))
+        self.strength_y_spin.setValue(self.settings.value("strength_y", 100.0, type=float))
+        self.channel_y_combo.setCurrentIndex(self.settings.value("channel_y", 1, type=int))
+        self.on_direction_changed()
         self.wrap_combo.setCurrentIndex(self.settings.value("wrap_mode", 0, type=int))
+        self.interpolation_combo.setCurrentIndex(self.settings.value("interpolation", 0, type=int))
         self.invert_check.setChecked(self.settings.value("invert", False, type=bool))
         self.center_check.setChecked(self.settings.value("center", True, type=bool))
         self.auto_update_check.setChecked(self.settings.value("auto_update", True, type=bool))
         self.scale_spin.setValue(self.settings.value("scale", 1.0, type=float))
+        self.budget_spin.setValue(self.settings.value("memory_budget_mb", 1024, type=int))
+        self.workers_spin.setValue(self.settings.value("workers", os.cpu_count() or 1, type=int))
+        self.scratch_spin.setValue(self.settings.value("scratch_threshold_mp", 256, type=int))
+        self.scratch_edit.setText(self.settings.value("scratch_dir", "", type=str))
         self.preview_scale = self.settings.value("preview_scale", 0.25, type=float)
         self.scale_slider.setValue(int(self.preview_scale * 100))
+        self.zoom_combo.setCurrentIndex(self.settings.value("preview_zoom", 0, type=int))
         self.preview_enabled = self.settings.value("preview_enabled", False, type=bool)
         self.preview_enable_check.setChecked(self.preview_enabled)
 
@@ -242,59 +420,106 @@ class DisplaceDialog(QDialog):
             self.name_edit.setEditText(layer_name)
 
         self.create_above_check.setChecked(self.settings.value("create_above", True, type=bool))
+        self.live_check.setChecked(self.settings.value("live", False, type=bool))
+        self.profile_check.setChecked(self.settings.value("profile", False, type=bool))
+        self.profile_memory_check.setChecked(self.settings.value("profile_memory", False, type=bool))
+        self.trace_edit.setText(self.settings.value("trace_path", "", type=str))
 
     def save_settings(self):
         """Save current settings for next time."""
         self.settings.setValue("strength", self.strength_spin.value())
         self.settings.setValue("channel", self.channel_combo.currentIndex())
         self.settings.setValue("direction", self.direction_combo.currentIndex())
+        self.settings.setValue("strength_y", self.strength_y_spin.value())
+        self.settings.setValue("channel_y", self.channel_y_combo.currentIndex())
         self.settings.setValue("wrap_mode", self.wrap_combo.currentIndex())
+        self.settings.setValue("interpolation", self.interpolation_combo.currentIndex())
         self.settings.setValue("invert", self.invert_check.isChecked())
         self.settings.setValue("center", self.center_check.isChecked())
         self.settings.setValue("auto_update", self.auto_update_check.isChecked())
         self.settings.setValue("scale", self.scale_spin.value())
+        self.settings.setValue("memory_budget_mb", self.budget_spin.value())
+        self.settings.setValue("workers", self.workers_spin.value())
+        self.settings.setValue("scratch_threshold_mp", self.scratch_spin.value())
+        self.settings.setValue("scratch_dir", self.scratch_edit.text())
         self.settings.setValue("preview_scale", self.preview_scale)
+        self.settings.setValue("preview_zoom", self.zoom_combo.currentIndex())
         self.settings.setValue("preview_enabled", self.preview_enabled)
         self.settings.setValue("layer_name", self.name_edit.currentText())
         self.settings.setValue("create_above", self.create_above_check.isChecked())
+        self.settings.setValue("live", self.live_check.isChecked())
+        self.settings.setValue("profile", self.profile_check.isChecked())
+        self.settings.setValue("profile_memory", self.profile_memory_check.isChecked())
+        self.settings.setValue("trace_path", self.trace_edit.text())
 
     def accept(self):
         self.save_settings()
+        self.cancel_preview()
         super().accept()
 
     def reject(self):
         self.save_settings()
+        self.cancel_preview()
         super().reject()
 
     # -------------------- Helpers and Layer Logic --------------------
 
     def on_layer_changed(self):
-        """Handle layer change: invalidate scaled cache and schedule update."""
-        self.cached_src_scaled_data = None
-        self.cached_disp_scaled_data = None
-        self.cached_preview_scale = 0.0
+        """Handle layer change: cached data is keyed per layer, so just refresh."""
         self.schedule_preview_update(immediate=True)
 
     def populate_layers(self):
+        """Lists paint layers by uuid, keeping the current choice when it still exists."""
+        current = self.layer_combo.currentData()
+        self.layer_combo.blockSignals(True)
         self.layer_combo.clear()
         doc = Krita.instance().activeDocument()
+        if doc:
+            self.doc = doc
+            self.registry.rebuild(doc.rootNode())
+            for uid, label in self.registry.paint_layers():
+                self.layer_combo.addItem(label, uid)
+            index = self.layer_combo.findData(current)
+            if index >= 0:
+                self.layer_combo.setCurrentIndex(index)
+        self.layer_combo.blockSignals(False)
+
+        if doc:
+            self.on_layer_changed()
+
+    def populate_targets(self):
+        """Lists every paint layer as a checkable batch target; the active layer starts checked."""
+        self.targets_list.clear()
+        doc = Krita.instance().activeDocument()
         if not doc:
             return
-        self.doc = doc
-        layers = self.collect_layers(doc.rootNode())
-        for name in layers:
-            self.layer_combo.addItem(name)
-
-        self.on_layer_changed()
-
-    def collect_layers(self, node, out=None):
-        if out is None:
-            out = []
-        if node.type() == 'paintlayer':
-            out.append(node.name())
-        for c in node.childNodes():
-            self.collect_layers(c, out)
-        return out
+        active = doc.activeNode()
+        active_uid = node_uuid(active) if active else None
+        for uid, label in self.registry.paint_layers():
+            item = QListWidgetItem(label)
+            item.setData(Qt.UserRole, uid)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if uid == active_uid else Qt.Unchecked)
+            self.targets_list.addItem(item)
+
+        self.frame_start_spin.setValue(doc.fullClipRangeStartTime())
+        self.frame_end_spin.setValue(doc.fullClipRangeEndTime())
+
+    def on_direction_changed(self):
+        """The Y strength and channel only apply to the Vector direction."""
+        self.vector_group.setVisible(self.direction_combo.currentIndex() == displace_core.VECTOR)
+
+    def on_frames_mode_changed(self):
+        """Frame mode works on the active layer alone, so the layer list is disabled meanwhile."""
+        frames = self.frames_check.isChecked()
+        self.targets_list.setEnabled(not frames)
+        self.frame_start_spin.setEnabled(frames)
+        self.frame_end_spin.setEnabled(frames)
+
+    def checked_targets(self):
+        """Uuids of the checked batch targets."""
+        items = (self.targets_list.item(i) for i in range(self.targets_list.count()))
+        return [item.data(Qt.UserRole) for item in items if item.checkState() == Qt.Checked]
 
     def on_preview_enable_changed(self, state):
         """Handle preview enable/disable."""
@@ -307,15 +532,16 @@ class DisplaceDialog(QDialog):
         else:
             self.preview_label.setText("Preview disabled.\nEnable checkbox above to see preview.")
             self.preview_timer.stop()
+            self.preview_generation += 1
 
     def on_preview_scale_changed(self, v):
         self.preview_scale = max(0.01, v / 100.0)
         self.scale_label.setText(f"{v}%")
 
-        self.cached_src_scaled_data = None
-        self.cached_disp_scaled_data = None
-        self.cached_preview_scale = 0.0
-
+        # The scale is that of the whole-canvas view: picking one leaves the detail view
+        if self.preview_zoom():
+            self.zoom_combo.setCurrentIndex(0)
+            return
         if self.preview_enabled:
             self.schedule_preview_update(immediate=True)
 
@@ -323,6 +549,97 @@ class DisplaceDialog(QDialog):
         """Set preview scale from button click"""
         self.scale_slider.setValue(scale_pct)
 
+    def preview_zoom(self):
+        """Zoom of the detail view, or 0 when the preview fits the whole canvas."""
+        return self.zoom_combo.currentData() or 0
+
+    def on_zoom_changed(self):
+        self.preview_label.setCursor(Qt.OpenHandCursor if self.preview_zoom() else Qt.ArrowCursor)
+        if self.preview_enabled:
+            self.schedule_preview_update(immediate=True)
+
+    def view_region(self, w, h, zoom):
+        """
+        Canvas rectangle the detail view shows at this zoom. view_center is
+        pulled back inside the canvas with it, so dragging away from an edge
+        moves the view at once.
+        """
+        if self.view_center is None:
+            self.view_center = (w / 2, h / 2)
+        region = displace_core.zoom_region(w, h, self.view_center, zoom,
+                                           self.preview_label.width(), self.preview_label.height())
+        self.view_center = (region[0] + region[2] / 2, region[1] + region[3] / 2)
+        return region
+
+    def canvas_point(self, pos):
+        """Canvas coordinates under a point of the preview label, or None when no image is shown."""
+        # After an error the label holds text rather than the last image
+        pixmap = self.preview_label.pixmap()
+        if self.shown_view is None or pixmap is None or pixmap.isNull():
+            return None
+        region, pixmap_w, pixmap_h = self.shown_view
+        if region is None:
+            doc = Krita.instance().activeDocument()
+            if not doc:
+                return None
+            region = (0, 0, doc.width(), doc.height())
+        # The label centers its pixmap
+        left = (self.preview_label.width() - pixmap_w) / 2
+        top = (self.preview_label.height() - pixmap_h) / 2
+        return (region[0] + (pos.x() - left) * region[2] / pixmap_w,
+                region[1] + (pos.y() - top) * region[3] / pixmap_h)
+
+    def eventFilter(self, obj, event):
+        """Double-click zooms the preview in at that point; dragging pans the detail view."""
+        if obj is not self.preview_label or not self.preview_enabled:
+            return super().eventFilter(obj, event)
+
+        kind = event.type()
+        zoom = self.preview_zoom()
+        if kind == QEvent.MouseButtonDblClick and event.button() == Qt.LeftButton:
+            point = self.canvas_point(event.pos())
+            if point is not None:
+                self.view_center = point
+                if zoom:
+                    self.schedule_view_update()
+                else:
+                    self.zoom_combo.setCurrentIndex(1)
+            return True
+        if (kind == QEvent.MouseButtonPress and event.button() == Qt.LeftButton and zoom
+                and self.view_center is not None):
+            self.drag_origin = (event.pos(), self.view_center)
+            self.preview_label.setCursor(Qt.ClosedHandCursor)
+            return True
+        if kind == QEvent.MouseMove and self.drag_origin is not None and zoom:
+            start, (cx, cy) = self.drag_origin
+            delta = event.pos() - start
+            self.view_center = (cx - delta.x() / zoom, cy - delta.y() / zoom)
+            self.schedule_view_update()
+            return True
+        if kind == QEvent.MouseButtonRelease and self.drag_origin is not None:
+            self.drag_origin = None
+            self.preview_label.setCursor(Qt.OpenHandCursor if zoom else Qt.ArrowCursor)
+            return True
+        return super().eventFilter(obj, event)
+
+    def schedule_view_update(self):
+        """
+        Re-renders after the detail view moved. Panning is not a settings
+        change, so it does not wait for auto-update; while dragging, at most
+        one render is queued.
+        """
+        if self.preview_enabled and not self.preview_timer.isActive():
+            self.preview_timer.start(50)
+
+    def refresh_preview(self):
+        """
+        Re-reads the layers and renders. The dialog is modal, so layers cannot
+        be painted while it is open: preview data is cached per layer and
+        scale and only dropped here.
+        """
+        self.preview_cache.clear()
+        self.schedule_preview_update(immediate=True)
+
     def schedule_preview_update(self, immediate=False):
         if not self.preview_enabled:
             return
@@ -346,167 +663,132 @@ class DisplaceDialog(QDialog):
 
     # -------------------- Data Loading (Memory Optimized) --------------------
 
-    def get_scaled_preview_data(self):
+    def get_scaled_preview_data(self, scale=None):
         """
-        Loads data in native color depth, converts to 8-bit RGB for preview,
-        then scales using QImage.scaled().
+        Returns the active layer and the displacement layer as 8-bit BGRA
+        buffers at the given scale (the current preview scale by default),
+        loading them on cache misses.
         """
-
-        # Check if cache is valid
-        if (self.cached_src_scaled_data and
-            self.cached_preview_scale == self.preview_scale and
-            self.cached_w > 0):
-            return self.cached_src_scaled_data, self.cached_disp_scaled_data, self.cached_w, self.cached_h
-
         doc = Krita.instance().activeDocument()
         if not doc:
             raise RuntimeError("No active document")
 
         node = doc.activeNode()
-        disp_layer_name = self.layer_combo.currentText()
-        disp_node = self.find_layer_by_name(doc.rootNode(), disp_layer_name)
+        disp_node = self.registry.node(self.layer_combo.currentData())
 
         if not node or not disp_node:
-             raise RuntimeError(f"Active layer or displacement layer '{disp_layer_name}' not found.")
-
-        w_orig, h_orig = doc.width(), doc.height()
-
-        # Определяем глубину цвета документа
-        color_depth = doc.colorDepth()
-
-        # Получаем данные в нативной глубине цвета
-        src_raw = node.projectionPixelData(0, 0, w_orig, h_orig)
-        disp_raw = disp_node.projectionPixelData(0, 0, w_orig, h_orig)
-
-        if not src_raw or not disp_raw:
-             raise RuntimeError("Cannot read projection pixel data.")
-
-        # Конвертируем в 8-bit RGBA для превью
-        src_u8 = self.convert_to_u8_rgba(src_raw, w_orig, h_orig, color_depth)
-        disp_u8 = self.convert_to_u8_rgba(disp_raw, w_orig, h_orig, color_depth)
+             raise RuntimeError(f"Active layer or displacement layer '{self.layer_combo.currentText()}' not found.")
 
-        # Создание полноразмерных QImage
-        src_qimage_full = QImage(src_u8, w_orig, h_orig, w_orig * 4, QImage.Format_ARGB32)
-        disp_qimage_full = QImage(disp_u8, w_orig, h_orig, w_orig * 4, QImage.Format_ARGB32)
+        if scale is None:
+            scale = self.preview_scale
+        src_data, pw, ph = self.get_scaled_node_data(doc, node, scale)
+        disp_data, _, _ = self.get_scaled_node_data(doc, disp_node, scale)
+        return src_data, disp_data, pw, ph
 
-        # Освобождение памяти
-        del src_raw
-        del disp_raw
-        del src_u8
-        del disp_u8
-
-        # Масштабирование
-        pw = max(1, int(w_orig * self.preview_scale))
-        ph = max(1, int(h_orig * self.preview_scale))
-
-        src_scaled = src_qimage_full.scaled(pw, ph, Qt.IgnoreAspectRatio, Qt.FastTransformation)
-        disp_scaled = disp_qimage_full.scaled(pw, ph, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+    def get_native_preview_data(self):
+        """
+        Whole active and displacement layers in native depth, for a 100%
+        preview whose full-resolution result Apply can reuse. Both come from
+        the LRU cache when unchanged (see get_native_node_data). Returns
+        (source, map, width, height, (result key, source format, map format)).
+        """
+        doc = Krita.instance().activeDocument()
+        if not doc:
+            raise RuntimeError("No active document")
 
-        del src_qimage_full
-        del disp_qimage_full
+        node = doc.activeNode()
+        disp_node = self.registry.node(self.layer_combo.currentData())
+        if not node or not disp_node:
+             raise RuntimeError(f"Active layer or displacement layer '{self.layer_combo.currentText()}' not found.")
 
-        # Кэширование
-        src_bits = src_scaled.constBits()
-        disp_bits = disp_scaled.constBits()
+        w, h = doc.width(), doc.height()
+        with self.preview_profile.stage("pixelData"):
+            fmt = displace_core.layer_format(node, w)
+            map_fmt = displace_core.layer_format(disp_node, w)
+        src_data = self.get_native_node_data(doc, node)
+        disp_data = self.get_native_node_data(doc, disp_node)
 
-        src_bits.setsize(pw * ph * 4)
-        disp_bits.setsize(pw * ph * 4)
+        key = displace_core.result_key(node, disp_node, w, h, fmt, self.get_settings(), map_fmt)
+        return src_data, disp_data, w, h, (key, fmt, map_fmt)
 
-        self.cached_src_scaled_data = bytearray(src_bits)
-        self.cached_disp_scaled_data = bytearray(disp_bits)
-        self.cached_preview_scale = self.preview_scale
-        self.cached_w = pw
-        self.cached_h = ph
+    def get_native_node_data(self, doc, node):
+        """
+        Reads a whole node in its native pixel format. Kept in the LRU cache
+        under scale 1.0, so changing settings at 100% reuses the pixels
+        instead of reading the layer again on every render.
+        """
+        w, h = doc.width(), doc.height()
+        key = (node_uuid(node), 1.0)
+        cached = self.preview_cache.get(key)
+        if cached is not None:
+            return cached[0]
+
+        with self.preview_profile.stage("pixelData"):
+            data = node.pixelData(0, 0, w, h)
+        if not data:
+            raise RuntimeError("Cannot read pixel data from one of the layers.")
+        data = bytes(data)
+        self.preview_cache.put(key, (data, w, h))
+        return data
+
+    def get_region_preview_data(self, zoom):
+        """
+        Reads what the detail view at this zoom needs, in native depth: the
+        visible canvas rectangle of the displacement layer, and of the active
+        layer that rectangle padded by the maximum displacement. Returns
+        (source, map, canvas width, canvas height,
+        (rectangle, source window, source format, map format)).
+        """
+        doc = Krita.instance().activeDocument()
+        if not doc:
+            raise RuntimeError("No active document")
 
-        return self.cached_src_scaled_data, self.cached_disp_scaled_data, pw, ph
+        node = doc.activeNode()
+        disp_node = self.registry.node(self.layer_combo.currentData())
+        if not node or not disp_node:
+             raise RuntimeError(f"Active layer or displacement layer '{self.layer_combo.currentText()}' not found.")
+
+        w, h = doc.width(), doc.height()
+        region = self.view_region(w, h, zoom)
+        with self.preview_profile.stage("pixelData"):
+            fmt = displace_core.layer_format(node, w)
+            map_fmt = displace_core.layer_format(disp_node, w)
+            src_data, disp_data, window = displace_core.region_inputs(
+                node.pixelData, disp_node.pixelData, w, h, region, self.get_settings())
+        return src_data, disp_data, w, h, (region, window, fmt, map_fmt)
+
+    def is_preview_cached(self, scale):
+        """True when both preview layers are already cached at this scale (native data at 100%)."""
+        doc = Krita.instance().activeDocument()
+        if not doc:
+            return False
+        node = doc.activeNode()
+        disp_node = self.registry.node(self.layer_combo.currentData())
+        if not node or not disp_node:
+            return False
+        return all((node_uuid(n), scale) in self.preview_cache for n in (node, disp_node))
 
-    def convert_to_u8_rgba(self, raw_data, width, height, color_depth):
+    def get_scaled_node_data(self, doc, node, scale):
         """
-        Конвертирует пиксельные данные из различных форматов в 8-bit RGBA.
-        Применяет линейно-sRGB конверсию для корректного отображения.
+        Loads one node decimated to preview size in its native pixel format and
+        converts only the reduced pixels to 8-bit BGRA. Results are kept in
+        the LRU cache.
         """
-        pixel_count = width * height
-
-        if color_depth == "U8":
-            # Уже в 8-bit формате, просто возвращаем
-            # Примечание: предполагаем, что U8 данные уже в sRGB.
-            return raw_data
-
-        elif color_depth == "U16":
-            # 16-bit на канал: конвертируем в 8-bit с sRGB коррекцией
-            result = bytearray(pixel_count * 4)
-            MAX_U16 = 65535.0
-
-            for i in range(pixel_count):
-                # Krita хранит в формате BGRA
-                offset = i * 8  # 4 канала * 2 байта
-
-                # Читаем 16-bit значения (little-endian)
-                b_u16 = struct.unpack_from('<H', raw_data, offset)[0]
-                g_u16 = struct.unpack_from('<H', raw_data, offset + 2)[0]
-                r_u16 = struct.unpack_from('<H', raw_data, offset + 4)[0]
-                a_u16 = struct.unpack_from('<H', raw_data, offset + 6)[0]
-
-                # Нормализуем в 0.0-1.0 (линейное пространство)
-                r_linear = r_u16 / MAX_U16
-                g_linear = g_u16 / MAX_U16
-                b_linear = b_u16 / MAX_U16
-                a_linear = a_u16 / MAX_U16
-
-                # Применяем линейно-sRGB конверсию для RGB каналов
-                result[i*4] = self._linear_to_srgb_u8(b_linear)      # B
-                result[i*4+1] = self._linear_to_srgb_u8(g_linear)    # G
-                result[i*4+2] = self._linear_to_srgb_u8(r_linear)    # R
-                # Альфа-канал остается линейным, просто масштабируем до 8-бит
-                result[i*4+3] = max(0, min(255, int(a_linear * 255 + 0.5)))    # A
-
-            return bytes(result)
-
-        elif color_depth == "F16" or color_depth == "F32":
-            # (Оставляем ваш код для float, он уже использует _linear_to_srgb_u8)
-            # ... (ваш существующий код для F16/F32) ...
-            # Ваш код для F16/F32 выглядит корректно
-            bytes_per_channel = 2 if color_depth == "F16" else 4
-            format_char = 'e' if color_depth == "F16" else 'f'
-
-            result = bytearray(pixel_count * 4)
-            for i in range(pixel_count):
-                offset = i * 4 * bytes_per_channel
-
-                # Читаем float значения (линейное пространство)
-                b = struct.unpack_from('<' + format_char, raw_data, offset)[0]
-                g = struct.unpack_from('<' + format_char, raw_data, offset + bytes_per_channel)[0]
-                r = struct.unpack_from('<' + format_char, raw_data, offset + bytes_per_channel * 2)[0]
-                a = struct.unpack_from('<' + format_char, raw_data, offset + bytes_per_channel * 3)[0]
-
-                # Применяем линейно-sRGB конверсию для RGB каналов
-                result[i*4] = self._linear_to_srgb_u8(b)      # B
-                result[i*4+1] = self._linear_to_srgb_u8(g)    # G
-                result[i*4+2] = self._linear_to_srgb_u8(r)    # R
-                # Альфа остается линейной
-                result[i*4+3] = max(0, min(255, int(a * 255 + 0.5)))    # A
-
-            return bytes(result)
+        key = (node_uuid(node), scale)
+        cached = self.preview_cache.get(key)
+        if cached is not None:
+            return cached
 
-        else:
-            # Неизвестный формат - пробуем как 8-bit
-            print(f"Warning: Unknown color depth '{color_depth}', treating as U8")
-            return raw_data
-
-    @staticmethod
-    def _linear_to_srgb_u8(linear_val):
-        """Конвертирует линейное значение (0.0-1.0) в sRGB u8 (0-255)"""
-        # Клампим значение
-        linear_val = max(0.0, min(1.0, linear_val))
-
-        # Применяем sRGB гамма-коррекцию
-        if linear_val <= 0.0031308:
-            srgb = 12.92 * linear_val
-        else:
-            srgb = 1.055 * math.pow(linear_val, 1.0 / 2.4) - 0.055
+        w_orig, h_orig = doc.width(), doc.height()
+        pw, ph = displace_core.preview_size(w_orig, h_orig, scale)
 
-        # Конвертируем в 8-bit
-        return max(0, min(255, int(srgb * 255 + 0.5)))
+        # Прореживаем в нативном формате, конвертируем только то, что осталось
+        data_u8 = displace_core.load_preview_buffer(node, w_orig, h_orig, displace_core.node_format(node), pw, ph,
+                                                    profile=self.preview_profile)
+
+        entry = (bytes(data_u8), pw, ph)
+        self.preview_cache.put(key, entry)
+        return entry
 
     def render_preview(self):
         if not self.preview_enabled:
@@ -514,108 +796,162 @@ class DisplaceDialog(QDialog):
 
         self.last_preview_time = time.time() * 1000
 
+        # One profile covers the coarse and the refine pass of this render
+        self.preview_profile.finish()
+        self.preview_profile = profile_for("preview", self.get_settings()).start()
+
+        # Progressive mode: when the requested scale still has to be loaded,
+        # show a coarse pass first and refine once it is on screen. The detail
+        # view only displaces what is visible and needs no coarse pass.
+        scale = self.preview_scale
+        coarse = (not self.preview_zoom() and scale > PROGRESSIVE_SCALE
+                  and not self.is_preview_cached(scale))
+        if coarse:
+            scale = PROGRESSIVE_SCALE
+
+        # Starting a new generation makes any job still running stop early
+        self.preview_generation += 1
+        self.pending_refine_generation = self.preview_generation if coarse else None
+        self.start_preview_job(self.preview_generation, scale)
+
+    def start_preview_job(self, generation, scale):
+        native = region = None
+        zoom = self.preview_zoom()
         try:
-            src_data, disp_data, pw, ph = self.get_scaled_preview_data()
+            if zoom:
+                src_data, disp_data, pw, ph, region = self.get_region_preview_data(zoom)
+            elif scale >= 1.0:
+                src_data, disp_data, pw, ph, native = self.get_native_preview_data()
+            else:
+                src_data, disp_data, pw, ph = self.get_scaled_preview_data(scale)
         except Exception as e:
+            self.pending_refine_generation = None
+            self.preview_profile.finish()
             self.preview_label.setText(f"Preview error: {str(e)}")
             print("Preview load error:", e)
             return
 
         if not src_data or not disp_data:
+            # Nothing to show: a refine queued by the coarse pass must not paint over the cleared label
+            self.pending_refine_generation = None
+            self.preview_profile.finish()
             self.preview_label.clear()
             return
 
-        settings = self.get_settings()
-        strength = settings['strength'] * settings['scale'] * self.preview_scale
-        channel_idx = settings['channel']
-        direction = settings['direction']
-        wrap_mode = settings['wrap_mode']
-        center = settings['center']
-        invert = settings['invert']
-        MAX_VAL = 255.0
-
-        if center:
-            NORM_CENTER_MULT = 2.0 / MAX_VAL
-            NORM_CENTER_OFFSET = 1.0
-        else:
-            NORM_CENTER_MULT = 1.0 / MAX_VAL
-            NORM_CENTER_OFFSET = 0.0
-        INV_SIGN = -1.0 if invert else 1.0
-
-        out_data = bytearray(pw * ph * 4)
-        pw_4 = pw * 4
-
-        for y in range(ph):
-            row_base = y * pw_4
-            for x in range(pw):
-                idx = row_base + x * 4
-
-                b = disp_data[idx]
-                g = disp_data[idx + 1]
-                r = disp_data[idx + 2]
-
-                if channel_idx == 3:
-                    d_val = 0.299 * r + 0.587 * g + 0.114 * b
-                elif channel_idx == 0:
-                    d_val = float(r)
-                elif channel_idx == 1:
-                    d_val = float(g)
-                else:
-                    d_val = float(b)
-
-                dn = (d_val * NORM_CENTER_MULT) - NORM_CENTER_OFFSET if center else d_val * NORM_CENTER_MULT
-                disp_px = dn * INV_SIGN * strength
-
-                if direction == 0:
-                    sx, sy = x + disp_px, y
-                elif direction == 1:
-                    sx, sy = x, y + disp_px
-                else:
-                    sx, sy = x + disp_px, y + disp_px
-
-                sx_i = int(round(sx))
-                sy_i = int(round(sy))
-
-                if wrap_mode == 1:
-                    sx_i %= pw
-                    sy_i %= ph
-                elif wrap_mode == 2:
-                    sx_i = max(0, min(pw - 1, sx_i))
-                    sy_i = max(0, min(ph - 1, sy_i))
+        # Pixel data is read above on the GUI thread (the Krita API is not
+        # thread-safe); only the displacement itself runs in the pool.
+        job = PreviewJob(generation, self.is_current_preview,
+                         src_data, disp_data, pw, ph, self.get_settings(), scale,
+                         profile=self.preview_profile, native=native, region=region)
+        job.signals.finished.connect(self.on_preview_rendered)
+        job.signals.failed.connect(self.on_preview_failed)
+        self.job_view = (region[0] if region is not None else None, zoom)
+        self.preview_pool.start(job)
+
+    def start_refine(self, generation):
+        if self.is_current_preview(generation):
+            self.start_preview_job(generation, self.preview_scale)
+
+    def is_current_preview(self, generation):
+        """Called from the worker thread; reading an int attribute is safe there."""
+        return generation == self.preview_generation and self.preview_enabled
+
+    def on_preview_rendered(self, generation, out_data, pw, ph):
+        if not self.is_current_preview(generation):
+            return
 
-                if 0 <= sx_i < pw and 0 <= sy_i < ph:
-                    src_idx = (sy_i * pw + sx_i) * 4
-                    out_data[idx:idx+4] = src_data[src_idx:src_idx+4]
-                else:
-                    pass
+        with self.preview_profile.stage("paint preview"):
+            # QImage wraps the worker's buffer; fromImage() below makes the only copy
+            out_image = QImage(out_data, pw, ph, pw * 4, QImage.Format_ARGB32)
 
-        out_image = QImage(bytes(out_data), pw, ph, pw * 4, QImage.Format_ARGB32)
+            region, zoom = self.job_view
+            if zoom:
+                # Canvas pixels enlarged without smoothing, so each one stays visible
+                pixmap = QPixmap.fromImage(out_image).scaled(
+                    pw * zoom, ph * zoom, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+            else:
+                pixmap = QPixmap.fromImage(out_image).scaled(
+                    self.preview_label.width(), self.preview_label.height(),
+                    Qt.KeepAspectRatio, Qt.SmoothTransformation
+                )
+            self.preview_label.setPixmap(pixmap)
+            self.shown_view = (region, pixmap.width(), pixmap.height())
+
+        # The coarse pass is on screen: load and render the requested scale
+        if generation == self.pending_refine_generation:
+            self.pending_refine_generation = None
+            QTimer.singleShot(0, lambda: self.start_refine(generation))
+        else:
+            self.finish_preview_profile()
+
+    def finish_preview_profile(self):
+        """Shows the timings of the finished render and appends them to the trace file, if set."""
+        profile = self.preview_profile
+        self.preview_profile = NO_PROFILE
+        profile.finish()
+        if profile is NO_PROFILE:
+            self.profile_label.setVisible(False)
+            return
 
-        self.preview_label.setPixmap(QPixmap.fromImage(out_image).scaled(
-            self.preview_label.width(), self.preview_label.height(),
-            Qt.KeepAspectRatio, Qt.SmoothTransformation
-        ))
+        self.profile_label.setText(profile.summary())
+        self.profile_label.setVisible(True)
+        trace_path = self.trace_edit.text().strip()
+        if trace_path:
+            try:
+                profile.write_trace(trace_path)
+            except OSError as e:
+                print("Trace write error:", e)
+
+    def on_preview_failed(self, generation, message):
+        if not self.is_current_preview(generation):
+            return
+        self.pending_refine_generation = None
+        self.preview_profile.finish()
+        self.preview_label.setText(f"Preview error: {message}")
+        print("Preview render error:", message)
+
+    def cancel_preview(self):
+        """Stops any preview job still running and waits for the pool to drain."""
+        self.preview_timer.stop()
+        self.preview_generation += 1
+        self.preview_pool.waitForDone()
+        self.preview_profile.finish()
+        self.preview_profile = NO_PROFILE
 
     # -------------------- Utilities --------------------
     def get_settings(self):
+        # Batch mode: uuids of the layers to displace, or an inclusive frame range for the active layer
+        targets, frames = [], None
+        if self.batch:
+            if self.frames_check.isChecked():
+                first, last = self.frame_start_spin.value(), self.frame_end_spin.value()
+                frames = (min(first, last), max(first, last))
+            else:
+                targets = self.checked_targets()
+
         return {
             'displacement_layer': self.layer_combo.currentText(),
+            'displacement_uuid': self.layer_combo.currentData(),
             'strength': float(self.strength_spin.value()),
             'channel': int(self.channel_combo.currentIndex()),
             'direction': int(self.direction_combo.currentIndex()),
+            'strength_y': float(self.strength_y_spin.value()),
+            'channel_y': int(self.channel_y_combo.currentIndex()),
             'wrap_mode': int(self.wrap_combo.currentIndex()),
+            'interpolation': int(self.interpolation_combo.currentIndex()),
             'invert': bool(self.invert_check.isChecked()),
             'center': bool(self.center_check.isChecked()),
             'scale': float(self.scale_spin.value()),
+            'memory_budget_mb': int(self.budget_spin.value()),
+            'workers': int(self.workers_spin.value()),
+            'scratch_threshold_mp': int(self.scratch_spin.value()),
+            'scratch_dir': self.scratch_edit.text().strip(),
             'layer_name': self.name_edit.currentText(),
-            'create_above': bool(self.create_above_check.isChecked())
+            'create_above': bool(self.create_above_check.isChecked()),
+            'live': bool(self.live_check.isChecked()),
+            'profile': bool(self.profile_check.isChecked()),
+            'profile_memory': bool(self.profile_memory_check.isChecked()),
+            'trace_path': self.trace_edit.text().strip(),
+            'targets': targets,
+            'frames': frames
         }
-
-    def find_layer_by_name(self, node, name):
-        if node.name() == name:
-            return node
-        for c in node.childNodes():
-            r = self.find_layer_by_name(c, name)
-            if r:
-                return r
-        return None
\ No newline at end of file
@@ -0,0 +1,283 @@
+"""
+In-memory stand-ins for the parts of the Krita Document/Node API the plugin
+uses, so displace_core can be driven and timed headless.
+
+Pixel data is stored as rows in the document's color model and depth (BGRA
+for integer RGBA), the same layout Krita returns from pixelData(); every
+layer shares the document's color space. Reads outside the canvas come back as
+transparent pixels and writes outside it are dropped. An animated layer keeps
+one such buffer per keyframe; like in Krita, pixelData() and setPixelData()
+work on the keyframe shown at the document's current time.
+"""
+import itertools
+
+from .pixel_formats import pixel_format
+
+
+_uuid_counter = itertools.count(1)
+
+
+class FakeRect:
+    """The QRect accessors the plugin reads."""
+
+    def __init__(self, x, y, width, height):
+        self._x, self._y, self._width, self._height = x, y, width, height
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+    def isEmpty(self):
+        return self._width <= 0 or self._height <= 0
+
+
+class FakeUuid(str):
+    """A uuid string with QUuid's toString()."""
+
+    def toString(self):
+        return str(self)
+
+
+class FakeSelection(FakeRect):
+    """
+    Selection covering a rectangle. mask, if given, holds one 8-bit value per
+    pixel of the rectangle (255 = selected); otherwise it is fully selected.
+    """
+
+    def __init__(self, x, y, width, height, mask=None):
+        super().__init__(x, y, width, height)
+        self._mask = bytes(mask) if mask is not None else b'\xff' * (width * height)
+
+    def duplicate(self):
+        return FakeSelection(self._x, self._y, self._width, self._height, self._mask)
+
+    def pixelData(self, x, y, w, h):
+        out = bytearray(w * h)
+        for row in range(max(y, self._y), min(y + h, self._y + self._height)):
+            x0, x1 = max(x, self._x), min(x + w, self._x + self._width)
+            if x0 >= x1:
+                continue
+            src = (row - self._y) * self._width + (x0 - self._x)
+            dst = (row - y) * w + (x0 - x)
+            out[dst:dst + x1 - x0] = self._mask[src:src + x1 - x0]
+        return bytes(out)
+
+
+class FakeNode:
+
+    def __init__(self, doc, name, node_type='paintlayer', data=None):
+        self.doc = doc
+        self._name = name
+        self._type = node_type
+        self._uuid = FakeUuid(f"{{00000000-0000-0000-0000-{next(_uuid_counter):012x}}}")
+        self._parent = None
+        self._children = []
+        # Groups only get pixel storage once something is written to them
+        size = doc.width() * doc.height() * doc.pixel_size
+        if data is not None:
+            self._data = bytearray(data)
+            if len(self._data) != size:
+                raise ValueError(f"Expected {size} bytes of pixel data, got {len(self._data)}")
+        else:
+            self._data = bytearray(size) if node_type == 'paintlayer' else None
+        # Keyframe time -> pixel buffer, for animated layers only
+        self._frames = None
+
+    def name(self):
+        return self._name
+
+    def setName(self, name):
+        self._name = name
+
+    def type(self):
+        return self._type
+
+    def uniqueId(self):
+        return self._uuid
+
+    def parentNode(self):
+        return self._parent
+
+    def childNodes(self):
+        return list(self._children)
+
+    def addChildNode(self, child, above):
+        """Inserts child directly above `above`, or at the bottom if above is None."""
+        child._parent = self
+        if above is None:
+            self._children.insert(0, child)
+        else:
+            self._children.insert(self._children.index(above) + 1, child)
+        return True
+
+    def clone(self):
+        node = FakeNode(self.doc, self._name, self._type, self._data)
+        if self._frames is not None:
+            node._frames = {t: bytearray(data) for t, data in self._frames.items()}
+        return node
+
+    def animated(self):
+        return self._frames is not None
+
+    def hasKeyframeAtTime(self, t):
+        return self._frames is not None and t in self._frames
+
+    def add_keyframe(self, t, data=None):
+        """Makes the layer animated and stores a keyframe at time t (transparent by default)."""
+        size = self.doc.width() * self.doc.height() * self.doc.pixel_size
+        frame = bytearray(data) if data is not None else bytearray(size)
+        if len(frame) != size:
+            raise ValueError(f"Expected {size} bytes of pixel data, got {len(frame)}")
+        if self._frames is None:
+            self._frames = {}
+        self._frames[t] = frame
+
+    def _buffer_at(self, t):
+        """Pixel buffer shown at time t: the last keyframe at or before t (the first one before it)."""
+        if self._frames is None:
+            return self._data
+        keys = sorted(self._frames)
+        shown = [k for k in keys if k <= t]
+        return self._frames[shown[-1] if shown else keys[0]]
+
+    def pixelData(self, x, y, w, h):
+        return self.pixelDataAtTime(x, y, w, h, self.doc.currentTime())
+
+    def pixelDataAtTime(self, x, y, w, h, t):
+        ps = self.doc.pixel_size
+        dw, dh = self.doc.width(), self.doc.height()
+        out = bytearray(w * h * ps)
+        x0, x1 = max(0, x), min(dw, x + w)
+        data = self._buffer_at(t)
+        if data is None or x0 >= x1:
+            return bytes(out)
+        for row in range(max(0, y), min(dh, y + h)):
+            src = (row * dw + x0) * ps
+            dst = ((row - y) * w + (x0 - x)) * ps
+            out[dst:dst + (x1 - x0) * ps] = data[src:src + (x1 - x0) * ps]
+        return bytes(out)
+
+    def setPixelData(self, data, x, y, w, h):
+        ps = self.doc.pixel_size
+        dw, dh = self.doc.width(), self.doc.height()
+        data = memoryview(data)
+        if len(data) < w * h * ps:
+            return False
+        if self._data is None:
+            self._data = bytearray(dw * dh * ps)
+        target = self._buffer_at(self.doc.currentTime())
+        x0, x1 = max(0, x), min(dw, x + w)
+        if x0 < x1:
+            for row in range(max(0, y), min(dh, y + h)):
+                src = ((row - y) * w + (x0 - x)) * ps
+                dst = (row * dw + x0) * ps
+                target[dst:dst + (x1 - x0) * ps] = data[src:src + (x1 - x0) * ps]
+        return True
+
+    def bounds(self):
+        """Tight rectangle around the pixels that are not fully zero (at the current time)."""
+        ps = self.doc.pixel_size
+        row_bytes = self.doc.width() * ps
+        data = self._buffer_at(self.doc.currentTime())
+        if data is None:
+            return FakeRect(0, 0, 0, 0)
+        x0, x1, y0, y1 = row_bytes, 0, None, None
+        for y in range(self.doc.height()):
+            row = bytes(data[y * row_bytes:(y + 1) * row_bytes])
+            content = row.rstrip(b'\x00')
+            if not content:
+                continue
+            x0 = min(x0, len(content) - len(content.lstrip(b'\x00')))
+            x1 = max(x1, len(content))
+            y0 = y if y0 is None else y0
+            y1 = y + 1
+        if y0 is None:
+            return FakeRect(0, 0, 0, 0)
+        return FakeRect(x0 // ps, y0, -(-x1 // ps) - x0 // ps, y1 - y0)
+
+    def colorModel(self):
+        return self.doc.colorModel()
+
+    def colorDepth(self):
+        return self.doc.colorDepth()
+
+    def projectionPixelData(self, x, y, w, h):
+        # No blending or masks: a paint layer's projection is its own pixels
+        return self.pixelData(x, y, w, h)
+
+
+class FakeDocument:
+
+    def __init__(self, width, height, depth="U8", color_model="RGBA"):
+        self._width = width
+        self._height = height
+        self._depth = depth
+        self._color_model = color_model
+        self.pixel_size = pixel_format(color_model, depth).pixel_size
+        self._batchmode = False
+        self._root = FakeNode(self, "root", 'grouplayer')
+        self._active = None
+        self._selection = None
+        self._time = 0
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+    def colorDepth(self):
+        return self._depth
+
+    def colorModel(self):
+        return self._color_model
+
+    def rootNode(self):
+        return self._root
+
+    def activeNode(self):
+        return self._active
+
+    def setActiveNode(self, node):
+        self._active = node
+
+    def selection(self):
+        return self._selection
+
+    def setSelection(self, selection):
+        self._selection = selection
+
+    def currentTime(self):
+        return self._time
+
+    def setCurrentTime(self, t):
+        self._time = t
+
+    def batchmode(self):
+        return self._batchmode
+
+    def setBatchmode(self, value):
+        self._batchmode = value
+
+    def refreshProjection(self):
+        pass
+
+    def waitForDone(self):
+        pass
+
+    def add_paint_layer(self, name, data=None, parent=None):
+        """Creates a paint layer on top of parent (the root by default)."""
+        node = FakeNode(self, name, 'paintlayer', data)
+        parent = parent or self._root
+        parent.addChildNode(node, parent._children[-1] if parent._children else None)
+        if self._active is None:
+            self._active = node
+        return node
@@ -0,0 +1,151 @@
+"""
+Per-stage wall time and peak allocation for the apply and preview paths.
+
+A Profile is passed down explicitly (profile=...) and records each stage
+the code wraps in profile.stage(name). Stages run on the calling thread;
+work done in the thread pool is added with profile.timed() and counts the
+summed worker time. With memory=True, tracemalloc measures the peak
+allocation above the level at stage start (NumPy buffers included), which
+slows Python-heavy stages down noticeably, so it is off by default.
+Stages should not nest: an inner stage resets the peak of the outer one.
+Functions take NO_PROFILE by default, whose hooks do nothing.
+"""
+import contextlib
+import json
+import platform
+import threading
+import time
+import tracemalloc
+
+
+class Profile:
+    """Stage timings of one run (an apply, or one preview render with its refine pass)."""
+
+    def __init__(self, name, memory=False):
+        self.name = name
+        self.memory = memory
+        # Stage name -> [calls, seconds, peak bytes or None], in first-seen order
+        self.stages = {}
+        self.total_seconds = None
+        self._lock = threading.Lock()
+        self._own_tracing = False
+        self._started = time.time()
+        self._t0 = None
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracing = True
+        self._t0 = time.perf_counter()
+        return self
+
+    def finish(self):
+        """Stops the clock (and tracemalloc, if this profile started it). Safe to call twice."""
+        if self._t0 is not None and self.total_seconds is None:
+            self.total_seconds = time.perf_counter() - self._t0
+        if self._own_tracing:
+            tracemalloc.stop()
+            self._own_tracing = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.finish()
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the wrapped block (and its peak allocation when memory is on)."""
+        base = None
+        # reset_peak needs Python 3.9; older interpreters get timings only
+        if self.memory and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1] - base if base is not None else None
+            self.add(name, seconds, peak)
+
+    def timed(self, name, fn):
+        """Wraps fn so that every call, from any thread, adds its time to stage name."""
+        def run(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - t0)
+        return run
+
+    def add(self, name, seconds, peak_bytes=None):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0, 0.0, None])
+            entry[0] += 1
+            entry[1] += seconds
+            if peak_bytes is not None:
+                entry[2] = peak_bytes if entry[2] is None else max(entry[2], peak_bytes)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._started)),
+            'total_seconds': self.total_seconds,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'stages': [{'stage': name, 'calls': calls, 'seconds': seconds, 'peak_bytes': peak}
+                       for name, (calls, seconds, peak) in self.stages.items()],
+        }
+
+    def summary(self):
+        """Plain-text table of the stages, for the dialog or a message box."""
+        lines = [f"{self.name}: {self.total_seconds or 0.0:.3f} s"]
+        for name, (calls, seconds, peak) in self.stages.items():
+            memory = f"{peak / (1024 * 1024):8.1f} MB" if peak is not None else ""
+            lines.append(f"  {name:24s} {calls:5d}x {seconds:9.3f} s {memory}")
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        """Appends this profile to path as one JSON line, so a trace file collects several runs."""
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.to_dict()) + "\n")
+
+
+class NullProfile:
+    """Profile stand-in whose hooks cost next to nothing."""
+
+    name = None
+    _nothing = contextlib.nullcontext()
+
+    def start(self):
+        return self
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def stage(self, name):
+        return self._nothing
+
+    def timed(self, name, fn):
+        return fn
+
+    def add(self, name, seconds, peak_bytes=None):
+        pass
+
+
+NO_PROFILE = NullProfile()
+
+
+def profile_for(name, settings):
+    """A Profile when the settings ask for stage timings, NO_PROFILE otherwise."""
+    if not settings.get('profile'):
+        return NO_PROFILE
+    return Profile(name, memory=settings.get('profile_memory', False))
@@ -20,12 +20,31 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt, QSettings, QTimer
 from PyQt5.QtGui import QImage, QPixmap
 
+from . import displace_core
 from .displace_dialog import DisplaceDialog
+from .node_registry import NodeRegistry
+from .live_displace import LiveDisplace, LiveInputs
+from .instrumentation import profile_for
+
+# How often linked (live) layers check their inputs' change tokens: the
+# interval doubles while nothing changes, up to LIVE_POLL_MAX_MS
+LIVE_POLL_MS = 500
+LIVE_POLL_MAX_MS = 2000
+# How often every link is checked tile by tile anyway, for edits a sampled
+# change token cannot see
+LIVE_VERIFY_MS = 10000
 
 class DisplaceFilterExtension(Extension):
     def __init__(self, parent):
         super().__init__(parent)
 
+        # Displaced layers kept linked to their source and map
+        self.live_links = []
+        self.live_timer = QTimer(self)
+        self.live_timer.setInterval(LIVE_POLL_MS)
+        self.live_timer.timeout.connect(self.poll_live_links)
+        self.live_verified = time.monotonic()
+
     def setup(self):
         pass
 
@@ -33,33 +52,14 @@ class DisplaceFilterExtension(Extension):
         action = window.createAction("apply_displace_map", "Apply Displace Map", "tools/scripts")
         action.triggered.connect(self.apply_displace)
 
-    # -------------------- STATIC HELPERS (Restored/Modified for Full Resolution) --------------------
-
-    # NOTE: _srgb_to_linear is assumed to be available in DisplaceDialog.
-    # If not, add it here or ensure DisplaceDialog is modified.
-
-    @staticmethod
-    def _srgb_to_linear(val_norm):
-        """Applies sRGB EOTF (gamma removal) to get LINEAR value."""
-        if val_norm <= 0.04045:
-            return val_norm / 12.92
-        else:
-            return math.pow((val_norm + 0.055) / 1.055, 2.4)
-
-    @staticmethod
-    def _normalize_displacement_float(value_float, center, invert):
-        """Normalize displacement float (0.0-1.0) value to range -1..1 or 0..1."""
-        dn = value_float # Already normalized to 0.0-1.0
-
-        if center:
-            dn = (dn - 0.5) * 2.0  # Range: -1..1
-
-        if invert:
-            dn = -dn
-
-        return dn
+        batch_action = window.createAction("apply_displace_map_batch", "Apply Displace Map (Batch)", "tools/scripts")
+        batch_action.triggered.connect(self.apply_displace_batch)
 
+        update_action = window.createAction("update_live_displace", "Update Live Displace Layers", "tools/scripts")
+        update_action.triggered.connect(lambda: self.poll_live_links(verify=True))
 
+        unlink_action = window.createAction("unlink_live_displace", "Unlink Live Displace Layers", "tools/scripts")
+        unlink_action.triggered.connect(self.unlink_live_links)
 
     def apply_displace(self):
         try:
@@ -79,209 +79,134 @@ class DisplaceFilterExtension(Extension):
                 return
 
             settings = dialog.get_settings()
-            w = doc.width()
-            h = doc.height()
 
-            disp_node = self.find_layer_by_name(doc.rootNode(), settings['displacement_layer'])
+            registry = NodeRegistry(doc.rootNode())
+            disp_node = registry.node(settings['displacement_uuid'])
             if not disp_node:
                 QMessageBox.warning(None, "Error", f"Displacement layer '{settings['displacement_layer']}' not found.")
                 return
 
-            doc.setBatchmode(True)
+            profile = profile_for("apply", settings)
+            with profile:
+                new_node = displace_core.apply_to_document(doc, main_node, disp_node, settings, profile=profile)
+            self.report_profile(profile, settings)
 
-            # Получение данных один раз
-            src_data = main_node.pixelData(0, 0, w, h)
-            disp_data = disp_node.pixelData(0, 0, w, h)
+            if settings['live']:
+                self.link_live(doc, main_node, disp_node, new_node, settings)
 
-            if not src_data or not disp_data:
-                doc.setBatchmode(False)
-                QMessageBox.warning(None, "Error", "Cannot read pixel data from one of the layers.")
-                return
+        except Exception as e:
+            QMessageBox.critical(None, "Plugin Error", str(e))
 
-            src_mv = memoryview(src_data)
-            disp_mv = memoryview(disp_data)
+    def apply_displace_batch(self):
+        """Displaces several layers, or every keyframe of the active layer, with one map."""
+        try:
+            app = Krita.instance()
+            doc = app.activeDocument()
+            if not doc:
+                QMessageBox.warning(None, "Error", "No active document.")
+                return
 
-            # Проверка BPC
-            expected_pixels = w * h * 4
-            bpc = len(src_mv) // expected_pixels
-            if bpc not in (1, 2, 4):
-                doc.setBatchmode(False)
-                QMessageBox.warning(None, "Error", f"Unsupported bytes-per-channel: {bpc}")
+            dialog = DisplaceDialog(batch=True)
+            if dialog.exec_() != QDialog.Accepted:
                 return
 
-            # -------------------- ПРЕДВАРИТЕЛЬНЫЕ ВЫЧИСЛЕНИЯ --------------------
-
-            # Константы для цикла
-            strength_val = settings['strength'] * settings['scale']
-            wrap_mode = settings['wrap_mode']
-            direction = settings['direction']
-            center = settings['center']
-            invert = settings['invert']
-            channel_idx = settings['channel']
-
-            stride = 4 * bpc
-            w_stride = w * stride
-            data_len = len(src_mv)
-
-            MAX_U8 = 255.0
-            MAX_U16 = 65535.0
-
-            # Предварительно вычислим функции для быстрого доступа
-            srgb_to_linear = self._srgb_to_linear
-            normalize_disp = self._normalize_displacement_float
-
-            # -------------------- СПЕЦИАЛИЗИРОВАННЫЙ ЧИТАТЕЛЬ (Оптимизация 2) --------------------
-
-            # Создаем функцию для чтения, специфичную для BPC, чтобы избежать проверок if/else в цикле
-            if bpc == 1:
-                # U8 Data (sRGB -> Linear)
-                def get_disp_val(idx, disp_mv, channel_idx):
-                    r_norm = disp_mv[idx + 2] / MAX_U8
-                    g_norm = disp_mv[idx + 1] / MAX_U8
-                    b_norm = disp_mv[idx] / MAX_U8
-
-                    # Convert to LINEAR
-                    r = srgb_to_linear(r_norm)
-                    g = srgb_to_linear(g_norm)
-                    b = srgb_to_linear(b_norm)
-
-                    # Extract component
-                    if channel_idx == 3: # Luminosity
-                        return 0.299 * r + 0.587 * g + 0.114 * b
-                    elif channel_idx == 0: # Red
-                        return r
-                    elif channel_idx == 1: # Green
-                        return g
-                    else: # Blue
-                        return b
-
-            elif bpc == 2:
-                # U16 Data (Assumed Linear)
-                def get_disp_val(idx, disp_mv, channel_idx):
-                    # Используем struct.unpack для U16 (6 байт на RGB)
-                    # '<HHH' - B G R
-                    b, g, r = struct.unpack('<HHH', disp_mv[idx : idx + 6])
-
-                    r /= MAX_U16
-                    g /= MAX_U16
-                    b /= MAX_U16
-
-                    if channel_idx == 3: # Luminosity
-                        return 0.299 * r + 0.587 * g + 0.114 * b
-                    elif channel_idx == 0: # Red
-                        return r
-                    elif channel_idx == 1: # Green
-                        return g
-                    else: # Blue
-                        return b
-
-            elif bpc == 4:
-                # F32 Data (Assumed Linear)
-                def get_disp_val(idx, disp_mv, channel_idx):
-                    # Используем struct.unpack для F32 (12 байт на RGB)
-                    # '<fff' - B G R
-                    b, g, r = struct.unpack('<fff', disp_mv[idx : idx + 12])
-
-                    # Clamp to 0..1 for normalization (as in original code)
-                    r = max(0.0, min(1.0, r))
-                    g = max(0.0, min(1.0, g))
-                    b = max(0.0, min(1.0, b))
-
-                    if channel_idx == 3: # Luminosity
-                        return 0.299 * r + 0.587 * g + 0.114 * b
-                    elif channel_idx == 0: # Red
-                        return r
-                    elif channel_idx == 1: # Green
-                        return g
-                    else: # Blue
-                        return b
-            else:
-                 # Должно быть обработано выше, но на всякий случай
-                 return
-
-            out_data = bytearray(data_len)
-            out_mv = memoryview(out_data)
-
-            # --- ГЛАВНЫЙ ЦИКЛ СМЕЩЕНИЯ (Ускоренный) ---
-            for y in range(h):
-                row_base = y * w
-                for x in range(w):
-                    idx = (row_base + x) * stride
-
-                    # 1. Чтение и нормализация смещения (быстрый вызов)
-                    dn_linear = get_disp_val(idx, disp_mv, channel_idx)
-                    dn = normalize_disp(dn_linear, center, invert)
-                    disp_scaled = strength_val * dn
-
-                    # 2. Расчет координат
-                    if direction == 0:  # Horizontal
-                        sx_i = int(round(x + disp_scaled))
-                        sy_i = y
-                    elif direction == 1:  # Vertical
-                        sx_i = x
-                        sy_i = int(round(y + disp_scaled))
-                    else:  # Both
-                        sx_i = int(round(x + disp_scaled))
-                        sy_i = int(round(y + disp_scaled))
-
-                    # 3. Применение Wrap Mode (более чистый код)
-                    if 0 <= sx_i < w and 0 <= sy_i < h:
-                        # В пределах границ, ничего не делаем (Clamping по умолчанию)
-                        pass
-                    elif wrap_mode == 1:  # Wrap
-                        sx_i %= w
-                        sy_i %= h
-                    elif wrap_mode == 2:  # Clamp (только если вышли за границы)
-                        sx_i = max(0, min(w - 1, sx_i))
-                        sy_i = max(0, min(h - 1, sy_i))
-
-                    # 4. Сэмплирование Source Pixel и Запись
-                    if 0 <= sx_i < w and 0 <= sy_i < h:
-                        src_idx = (sy_i * w + sx_i) * stride
-
-                        # КОПИРОВАНИЕ ЧЕРЕЗ СЛАЙСЫ memoryview (наиболее быстрое в Python)
-                        out_mv[idx : idx + stride] = src_mv[src_idx : src_idx + stride]
-                    else:
-                        # Запись прозрачного (более чистое и быстрое обнуление)
-                        # Используем memoryview для записи
-                        out_mv[idx : idx + stride] = b'\x00' * stride
-
-
-            # --- КОНЕЦ ГЛАВНОГО ЦИКЛА СМЕЩЕНИЯ ---
-
-            new_node = main_node.clone()
-            layer_name = settings['layer_name'].replace('{layer}', main_node.name())
-            new_node.setName(layer_name)
-
-            parent = main_node.parentNode()
-            if settings['create_above']:
-                parent.addChildNode(new_node, main_node)
-            else:
-                parent.addChildNode(new_node, None)
+            settings = dialog.get_settings()
 
-            # Write the resulting pixel data back to the new node
-            new_node.setPixelData(bytes(out_data), 0, 0, w, h)
-            doc.refreshProjection()
-            doc.setBatchmode(False)
+            registry = NodeRegistry(doc.rootNode())
+            disp_node = registry.node(settings['displacement_uuid'])
+            if not disp_node:
+                QMessageBox.warning(None, "Error", f"Displacement layer '{settings['displacement_layer']}' not found.")
+                return
 
-            try:
-                doc.waitForDone()
-            except:
-                pass
+            if settings['frames'] is not None:
+                main_node = doc.activeNode()
+                if not main_node or main_node.type() != 'paintlayer':
+                    QMessageBox.warning(None, "Error", "Select a paint layer.")
+                    return
+                targets = [main_node]
+            else:
+                targets = []
+                for uid in settings['targets']:
+                    node = registry.node(uid)
+                    if not node:
+                        QMessageBox.warning(None, "Error", "A target layer was removed; refresh the layer list.")
+                        return
+                    targets.append(node)
+                if not targets:
+                    QMessageBox.warning(None, "Error", "Check at least one target layer.")
+                    return
+
+            profile = profile_for("apply batch", settings)
+            with profile:
+                new_nodes = displace_core.apply_batch(doc, targets, disp_node, settings, settings['frames'],
+                                                      profile=profile)
+            self.report_profile(profile, settings)
+
+            # Live links follow layers; animated copies are not kept in sync
+            if settings['live'] and settings['frames'] is None:
+                for main_node, new_node in zip(targets, new_nodes):
+                    self.link_live(doc, main_node, disp_node, new_node, settings)
 
         except Exception as e:
-            if 'doc' in locals() and doc:
-                doc.setBatchmode(False)
             QMessageBox.critical(None, "Plugin Error", str(e))
 
-    def find_layer_by_name(self, node, name):
-        if node.name() == name:
-            return node
-        for child in node.childNodes():
-            result = self.find_layer_by_name(child, name)
-            if result:
-                return result
-        return None
+    def report_profile(self, profile, settings):
+        """Shows the stage timings of an apply and appends them to the trace file, if set."""
+        if not settings.get('profile'):
+            return
+        if settings.get('trace_path'):
+            try:
+                profile.write_trace(settings['trace_path'])
+            except OSError as e:
+                print("Trace write error:", e)
+        QMessageBox.information(None, "Displace Timings", profile.summary())
+
+    # -------------------- Live layers --------------------
+
+    def link_live(self, doc, main_node, disp_node, new_node, settings):
+        self.live_links.append(LiveDisplace(doc, main_node, disp_node, new_node, settings))
+        self.live_timer.start(LIVE_POLL_MS)
+
+    def poll_live_links(self, verify=False):
+        """
+        Re-displaces edited tiles of every linked layer. Each input is read
+        once per tick however many links share it, and only checked tile by
+        tile when its change token moved, or when verifying: every
+        LIVE_VERIFY_MS, or on request. Links whose document was closed or
+        whose layers were deleted are dropped.
+        """
+        now = time.monotonic()
+        if now - self.live_verified >= LIVE_VERIFY_MS / 1000.0:
+            verify = True
+        if verify:
+            self.live_verified = now
+
+        documents = Krita.instance().documents()
+        inputs = LiveInputs()
+        changed = False
+        for link in list(self.live_links):
+            nodes = (link.main_node, link.disp_node, link.new_node)
+            if link.doc not in documents or any(link.doc.nodeByUniqueID(n.uniqueId()) is None for n in nodes):
+                self.live_links.remove(link)
+                continue
+            try:
+                if link.poll(inputs, verify):
+                    changed = True
+            except Exception as e:
+                # A failing link would fail on every tick; drop it and say why once
+                self.live_links.remove(link)
+                print("Live displace error, layer unlinked:", e)
+
+        if not self.live_links:
+            self.live_timer.stop()
+            return
+        # Back off while nothing changes; poll quickly again after an edit
+        interval = LIVE_POLL_MS if changed else min(LIVE_POLL_MAX_MS, self.live_timer.interval() * 2)
+        self.live_timer.setInterval(interval)
+
+    def unlink_live_links(self):
+        self.live_links = []
+        self.live_timer.stop()
 
 
 Krita.instance().addExtension(DisplaceFilterExtension(Krita.instance()))
\ No newline at end of file
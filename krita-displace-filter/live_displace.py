@@ -0,0 +1,241 @@
+"""
+Live re-displace: keeps a displaced layer linked to its source and map and
+re-renders only the tiles an edit can have changed.
+
+Krita does not report which pixels an edit touched, so both inputs are
+hashed per tile and compared with the hashes from the previous update.
+Like displace_core, this module needs neither Krita nor Qt.
+"""
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from . import displace_core
+from .displace_core import np
+from .node_registry import NodeRegistry, node_uuid
+
+
+# Edge of the square tiles inputs are hashed and outputs re-rendered in
+LIVE_TILE_SIZE = 256
+
+
+def tile_hashes(read, w, h, fmt, tile=LIVE_TILE_SIZE):
+    """
+    CRC32 of every tile x tile block of a layer in format fmt, keyed by
+    (column, row) of the tile. Reads one row of tiles at a time through
+    read(x, y, w, h).
+    """
+    stride = fmt.pixel_size
+    row_bytes = w * stride
+    hashes = {}
+    for ty, y0 in enumerate(range(0, h, tile)):
+        rows = min(tile, h - y0)
+        band = memoryview(read(0, y0, w, rows))
+        for tx, x0 in enumerate(range(0, w, tile)):
+            lo, hi = x0 * stride, min(w, x0 + tile) * stride
+            crc = 0
+            for y in range(rows):
+                base = y * row_bytes
+                crc = zlib.crc32(band[base + lo:base + hi], crc)
+            hashes[tx, ty] = crc
+    return hashes
+
+
+def tile_span(lo, hi, size, tile, wrap):
+    """
+    Indices of the tiles covering pixels [lo, hi) along one axis. With wrap,
+    pixels past an edge fold around to the other side; otherwise they are
+    dropped.
+    """
+    if wrap and hi - lo >= size:
+        return set(range(-(-size // tile)))
+    pieces = [(max(0, lo), min(size, hi))]
+    if wrap:
+        if lo < 0:
+            pieces.append((lo + size, size))
+        if hi > size:
+            pieces.append((0, hi - size))
+    out = set()
+    for a, b in pieces:
+        if a < b:
+            out.update(range(a // tile, (b - 1) // tile + 1))
+    return out
+
+
+def dirty_tiles(changed_map, changed_source, w, h, settings, tile=LIVE_TILE_SIZE):
+    """
+    Output tiles to re-render: every changed map tile, plus every tile that
+    can sample from a changed source tile, i.e. lies within the displacement
+    reach of it along the displaced axes.
+    """
+    wrap = settings['wrap_mode'] == 1
+    margin = displace_core.source_margin(settings)
+    halo = displace_core.source_halo(settings)
+    dirty = set(changed_map)
+    for tx, ty in changed_source:
+        x0, y0 = tx * tile, ty * tile
+        xs = tile_span(x0 - margin, min(w, x0 + tile) + margin, w, tile, wrap)
+        ys = tile_span(y0 - halo, min(h, y0 + tile) + halo, h, tile, wrap)
+        dirty.update((x, y) for x in xs for y in ys)
+    return dirty
+
+
+def tile_rects(tiles, w, h, tile=LIVE_TILE_SIZE):
+    """
+    Canvas rectangles (x, y, width, height) covering the tiles, with
+    neighbouring tiles of a row merged into one rectangle.
+    """
+    rows = {}
+    for tx, ty in tiles:
+        rows.setdefault(ty, []).append(tx)
+
+    rects = []
+    for ty in sorted(rows):
+        columns = sorted(rows[ty])
+        start = prev = columns[0]
+        for tx in columns[1:] + [None]:
+            if tx is not None and tx == prev + 1:
+                prev = tx
+                continue
+            x0, y0 = start * tile, ty * tile
+            rects.append((x0, y0, min(w, (prev + 1) * tile) - x0, min(h, y0 + tile) - y0))
+            if tx is not None:
+                start = prev = tx
+    return rects
+
+
+def split_rect(rect, clip):
+    """
+    Splits rect into (the part inside clip or None, the parts outside it).
+    clip may be None, meaning everything is inside.
+    """
+    if clip is None:
+        return rect, []
+    x, y, w, h = rect
+    x0, y0 = max(x, clip[0]), max(y, clip[1])
+    x1, y1 = min(x + w, clip[0] + clip[2]), min(y + h, clip[1] + clip[3])
+    if x0 >= x1 or y0 >= y1:
+        return None, [rect]
+    outside = [(x, y, w, y0 - y), (x, y1, w, y + h - y1),
+               (x, y0, x0 - x, y1 - y0), (x1, y0, x + w - x1, y1 - y0)]
+    return (x0, y0, x1 - x0, y1 - y0), [r for r in outside if r[2] > 0 and r[3] > 0]
+
+
+class LiveInputs:
+    """
+    What one poll of the live links reads of their inputs: change tokens and
+    tile hashes by node uuid, so a layer several links share (typically the
+    map) is read once per poll however many links use it.
+    """
+
+    def __init__(self):
+        self.registry = NodeRegistry()
+        self._hashes = {}
+
+    def token(self, node, w, h):
+        return self.registry.change_token(node, w, h)
+
+    def hashes(self, node, w, h, fmt, tile):
+        key = node_uuid(node), tile
+        hashes = self._hashes.get(key)
+        if hashes is None:
+            hashes = self._hashes[key] = tile_hashes(node.pixelData, w, h, fmt, tile)
+        return hashes
+
+    def forget(self, node):
+        """Drops what was read of a node this poll wrote to, e.g. a link's output feeding another link."""
+        uid = node_uuid(node)
+        self.registry.forget_tokens()
+        for key in [k for k in self._hashes if k[0] == uid]:
+            del self._hashes[key]
+
+
+class LiveDisplace:
+    """
+    Link between a displaced layer and the source and map it was made from.
+
+    poll() is meant to be called from a timer: it compares the cheap change
+    tokens of both inputs (see displace_core.node_change_token) and only
+    when one moved, or when asked to verify, calls update(). That hashes
+    both inputs per tile, which sees any edit however small, and
+    re-displaces only the output tiles that can have changed. The selection
+    active when the link was made keeps limiting (and blending) the result.
+    """
+
+    def __init__(self, doc, main_node, disp_node, new_node, settings, tile=LIVE_TILE_SIZE, inputs=None):
+        self.doc = doc
+        self.main_node = main_node
+        self.disp_node = disp_node
+        self.new_node = new_node
+        self.settings = dict(settings)
+        self.tile = tile
+        self.w, self.h = doc.width(), doc.height()
+        self.fmt = displace_core.layer_format(main_node, self.w)
+        self.map_fmt = displace_core.layer_format(disp_node, self.w)
+
+        selection = doc.selection()
+        self.selection = selection.duplicate() if selection is not None else None
+        self.clip = displace_core.rect_tuple(self.selection) if self.selection is not None else None
+
+        inputs = inputs or LiveInputs()
+        self.tokens = self.input_tokens(inputs)
+        self.source_hashes = inputs.hashes(main_node, self.w, self.h, self.fmt, tile)
+        self.map_hashes = inputs.hashes(disp_node, self.w, self.h, self.map_fmt, tile)
+
+    def input_tokens(self, inputs):
+        return inputs.token(self.main_node, self.w, self.h), inputs.token(self.disp_node, self.w, self.h)
+
+    def poll(self, inputs=None, verify=False):
+        """
+        update() when a change token of an input moved, or always with
+        verify, since a sampled token can miss a small edit. Returns the
+        rectangles re-rendered.
+        """
+        inputs = inputs or LiveInputs()
+        if not verify and self.input_tokens(inputs) == self.tokens:
+            return []
+        return self.update(inputs)
+
+    def update(self, inputs=None):
+        """
+        Re-displaces the tiles the inputs' changes can reach; returns the
+        rectangles written. inputs (a LiveInputs) shares what is read with
+        the other links polled at the same time.
+        """
+        w, h, tile = self.w, self.h, self.tile
+        inputs = inputs or LiveInputs()
+        self.tokens = self.input_tokens(inputs)
+        source = inputs.hashes(self.main_node, w, h, self.fmt, tile)
+        dmap = inputs.hashes(self.disp_node, w, h, self.map_fmt, tile)
+        changed_source = [k for k, v in source.items() if self.source_hashes.get(k) != v]
+        changed_map = [k for k, v in dmap.items() if self.map_hashes.get(k) != v]
+        self.source_hashes, self.map_hashes = source, dmap
+
+        rects = tile_rects(dirty_tiles(changed_map, changed_source, w, h, self.settings, tile), w, h, tile)
+        if not rects:
+            return []
+
+        # Dirty tiles are usually few and scattered: the map is decoded per
+        # strip rather than into one field over their bounding box
+        settings = self.settings
+        workers = max(1, settings['workers']) if np is not None else 1
+        budget = int(settings['memory_budget_mb'] * 1024 * 1024)
+        write = displace_core.node_writer(self.doc, self.new_node)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            runner = displace_core.StripRunner(executor, workers, w, h, self.fmt, settings, budget,
+                                               map_fmt=self.map_fmt)
+            for rect in rects:
+                if self.selection is not None and self.clip is None:
+                    inside, outside = None, [rect]
+                else:
+                    inside, outside = split_rect(rect, self.clip)
+                # Outside the selection the output is a copy of the source, as after the apply
+                for x, y, rw, rh in outside:
+                    write(self.main_node.pixelData(x, y, rw, rh), x, y, rw, rh)
+                if inside is not None:
+                    runner.run(inside, self.main_node.pixelData, self.disp_node.pixelData,
+                               self.main_node.pixelData, write, self.selection)
+            runner.flush()
+
+        inputs.forget(self.new_node)
+        self.doc.refreshProjection()
+        return rects
@@ -0,0 +1,83 @@
+"""
+Shared index of a document's layer tree for the dialog and the extension.
+
+Built in one traversal, it resolves layers by uuid (stable, unlike names,
+which may repeat) and hands out cheap per-node change tokens (see
+displace_core.node_change_token) that stay memoized until forget_tokens()
+or rebuild(), so several lookups in one pass read each layer once.
+"""
+from .displace_core import node_change_token
+
+
+PATH_SEPARATOR = "/"
+
+
+def node_uuid(node):
+    return node.uniqueId().toString()
+
+
+class NodeRegistry:
+    """
+    Nodes by uuid, plus the paint layers in tree order with their paths
+    ("Group/Layer") for labels. Call rebuild() after the layer tree changes.
+    """
+
+    def __init__(self, root=None):
+        self._nodes = {}
+        self._paths = {}
+        self._paint_layers = []
+        self._tokens = {}
+        if root is not None:
+            self.rebuild(root)
+
+    def rebuild(self, root):
+        self._nodes.clear()
+        self._paths.clear()
+        self._paint_layers = []
+        self._tokens.clear()
+
+        # Explicit stack: deep group nesting must not hit the recursion limit
+        stack = [(child, "") for child in reversed(root.childNodes())]
+        while stack:
+            node, prefix = stack.pop()
+            uid = node_uuid(node)
+            path = prefix + node.name()
+            self._nodes[uid] = node
+            self._paths[uid] = path
+            if node.type() == 'paintlayer':
+                self._paint_layers.append(uid)
+            stack.extend((child, path + PATH_SEPARATOR) for child in reversed(node.childNodes()))
+
+    def node(self, uid):
+        """The node with this uuid, or None."""
+        return self._nodes.get(uid)
+
+    def paint_layers(self):
+        """
+        (uuid, label) of every paint layer in tree order. The label is the
+        layer name, or its full path when another paint layer has that name.
+        """
+        names = {}
+        for uid in self._paint_layers:
+            name = self._nodes[uid].name()
+            names[name] = names.get(name, 0) + 1
+        out = []
+        for uid in self._paint_layers:
+            name = self._nodes[uid].name()
+            out.append((uid, name if names[name] == 1 else self._paths[uid]))
+        return out
+
+    def change_token(self, node, w, h):
+        """node_change_token of a node on a w x h canvas, computed once until forget_tokens()."""
+        uid = node_uuid(node)
+        token = self._tokens.get(uid)
+        if token is None:
+            token = self._tokens[uid] = node_change_token(node, w, h)
+        return token
+
+    def forget_tokens(self):
+        """Drops memoized tokens, e.g. when an edit may have changed any layer."""
+        self._tokens.clear()
+
+    def __len__(self):
+        return len(self._nodes)
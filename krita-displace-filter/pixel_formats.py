@@ -0,0 +1,161 @@
+"""
+Pixel layouts of the color models and depths the filter handles.
+
+Krita hands out pixelData in the layout of the node's color space: the
+channel count, the channel order and the value type all follow
+colorModel() and colorDepth(). Integer RGB is stored BGRA, float RGB is
+RGBA, gray is gray + alpha and CMYK is C, M, Y, K + alpha; alpha always
+comes last. Strides, channel positions and value ranges are looked up
+here instead of being assumed, and every layout gets the same bulk NumPy
+readers and per-pixel struct fallbacks.
+"""
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Bytes per channel for colorDepth() values
+DEPTH_BPC = {"U8": 1, "U16": 2, "F16": 2, "F32": 4}
+
+# struct code and NumPy dtype of one channel
+DEPTH_STRUCT = {"U8": 'B', "U16": 'H', "F16": 'e', "F32": 'f'}
+DEPTH_DTYPE = {"U8": 'u1', "U16": '<u2', "F16": '<f2', "F32": '<f4'}
+
+# Full ink of a float CMYK channel: Krita keeps them in 0..100, alpha in 0..1
+FLOAT_INK_UNIT = 100.0
+
+
+class PixelFormat:
+    """
+    Layout of one color model at one depth. rgb holds the channel indices
+    of red, green and blue (gray repeats its single channel); it is None
+    for CMYKA, whose colors are worked out from the inks.
+    """
+
+    def __init__(self, model, depth, channels, rgb):
+        self.model = model
+        self.depth = depth
+        self.key = (model, depth)
+        self.channels = channels
+        self.alpha = channels - 1
+        self.bpc = DEPTH_BPC[depth]
+        self.pixel_size = channels * self.bpc
+        self.is_float = depth in ("F16", "F32")
+        # Opaque alpha, and the clamp for integer channels
+        self.top = 1.0 if self.is_float else float((1 << (8 * self.bpc)) - 1)
+        self.ink_unit = FLOAT_INK_UNIT if self.is_float else self.top
+        self.rgb = rgb
+        self.dtype = DEPTH_DTYPE[depth]
+        self.struct_format = f"<{channels}{DEPTH_STRUCT[depth]}"
+        # Packs one pixel from its channel values; integer values must already be in range
+        self.packer = struct.Struct(self.struct_format)
+
+    def __repr__(self):
+        return f"PixelFormat({self.model}, {self.depth})"
+
+
+PIXEL_FORMATS = {}
+for _depth in DEPTH_BPC:
+    _float = _depth in ("F16", "F32")
+    PIXEL_FORMATS["RGBA", _depth] = PixelFormat("RGBA", _depth, 4, (0, 1, 2) if _float else (2, 1, 0))
+    PIXEL_FORMATS["GRAYA", _depth] = PixelFormat("GRAYA", _depth, 2, (0, 0, 0))
+    PIXEL_FORMATS["CMYKA", _depth] = PixelFormat("CMYKA", _depth, 5, None)
+del _depth, _float
+
+
+def pixel_format(model, depth):
+    """The PixelFormat of a colorModel() / colorDepth() pair; ValueError for anything else."""
+    fmt = PIXEL_FORMATS.get((model, depth))
+    if fmt is None:
+        raise ValueError(f"Unsupported color space {model}/{depth}: use RGBA, GRAYA or CMYKA "
+                         f"at U8, U16, F16 or F32.")
+    return fmt
+
+
+def rgba_format(depth):
+    """RGBA format of a depth name or a bytes-per-channel count (4 meaning F32)."""
+    if not isinstance(depth, str):
+        depth = {1: "U8", 2: "U16", 4: "F32"}[depth]
+    return pixel_format("RGBA", depth)
+
+
+def node_format(node):
+    """PixelFormat of a node's own color space (a layer need not share the document's)."""
+    return pixel_format(node.colorModel(), node.colorDepth())
+
+
+# 8-bit BGRA: the preview buffers and QImage.Format_ARGB32
+PREVIEW_FORMAT = PIXEL_FORMATS["RGBA", "U8"]
+
+
+def channels_numpy(data, n, fmt):
+    """(n, channels) view of the first n pixels of a buffer."""
+    return np.frombuffer(data, dtype=fmt.dtype, count=n * fmt.channels).reshape(n, fmt.channels)
+
+
+def pixel_item_dtype(fmt):
+    """
+    NumPy dtype that moves one whole pixel as an opaque item; integer items
+    gather faster than void ones of the same size.
+    """
+    return {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}.get(
+        fmt.pixel_size, np.dtype((np.void, fmt.pixel_size)))
+
+
+def pixel_reader(fmt):
+    """Returns read(mv, idx) -> channel values of the pixel at byte index idx."""
+    if fmt.bpc == 1:
+        n = fmt.channels
+        return lambda mv, idx: tuple(mv[idx:idx + n])
+    unpack = fmt.packer.unpack_from
+    return lambda mv, idx: unpack(mv, idx)
+
+
+def unit_rgb_numpy(channels, fmt):
+    """
+    (n, 3) float64 red, green and blue in 0..1 of an (n, channels) array,
+    values taken as stored (no transfer curve). NaN reads as 0. CMYK is
+    converted naively: red = (1 - c) * (1 - k), and so on.
+    """
+    if fmt.model == "CMYKA":
+        inks = np.clip(np.nan_to_num(channels[:, :4].astype(np.float64) / fmt.ink_unit), 0.0, 1.0)
+        return (1.0 - inks[:, :3]) * (1.0 - inks[:, 3:4])
+    rgb = channels[:, list(fmt.rgb)].astype(np.float64)
+    if not fmt.is_float:
+        rgb /= fmt.top
+    return np.clip(np.nan_to_num(rgb), 0.0, 1.0)
+
+
+def rgb_reader(fmt):
+    """Per-pixel unit_rgb_numpy: returns read(mv, idx) -> (r, g, b) in 0..1."""
+    read = pixel_reader(fmt)
+    clamp = lambda v: max(0.0, min(1.0, v)) if v == v else 0.0
+    if fmt.model == "CMYKA":
+        unit = fmt.ink_unit
+
+        def read_rgb(mv, idx):
+            c, m, y, k = (clamp(v / unit) for v in read(mv, idx)[:4])
+            return (1.0 - c) * (1.0 - k), (1.0 - m) * (1.0 - k), (1.0 - y) * (1.0 - k)
+        return read_rgb
+
+    ri, gi, bi = fmt.rgb
+    top = fmt.top
+
+    def read_rgb(mv, idx):
+        px = read(mv, idx)
+        return clamp(px[ri] / top), clamp(px[gi] / top), clamp(px[bi] / top)
+    return read_rgb
+
+
+_half_float_values = None
+
+
+def half_float_values():
+    """Value of every 16-bit pattern read as a half float, so F16 data can go through 65536-entry tables."""
+    global _half_float_values
+    if _half_float_values is None:
+        _half_float_values = struct.unpack('<65536e', struct.pack('<65536H', *range(65536)))
+    return _half_float_values
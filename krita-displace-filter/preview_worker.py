@@ -0,0 +1,81 @@
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+from . import displace_core
+from .instrumentation import NO_PROFILE
+
+
+class PreviewSignals(QObject):
+    # generation, BGRA data, width, height
+    finished = pyqtSignal(int, object, int, int)
+    # generation, error message
+    failed = pyqtSignal(int, str)
+
+
+class PreviewJob(QRunnable):
+    """
+    Renders one preview off the GUI thread.
+
+    Every job carries the generation it was started for. is_current(generation)
+    is polled between rows, so a job whose settings were superseded stops early,
+    and the dialog drops any result that arrives for an old generation.
+
+    With native = (result key, source format, map format), the buffers are
+    whole layers in their native pixel formats: the full-resolution result is taken from (or
+    stored in) displace_core.displace_result_cache, where Apply finds it,
+    and only its 8-bit copy is sent back for display.
+
+    With region = (canvas rectangle, source window, source format, map
+    format), the buffers come from displace_core.region_inputs and only that
+    rectangle is displaced at full resolution (the zoomed detail view);
+    pw x ph is then the canvas size.
+    """
+
+    def __init__(self, generation, is_current, src_data, disp_data, pw, ph, settings, preview_scale,
+                 profile=NO_PROFILE, native=None, region=None):
+        super().__init__()
+        self.generation = generation
+        self.is_current = is_current
+        self.src_data = src_data
+        self.disp_data = disp_data
+        self.pw = pw
+        self.ph = ph
+        self.settings = settings
+        self.preview_scale = preview_scale
+        self.profile = profile
+        self.native = native
+        self.region = region
+        # Created on the GUI thread, so emits from the worker are queued to it
+        self.signals = PreviewSignals()
+
+    def run(self):
+        cancelled = lambda: not self.is_current(self.generation)
+        pw, ph = self.pw, self.ph
+        try:
+            if self.region is not None:
+                rect, window, fmt, map_fmt = self.region
+                with self.profile.stage("displace region"):
+                    out_data = displace_core.displace_region(
+                        self.src_data, self.disp_data, self.pw, self.ph, fmt, rect, window, self.settings,
+                        cancelled, map_fmt)
+                pw, ph = rect[2], rect[3]
+                if out_data is not None:
+                    out_data = displace_core.convert_to_u8_rgba(out_data, pw, ph, fmt, self.profile)
+            elif self.native is None:
+                with self.profile.stage("displace preview"):
+                    out_data = displace_core.displace_preview(
+                        self.src_data, self.disp_data, self.pw, self.ph, self.settings, self.preview_scale,
+                        cancelled=cancelled)
+            else:
+                key, fmt, map_fmt = self.native
+                with self.profile.stage("displace full resolution"):
+                    out_data = displace_core.displace_cached(
+                        key, self.src_data, self.disp_data, self.pw, self.ph, fmt, self.settings, cancelled,
+                        map_fmt)
+                if out_data is not None:
+                    out_data = displace_core.convert_to_u8_rgba(out_data, self.pw, self.ph, fmt, self.profile)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+            return
+
+        if out_data is not None:
+            self.signals.finished.emit(self.generation, out_data, pw, ph)
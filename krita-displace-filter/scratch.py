@@ -0,0 +1,89 @@
+"""
+Disk-backed scratch buffers for the out-of-core apply.
+
+A ScratchBuffer is an anonymous temporary file mapped into memory. Pages
+written to it are file-backed, so under memory pressure the OS writes them
+out and drops them instead of swapping, and a canvas larger than physical
+RAM can be staged once and then read back window by window. Slices of
+ScratchBuffer.mv are views of the mapping: taking whole rows copies
+nothing.
+"""
+import mmap
+import tempfile
+
+from .instrumentation import NO_PROFILE
+
+
+class ScratchBuffer:
+    """size bytes of zero-filled, file-backed memory; close() (or a with block) removes the file."""
+
+    def __init__(self, size, directory=None):
+        self.size = size
+        self._file = tempfile.TemporaryFile(prefix="displace-scratch-", dir=directory or None)
+        try:
+            # Sparse on most file systems: nothing is written until it is used
+            self._file.truncate(max(1, size))
+            self._map = mmap.mmap(self._file.fileno(), max(1, size))
+        except Exception:
+            self._file.close()
+            raise
+        self.mv = memoryview(self._map)[:size]
+
+    def close(self):
+        self.mv.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # A view handed out earlier is still alive; the mapping goes with it
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def stage_layer(read, w, h, pixel_size, budget_bytes, directory=None, profile=NO_PROFILE, name="stage layer",
+                first_row=0):
+    """
+    Copies h full-width rows of a layer starting at first_row, read through
+    read(x, y, width, height) in strips of about budget_bytes, into a new
+    ScratchBuffer and returns it.
+    """
+    row_bytes = w * pixel_size
+    buf = ScratchBuffer(h * row_bytes, directory)
+    strip = max(1, min(h, budget_bytes // row_bytes))
+    try:
+        with profile.stage(name):
+            for y0 in range(0, h, strip):
+                rows = min(strip, h - y0)
+                data = read(0, first_row + y0, w, rows)
+                if not data or len(data) < rows * row_bytes:
+                    raise RuntimeError("Cannot read pixel data from one of the layers.")
+                buf.mv[y0 * row_bytes:(y0 + rows) * row_bytes] = memoryview(data)[:rows * row_bytes]
+                del data
+    except Exception:
+        buf.close()
+        raise
+    return buf
+
+
+def scratch_reader(buf, w, pixel_size, first_row=0):
+    """
+    read(x, y, width, height) over rows staged by stage_layer, like a
+    node's pixelData; y counts from the top of the canvas and must stay
+    within the staged rows. Whole rows come back as views of the mapping;
+    narrower windows are copied row by row.
+    """
+    row_bytes = w * pixel_size
+
+    def read(x, y, width, height):
+        y -= first_row
+        if x == 0 and width == w:
+            return buf.mv[y * row_bytes:(y + height) * row_bytes]
+        lo, n = x * pixel_size, width * pixel_size
+        return b''.join(buf.mv[(y + r) * row_bytes + lo:(y + r) * row_bytes + lo + n] for r in range(height))
+    return read
@@ -0,0 +1,35 @@
+"""
+Shared setup: the plugin's Krita-free modules, loaded the way the benchmark
+loads them, and its synthetic canvases and settings.
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+import bench_displace  # noqa: E402
+
+core, fake_nodes = bench_displace.load_plugin()
+make_canvas = bench_displace.make_canvas
+DIRECTIONS = bench_displace.DIRECTIONS
+EDGES = bench_displace.EDGES
+INTERPOLATIONS = bench_displace.INTERPOLATIONS
+
+
+def make_settings(direction, edge, interpolation="Nearest", **overrides):
+    settings = bench_displace.make_settings(direction, edge, interpolation)
+    settings.update(strength=12.0, strength_y=7.0, workers=3)
+    settings.update(overrides)
+    return settings
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    """Every test starts without fields or results left by an earlier one."""
+    core.offset_field_cache.clear()
+    core.displace_result_cache.clear()
+    yield
+    core.offset_field_cache.clear()
+    core.displace_result_cache.clear()
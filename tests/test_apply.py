@@ -0,0 +1,96 @@
+"""
+Applies that write only part of what the engine displaces: selections
+blended over the original pixels, and frame ranges of an animated layer.
+"""
+import pytest
+
+from conftest import core, fake_nodes, make_canvas, make_settings
+
+W, H = 40, 30
+
+
+def document(depth="U8"):
+    doc = fake_nodes.FakeDocument(W, H, depth)
+    src = doc.add_paint_layer("Source", make_canvas(W, H, depth, 0))
+    dmap = doc.add_paint_layer("Map", make_canvas(W, H, depth, W // 3))
+    return doc, src, dmap
+
+
+def whole(node, t=None):
+    if t is None:
+        return bytes(node.pixelData(0, 0, W, H))
+    return bytes(node.pixelDataAtTime(0, 0, W, H, t))
+
+
+@pytest.mark.parametrize("depth", ["U8", "U16", "F32"])
+def test_blend_selection_mixes_by_mask(depth, monkeypatch):
+    fmt = core.PIXEL_FORMATS["RGBA", depth]
+    top = fmt.top if fmt.is_float else int(fmt.top)
+    out = fmt.packer.pack(*[top] * 4) * 3
+    orig = fmt.packer.pack(*[0] * 3, top) * 3
+    mask = bytes([0, 255, 51])
+    mixed = top * 51 / 255
+    expected = orig[:fmt.pixel_size] + out[:fmt.pixel_size] + fmt.packer.pack(
+        *[mixed if fmt.is_float else round(mixed)] * 3, top)
+
+    fast = bytearray(out)
+    core.blend_selection(fast, orig, mask, fmt)
+    # The per-pixel fallback used without NumPy
+    monkeypatch.setattr(core, "np", None)
+    slow = bytearray(out)
+    core.blend_selection(slow, orig, mask, fmt)
+    assert fast == slow == expected
+
+
+def test_apply_blends_a_soft_selection_over_the_original():
+    doc, src, dmap = document()
+    settings = make_settings("Both", "Clamp")
+    sx, sy, sw, sh = 6, 4, 20, 15
+    mask = bytes((x * 13 + y * 7) % 256 for y in range(sh) for x in range(sw))
+    doc.setSelection(fake_nodes.FakeSelection(sx, sy, sw, sh, mask))
+
+    out = core.apply_to_document(doc, src, dmap, settings)
+
+    displaced = bytearray(core.displace(whole(src), whole(dmap), W, H, core.node_format(src), settings))
+    expected = bytearray(whole(src))
+    for y in range(sy, sy + sh):
+        lo, hi = (y * W + sx) * 4, (y * W + sx + sw) * 4
+        row = displaced[lo:hi]
+        core.blend_selection(row, expected[lo:hi], mask[(y - sy) * sw:(y - sy + 1) * sw], core.node_format(src))
+        expected[lo:hi] = row
+    assert whole(out) == bytes(expected)
+
+
+def animated_document():
+    doc, src, dmap = document()
+    for t, phase in ((0, 0), (2, 5), (5, 11)):
+        src.add_keyframe(t, make_canvas(W, H, "U8", phase))
+    return doc, src, dmap
+
+
+def test_frame_range_displaces_each_keyframe_and_restores_the_time():
+    doc, src, dmap = animated_document()
+    doc.setCurrentTime(4)
+    batchmode = []
+    set_batchmode = doc.setBatchmode
+    doc.setBatchmode = lambda value: batchmode.append(value) or set_batchmode(value)
+    settings = make_settings("Vertical", "Wrap")
+
+    out, = core.apply_batch(doc, [src], dmap, settings, frames=(0, 3))
+
+    fmt = core.node_format(src)
+    for t in (0, 2):
+        assert whole(out, t) == bytes(core.displace(whole(src, t), whole(dmap), W, H, fmt, settings))
+    # Outside the range the copy keeps the original keyframe
+    assert whole(out, 5) == whole(src, 5)
+    assert doc.currentTime() == 4
+    assert batchmode == [True, False] and not doc.batchmode()
+
+
+def test_frame_range_needs_one_layer_with_keyframes_in_it():
+    doc, src, dmap = animated_document()
+    settings = make_settings("Horizontal", "Clamp")
+    with pytest.raises(ValueError):
+        core.apply_batch(doc, [src, dmap], dmap, settings, frames=(0, 3))
+    with pytest.raises(RuntimeError):
+        core.apply_batch(doc, [src], dmap, settings, frames=(6, 9))
@@ -0,0 +1,149 @@
+"""
+The LRU caches stay within their budget, and cached layer data or results
+must never outlive an edit of the layer they came from, however small.
+"""
+import importlib
+import threading
+
+import pytest
+
+from conftest import core, fake_nodes, make_canvas, make_settings
+
+caching = importlib.import_module("displace_plugin.caching")
+node_registry = importlib.import_module("displace_plugin.node_registry")
+
+W, H = 512, 512
+
+
+def flat_document():
+    """A uniform map: only a check of every pixel sees a few edited ones."""
+    doc = fake_nodes.FakeDocument(W, H, "U8")
+    src = doc.add_paint_layer("Source", make_canvas(W, H, "U8", 0))
+    dmap = doc.add_paint_layer("Map", bytes([128, 128, 128, 255]) * (W * H))
+    return doc, src, dmap
+
+
+def stroke(node, x=3, y=3, size=4):
+    node.setPixelData(bytes([255, 255, 255, 255]) * (size * size), x, y, size, size)
+
+
+def canvas(node):
+    return bytes(node.pixelData(0, 0, W, H))
+
+
+def test_offset_field_cache_sees_small_map_edits():
+    doc, src, dmap = flat_document()
+    settings = make_settings("Horizontal", "Clamp")
+    core.apply_to_document(doc, src, dmap, settings)
+    stroke(dmap)
+    out = core.apply_to_document(doc, src, dmap, settings)
+    assert canvas(out) == bytes(core.displace(canvas(src), canvas(dmap), W, H, core.node_format(src), settings))
+
+
+def test_change_token_moves_with_sampled_rows_and_bounds():
+    doc, src, dmap = flat_document()
+    layer = doc.add_paint_layer("Empty", bytes(W * H * 4))
+    registry = node_registry.NodeRegistry(doc.rootNode())
+    before = registry.change_token(dmap, W, H), registry.change_token(layer, W, H)
+
+    stroke(dmap, 3, core.sample_positions(core.CHANGE_TOKEN_ROWS, H)[5], 4)
+    # Between sampled rows, but it grows the bounds of an empty layer
+    stroke(layer, 100, 1, 1)
+    registry.forget_tokens()
+    after = registry.change_token(dmap, W, H), registry.change_token(layer, W, H)
+    assert after[0] != before[0] and after[1] != before[1]
+
+
+def test_change_token_reads_only_sampled_rows():
+    doc, src, dmap = flat_document()
+    read = []
+    pixel_data = dmap.pixelData
+    dmap.pixelData = lambda x, y, w, h: read.append(w * h) or pixel_data(x, y, w, h)
+    core.node_change_token(dmap, W, H)
+    assert sum(read) <= core.CHANGE_TOKEN_ROWS * W
+
+
+def test_lru_cache_evicts_least_recently_used_by_size():
+    cache = caching.LRUCache(10)
+    cache.put("a", b"xxxx")
+    cache.put("b", b"xxxx")
+    cache.get("a")
+    cache.put("c", b"xxxx")
+    assert "a" in cache and "c" in cache and "b" not in cache
+
+    # Replacing an entry frees its old size; one over the whole budget is not stored
+    cache.put("a", b"x")
+    cache.put("d", b"xxxxx")
+    assert len(cache) == 3
+    cache.put("e", b"x" * 11)
+    assert "e" not in cache and len(cache) == 3
+
+
+def test_lru_cache_stays_within_budget_across_threads():
+    cache = caching.LRUCache(64 * 100)
+    errors = []
+
+    def churn(worker):
+        try:
+            for i in range(2000):
+                cache.put((worker, i % 150), bytes(64 + i % 3))
+                cache.get((worker, (i * 7) % 150))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=churn, args=(k,)) for k in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert cache._total == sum(cache._sizes.values()) <= cache.max_bytes
+    assert set(cache._sizes) == set(cache._entries)
+
+
+def cached_apply_inputs():
+    doc = fake_nodes.FakeDocument(64, 48, "U8")
+    src = doc.add_paint_layer("Source", make_canvas(64, 48, "U8", 0))
+    dmap = doc.add_paint_layer("Map", make_canvas(64, 48, "U8", 21))
+    settings = make_settings("Both", "Wrap")
+    fmt = core.node_format(src)
+    key = core.result_key(src, dmap, 64, 48, fmt, settings)
+    return doc, src, dmap, settings, fmt, key
+
+
+def test_displace_cached_reuses_a_result_until_an_input_changes():
+    doc, src, dmap, settings, fmt, key = cached_apply_inputs()
+    src_data, map_data = src.pixelData(0, 0, 64, 48), dmap.pixelData(0, 0, 64, 48)
+    first = core.displace_cached(key, src_data, map_data, 64, 48, fmt, settings)
+    assert core.displace_cached(key, src_data, map_data, 64, 48, fmt, settings) is first
+
+    stroke(dmap, 10, 10, 4)
+    map_data = dmap.pixelData(0, 0, 64, 48)
+    again = core.displace_cached(key, src_data, map_data, 64, 48, fmt, settings)
+    assert again is not first
+    assert bytes(again) == bytes(core.displace(src_data, map_data, 64, 48, fmt, settings))
+
+
+def test_apply_writes_a_cached_result_without_displacing(monkeypatch):
+    doc, src, dmap, settings, fmt, key = cached_apply_inputs()
+    # What the 100% preview leaves behind
+    result = core.displace_cached(key, src.pixelData(0, 0, 64, 48), dmap.pixelData(0, 0, 64, 48), 64, 48, fmt,
+                                  settings)
+
+    def run_jobs(*args, **kwargs):
+        raise AssertionError("displaced again despite a cached result")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(core, "run_jobs", run_jobs)
+        out = core.apply_to_document(doc, src, dmap, settings)
+    assert bytes(out.pixelData(0, 0, 64, 48)) == bytes(result)
+
+
+@pytest.mark.parametrize("edited", ["Source", "Map"])
+def test_apply_ignores_a_cached_result_of_older_pixels(edited):
+    doc, src, dmap, settings, fmt, key = cached_apply_inputs()
+    core.displace_cached(key, src.pixelData(0, 0, 64, 48), dmap.pixelData(0, 0, 64, 48), 64, 48, fmt, settings)
+    stroke(src if edited == "Source" else dmap, 30, 20, 3)
+    out = core.apply_to_document(doc, src, dmap, settings)
+    assert bytes(out.pixelData(0, 0, 64, 48)) == bytes(core.displace(
+        src.pixelData(0, 0, 64, 48), dmap.pixelData(0, 0, 64, 48), 64, 48, fmt, settings))
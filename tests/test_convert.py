@@ -0,0 +1,56 @@
+"""Conversion of native layer data to the 8-bit BGRA preview buffers."""
+import itertools
+import struct
+
+import pytest
+
+from conftest import core, make_canvas
+
+W, H = 37, 5
+
+FORMATS = list(itertools.product(["RGBA", "GRAYA", "CMYKA"], ["U8", "U16", "F16", "F32"]))
+
+
+def test_unknown_depth_is_an_error():
+    with pytest.raises(ValueError):
+        core.convert_to_u8_rgba(bytes(16), 2, 2, "U32")
+
+
+def test_u8_rgba_is_returned_as_is():
+    data = make_canvas(W, H, "U8", 0)
+    assert core.convert_to_u8_rgba(data, W, H, "U8") is data
+
+
+@pytest.mark.parametrize("model,depth", FORMATS)
+def test_numpy_and_python_conversions_agree(model, depth):
+    fmt = core.PIXEL_FORMATS[model, depth]
+    data = make_canvas(W, H, depth, 5, model)
+    assert core._convert_to_u8_numpy(data, W * H, fmt) == core._convert_to_u8_python(data, W * H, fmt)
+
+
+@pytest.mark.parametrize("depth,code", [("F16", 'e'), ("F32", 'f')])
+def test_float_rgba_is_swapped_to_bgra_and_encoded_to_srgb(depth, code):
+    # Stored RGBA; out of range values are clamped and NaN reads as 0
+    data = struct.pack(f'<8{code}', 1.0, 0.0, 0.5, 0.5, 2.0, float('nan'), -1.0, 1.0)
+    assert core.convert_to_u8_rgba(data, 2, 1, depth) == bytes([
+        core.linear_to_srgb_u8(0.5), 0, 255, 128,
+        0, 0, 255, 255])
+
+
+def test_u16_goes_through_the_srgb_table_and_keeps_alpha_linear():
+    # Stored BGRA like U8
+    data = struct.pack('<4H', 65535, 0, 32768, 32768)
+    assert core.convert_to_u8_rgba(data, 1, 1, "U16") == bytes([
+        255, 0, core.linear_to_srgb_u8(32768 / 65535), 128])
+
+
+def test_gray_fills_every_colour_channel():
+    fmt = core.PIXEL_FORMATS["GRAYA", "U16"]
+    gray = core.linear_to_srgb_u8(0.25)
+    assert core.convert_to_u8_rgba(struct.pack('<2H', 16384, 65535), 1, 1, fmt) == bytes([gray] * 3 + [255])
+
+
+def test_cmyk_inks_are_subtracted_from_white():
+    fmt = core.PIXEL_FORMATS["CMYKA", "U8"]
+    # Full cyan, half black, no magenta or yellow
+    assert core.convert_to_u8_rgba(bytes([255, 0, 0, 128, 255]), 1, 1, fmt) == bytes([127, 127, 0, 255])
@@ -0,0 +1,170 @@
+"""
+Equivalence checks of the displacement engines and the apply paths, run
+headless through fake_nodes: every faster path must produce the pixels of
+the plain whole-canvas displacement.
+"""
+import itertools
+
+import numpy as np
+import pytest
+
+from conftest import DIRECTIONS, EDGES, core, fake_nodes, make_canvas, make_settings
+
+W, H = 48, 37
+
+FORMATS = [("RGBA", "U8"), ("RGBA", "U16"), ("RGBA", "F32"), ("GRAYA", "F16"), ("CMYKA", "U8")]
+MODES = list(itertools.product(DIRECTIONS, EDGES))
+
+
+def document(model="RGBA", depth="U8", w=W, h=H):
+    doc = fake_nodes.FakeDocument(w, h, depth, model)
+    src = doc.add_paint_layer("Source", make_canvas(w, h, depth, 0, model))
+    dmap = doc.add_paint_layer("Map", make_canvas(w, h, depth, w // 3, model))
+    return doc, src, dmap
+
+
+def whole(node, doc):
+    return bytes(node.pixelData(0, 0, doc.width(), doc.height()))
+
+
+def reference(doc, src, dmap, settings):
+    """The plain one-call displacement of the whole canvas."""
+    fmt = core.node_format(src)
+    return bytes(core.displace(whole(src, doc), whole(dmap, doc), doc.width(), doc.height(), fmt, settings,
+                               map_fmt=core.node_format(dmap)))
+
+
+def crop(data, w, region, pixel_size):
+    x, y, rw, rh = region
+    return b''.join(data[((y + r) * w + x) * pixel_size:((y + r) * w + x + rw) * pixel_size] for r in range(rh))
+
+
+@pytest.mark.parametrize("model,depth", FORMATS)
+@pytest.mark.parametrize("direction,edge", MODES)
+def test_numpy_engine_matches_python_loop(model, depth, direction, edge):
+    doc, src, dmap = document(model, depth)
+    fmt = core.node_format(src)
+    settings = make_settings(direction, edge)
+    args = (memoryview(whole(src, doc)), memoryview(whole(dmap, doc)), W, H, fmt, settings)
+    assert bytes(core.displace_numpy(*args)) == bytes(core.displace_python(*args))
+
+
+def banded_map(doc, dmap, w, h, pixel_size):
+    """
+    Rebuilds the map from its own pixels in bands of flat rows, rows with a
+    4 px stripe, rows flat for their first two thirds and untouched rows.
+    """
+    data = whole(dmap, doc)
+
+    def px(x, y):
+        return data[(y * w + x) * pixel_size:(y * w + x + 1) * pixel_size]
+
+    rows = []
+    for y in range(h):
+        band = y * 4 // h
+        if band == 0:
+            rows.append(px(7, y) * w)
+        elif band == 1:
+            rows.append(px(3, y) * (w // 2) + px(w - 5, y) * 4 + px(3, y) * (w - w // 2 - 4))
+        elif band == 2:
+            rows.append(px(w // 3, y) * (2 * w // 3) + data[(y * w + 2 * w // 3) * pixel_size:(y + 1) * w * pixel_size])
+        else:
+            rows.append(data[y * w * pixel_size:(y + 1) * w * pixel_size])
+    return b''.join(rows)
+
+
+@pytest.mark.parametrize("model,depth", FORMATS)
+@pytest.mark.parametrize("direction,edge", MODES)
+def test_numpy_engine_copies_runs_like_python_loop(model, depth, direction, edge):
+    # Wide enough for whole rows and runs within rows to be copied as slices
+    w, h = 2 * core.SLICE_RUN_PIXELS + 44, 16
+    doc, src, dmap = document(model, depth, w, h)
+    fmt = core.node_format(src)
+    settings = make_settings(direction, edge)
+    args = (memoryview(whole(src, doc)), memoryview(banded_map(doc, dmap, w, h, fmt.pixel_size)), w, h, fmt, settings)
+    assert bytes(core.displace_numpy(*args)) == bytes(core.displace_python(*args))
+
+
+@pytest.mark.parametrize("interpolation", ["Bilinear", "Bicubic"])
+@pytest.mark.parametrize("direction,edge", MODES)
+def test_filtered_numpy_engine_matches_python_loop(interpolation, direction, edge):
+    doc, src, dmap = document()
+    settings = make_settings(direction, edge, interpolation, strength=5.5, strength_y=3.25)
+    args = (memoryview(whole(src, doc)), memoryview(whole(dmap, doc)), W, H, core.node_format(src), settings)
+    assert bytes(core.displace_numpy(*args)) == bytes(core.displace_python(*args))
+
+
+# RGBA U8 is compared byte for byte above
+@pytest.mark.parametrize("model,depth", FORMATS[1:])
+@pytest.mark.parametrize("interpolation", ["Bilinear", "Bicubic"])
+@pytest.mark.parametrize("direction,edge", MODES)
+def test_filtered_numpy_engine_matches_python_loop_at_every_depth(model, depth, interpolation, direction, edge):
+    # The NumPy engine blends in float32: a value on a rounding tie may land
+    # one level off, and floats differ by float32 rounding
+    doc, src, dmap = document(model, depth)
+    fmt = core.node_format(src)
+    settings = make_settings(direction, edge, interpolation, strength=5.5, strength_y=3.25)
+    args = (memoryview(whole(src, doc)), memoryview(whole(dmap, doc)), W, H, fmt, settings)
+    fast = np.frombuffer(bytes(core.displace_numpy(*args)), dtype=fmt.dtype).astype(np.float64)
+    slow = np.frombuffer(bytes(core.displace_python(*args)), dtype=fmt.dtype).astype(np.float64)
+    if fmt.is_float:
+        np.testing.assert_allclose(fast, slow, rtol=1e-5, atol=1e-6)
+    else:
+        assert np.abs(fast - slow).max() <= 1
+
+
+@pytest.mark.parametrize("model,depth", FORMATS)
+@pytest.mark.parametrize("direction,edge", MODES)
+def test_strip_apply_matches_whole_canvas(model, depth, direction, edge):
+    doc, src, dmap = document(model, depth)
+    # A budget far below the canvas size forces many strips per apply
+    settings = make_settings(direction, edge, memory_budget_mb=0.002)
+    new_node = core.apply_to_document(doc, src, dmap, settings)
+    assert whole(new_node, doc) == reference(doc, src, dmap, settings)
+
+
+@pytest.mark.parametrize("direction,edge", MODES)
+def test_apply_within_layer_bounds_matches_whole_canvas(direction, edge):
+    doc, src, dmap = document()
+    # Transparent margins: only the bounds grown by the reach are displaced
+    data = bytearray(whole(src, doc))
+    row = W * 4
+    for y in range(H):
+        if y < 9 or y >= 25:
+            data[y * row:(y + 1) * row] = bytes(row)
+        else:
+            data[y * row:y * row + 10 * 4] = bytes(40)
+    src.setPixelData(bytes(data), 0, 0, W, H)
+    settings = make_settings(direction, edge)
+    new_node = core.apply_to_document(doc, src, dmap, settings)
+    assert whole(new_node, doc) == reference(doc, src, dmap, settings)
+
+
+def test_batch_matches_single_applies():
+    doc, src, dmap = document()
+    other = doc.add_paint_layer("Other", make_canvas(W, H, "U8", 11))
+    settings = make_settings("Both", "Clamp", "Bilinear", memory_budget_mb=0.01)
+    batch = core.apply_batch(doc, [src, other], dmap, settings)
+    assert [whole(node, doc) for node in batch] == [reference(doc, node, dmap, settings) for node in (src, other)]
+
+
+@pytest.mark.parametrize("model,depth", FORMATS)
+@pytest.mark.parametrize("direction,edge", MODES)
+def test_region_matches_whole_canvas(model, depth, direction, edge):
+    doc, src, dmap = document(model, depth)
+    fmt, map_fmt = core.node_format(src), core.node_format(dmap)
+    settings = make_settings(direction, edge, "Bilinear")
+    full = core.displace_canvas(whole(src, doc), whole(dmap, doc), W, H, fmt, settings, map_fmt=map_fmt)
+    for region in ((0, 0, W, H), (10, 5, 17, 12), (0, 0, 7, 3), (W - 9, H - 11, 9, 11), (W // 2, H // 2, 1, 1)):
+        src_data, disp_data, window = core.region_inputs(src.pixelData, dmap.pixelData, W, H, region, settings)
+        out = core.displace_region(src_data, disp_data, W, H, fmt, region, window, settings, map_fmt=map_fmt)
+        assert bytes(out) == crop(bytes(full), W, region, fmt.pixel_size)
+
+
+@pytest.mark.parametrize("direction,edge", MODES)
+def test_staged_apply_matches_direct_apply(direction, edge):
+    doc, src, dmap = document()
+    settings = make_settings(direction, edge, memory_budget_mb=0.01, scratch_threshold_mp=0.0001)
+    assert core.out_of_core(W, H, core.node_format(src), settings)
+    new_node = core.apply_to_document(doc, src, dmap, settings)
+    assert whole(new_node, doc) == reference(doc, src, dmap, settings)
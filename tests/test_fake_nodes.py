@@ -0,0 +1,11 @@
+"""The in-memory stand-ins must answer the Krita node calls the plugin makes like Krita does."""
+from conftest import fake_nodes, make_canvas
+
+W, H = 20, 14
+
+
+def test_projection_of_a_paint_layer_is_its_pixels():
+    doc = fake_nodes.FakeDocument(W, H, "U16")
+    node = doc.add_paint_layer("Paint", make_canvas(W, H, "U16", 0))
+    assert node.projectionPixelData(0, 0, W, H) == node.pixelData(0, 0, W, H)
+    assert node.projectionPixelData(3, 2, 5, 4) == node.pixelData(3, 2, 5, 4)
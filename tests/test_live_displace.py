@@ -0,0 +1,98 @@
+"""A linked layer brought up to date tile by tile must equal a fresh apply of the edited inputs."""
+import importlib
+
+import pytest
+
+from conftest import core, fake_nodes, make_canvas, make_settings
+
+live_displace = importlib.import_module("displace_plugin.live_displace")
+
+W, H = 70, 52
+
+
+def stroke(node, x, y, size, value=0xFF):
+    """Paints a size x size square of one opaque value, like a small brush dab."""
+    ps = node.doc.pixel_size
+    node.setPixelData(bytes([value] * (ps - 1) + [0xFF]) * (size * size), x, y, size, size)
+
+
+@pytest.mark.parametrize("edited", ["source", "map"])
+@pytest.mark.parametrize("direction,edge", [("Horizontal", "Clamp"), ("Both", "Wrap"), ("Vector", "Transparent")])
+def test_update_matches_fresh_apply(edited, direction, edge):
+    doc = fake_nodes.FakeDocument(W, H, "U8")
+    src = doc.add_paint_layer("Source", make_canvas(W, H, "U8", 0))
+    dmap = doc.add_paint_layer("Map", make_canvas(W, H, "U8", 5))
+    settings = make_settings(direction, edge)
+    new_node = core.apply_to_document(doc, src, dmap, settings)
+    link = live_displace.LiveDisplace(doc, src, dmap, new_node, settings, tile=16)
+
+    stroke(src if edited == "source" else dmap, 30, 20, 4, 0x40)
+    assert link.update()
+
+    fresh = core.apply_to_document(doc, src, dmap, settings)
+    assert new_node.pixelData(0, 0, W, H) == fresh.pixelData(0, 0, W, H)
+
+
+def test_update_sees_a_small_stroke_on_a_flat_map():
+    """A few pixels on a uniform map: no coarse change signal may hide them."""
+    doc = fake_nodes.FakeDocument(W, H, "U8")
+    src = doc.add_paint_layer("Source", make_canvas(W, H, "U8", 0))
+    dmap = doc.add_paint_layer("Map", bytes([128, 128, 128, 255]) * (W * H))
+    settings = make_settings("Horizontal", "Clamp")
+    new_node = core.apply_to_document(doc, src, dmap, settings)
+    link = live_displace.LiveDisplace(doc, src, dmap, new_node, settings, tile=16)
+
+    assert link.update() == []
+    stroke(dmap, 3, 3, 4)
+    assert link.update()
+
+    fresh = core.apply_to_document(doc, src, dmap, settings)
+    assert new_node.pixelData(0, 0, W, H) == fresh.pixelData(0, 0, W, H)
+
+
+def linked_flat_map(h=H):
+    doc = fake_nodes.FakeDocument(W, h, "U8")
+    src = doc.add_paint_layer("Source", make_canvas(W, h, "U8", 0))
+    dmap = doc.add_paint_layer("Map", bytes([128, 128, 128, 255]) * (W * h))
+    settings = make_settings("Horizontal", "Clamp")
+    new_node = core.apply_to_document(doc, src, dmap, settings)
+    return doc, src, dmap, settings, live_displace.LiveDisplace(doc, src, dmap, new_node, settings, tile=16)
+
+
+def test_idle_poll_reads_only_change_tokens():
+    doc, src, dmap, settings, link = linked_flat_map()
+    read = []
+    for node in (src, dmap):
+        pixel_data = node.pixelData
+        node.pixelData = lambda x, y, w, h, pixel_data=pixel_data: read.append(w * h) or pixel_data(x, y, w, h)
+    assert link.poll() == []
+    assert sum(read) <= 2 * min(core.CHANGE_TOKEN_ROWS, H) * W
+
+
+def test_links_sharing_a_map_hash_it_once_per_poll(monkeypatch):
+    doc, src, dmap, settings, link = linked_flat_map()
+    other_src = doc.add_paint_layer("Other", make_canvas(W, H, "U8", 9))
+    other = live_displace.LiveDisplace(doc, other_src, dmap, core.apply_to_document(doc, other_src, dmap, settings),
+                                       settings, tile=16)
+    hashed = []
+    tile_hashes = live_displace.tile_hashes
+    monkeypatch.setattr(live_displace, "tile_hashes",
+                        lambda read, *args: hashed.append(read) or tile_hashes(read, *args))
+    stroke(dmap, 30, 20, 4)
+    inputs = live_displace.LiveInputs()
+    assert link.poll(inputs) and other.poll(inputs)
+    # Both sources, and the map once
+    assert len(hashed) == 3
+
+
+def test_verify_finds_an_edit_the_token_cannot_see():
+    h = 300
+    doc, src, dmap, settings, link = linked_flat_map(h)
+    # Rows 0 and 1 are not among the sampled rows, and the opaque map keeps its bounds
+    assert not {0, 1} & set(core.sample_positions(core.CHANGE_TOKEN_ROWS, h))
+    stroke(dmap, 3, 0, 2)
+    assert link.poll() == []
+    assert link.poll(verify=True)
+
+    fresh = core.apply_to_document(doc, src, dmap, settings)
+    assert link.new_node.pixelData(0, 0, W, h) == fresh.pixelData(0, 0, W, h)
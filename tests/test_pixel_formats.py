@@ -0,0 +1,68 @@
+"""The pixel layouts looked up by color model and depth, and their readers."""
+import importlib
+import itertools
+
+import numpy as np
+import pytest
+
+from conftest import fake_nodes, make_canvas
+
+pixel_formats = importlib.import_module("displace_plugin.pixel_formats")
+
+MODELS = {"RGBA": 4, "GRAYA": 2, "CMYKA": 5}
+DEPTHS = {"U8": (1, 255.0), "U16": (2, 65535.0), "F16": (2, 1.0), "F32": (4, 1.0)}
+FORMATS = list(itertools.product(MODELS, DEPTHS))
+
+
+@pytest.mark.parametrize("model,depth", FORMATS)
+def test_layout_of_every_model_and_depth(model, depth):
+    fmt = pixel_formats.pixel_format(model, depth)
+    bpc, top = DEPTHS[depth]
+    assert fmt.key == (model, depth)
+    assert (fmt.channels, fmt.alpha, fmt.bpc) == (MODELS[model], MODELS[model] - 1, bpc)
+    assert fmt.pixel_size == fmt.packer.size == MODELS[model] * bpc
+    assert fmt.top == top and fmt.is_float == depth.startswith("F")
+    assert np.dtype(fmt.dtype).itemsize == bpc
+
+
+def test_channel_order_follows_krita():
+    # Integer RGB is stored BGRA, float RGB is RGBA; gray repeats its one channel
+    assert pixel_formats.pixel_format("RGBA", "U16").rgb == (2, 1, 0)
+    assert pixel_formats.pixel_format("RGBA", "F16").rgb == (0, 1, 2)
+    assert pixel_formats.pixel_format("GRAYA", "F32").rgb == (0, 0, 0)
+    assert pixel_formats.pixel_format("CMYKA", "U8").rgb is None
+    assert pixel_formats.pixel_format("CMYKA", "F32").ink_unit == pixel_formats.FLOAT_INK_UNIT
+
+
+@pytest.mark.parametrize("model,depth", [("LABA", "U8"), ("RGBA", "U32"), ("XYZA", "F16")])
+def test_unsupported_color_spaces_are_an_error(model, depth):
+    with pytest.raises(ValueError):
+        pixel_formats.pixel_format(model, depth)
+
+
+def test_rgba_format_takes_a_depth_or_a_channel_size():
+    assert pixel_formats.rgba_format(2) is pixel_formats.rgba_format("U16")
+    assert pixel_formats.rgba_format(4).key == ("RGBA", "F32")
+
+
+def test_node_format_follows_the_layer_color_space():
+    doc = fake_nodes.FakeDocument(4, 4, "F16", "GRAYA")
+    assert pixel_formats.node_format(doc.add_paint_layer("Layer")).key == ("GRAYA", "F16")
+
+
+@pytest.mark.parametrize("model,depth", FORMATS)
+def test_bulk_and_per_pixel_readers_agree(model, depth):
+    fmt = pixel_formats.pixel_format(model, depth)
+    n = 23
+    data = make_canvas(n, 1, depth, 3, model)
+    channels = pixel_formats.channels_numpy(data, n, fmt)
+    read_px = pixel_formats.pixel_reader(fmt)
+    read_rgb = pixel_formats.rgb_reader(fmt)
+    assert channels.shape == (n, fmt.channels)
+    for i in range(n):
+        assert read_px(data, i * fmt.pixel_size) == pytest.approx(tuple(channels[i].astype(float)))
+    np.testing.assert_allclose(pixel_formats.unit_rgb_numpy(channels, fmt),
+                               [read_rgb(data, i * fmt.pixel_size) for i in range(n)], atol=1e-12)
+    # Whole pixels move as items of one pixel_size each
+    items = np.frombuffer(data, dtype=pixel_formats.pixel_item_dtype(fmt))
+    assert items.itemsize == fmt.pixel_size and items.size == n
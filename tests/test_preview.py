@@ -0,0 +1,75 @@
+"""
+Preview inputs decimated in the native format, and the coarse and refine
+renders of a progressive preview.
+"""
+import pytest
+
+from conftest import core, fake_nodes, make_canvas, make_settings
+
+W, H = 120, 90
+
+# The dialog's quick first pass (displace_dialog.PROGRESSIVE_SCALE)
+COARSE_SCALE = 0.05
+
+
+def layer(model="RGBA", depth="U8"):
+    doc = fake_nodes.FakeDocument(W, H, depth, model)
+    return doc.add_paint_layer("Layer", make_canvas(W, H, depth, 9, model))
+
+
+def decimated_reference(node, pw, ph):
+    """The whole layer converted to 8 bits, then picked at the preview sample positions."""
+    full = core.convert_to_u8_rgba(node.pixelData(0, 0, W, H), W, H, core.node_format(node))
+    return b''.join(full[(y * W + x) * 4:(y * W + x + 1) * 4]
+                    for y in core.sample_positions(ph, H) for x in core.sample_positions(pw, W))
+
+
+@pytest.mark.parametrize("model,depth", [("RGBA", "U8"), ("RGBA", "U16"), ("GRAYA", "F16"), ("CMYKA", "F32")])
+@pytest.mark.parametrize("scale", [COARSE_SCALE, 0.25, 0.5, 0.75, 1.0])
+def test_decimating_native_data_matches_decimating_the_converted_layer(model, depth, scale):
+    node = layer(model, depth)
+    pw, ph = core.preview_size(W, H, scale)
+    data = core.load_preview_buffer(node, W, H, core.node_format(node), pw, ph)
+    assert bytes(data) == decimated_reference(node, pw, ph)
+
+
+def test_small_previews_read_only_the_sampled_rows():
+    node = layer()
+    read = []
+    pixel_data = node.pixelData
+    node.pixelData = lambda x, y, w, h: read.append((y, h)) or pixel_data(x, y, w, h)
+    pw, ph = core.preview_size(W, H, 0.25)
+    core.load_preview_buffer(node, W, H, core.node_format(node), pw, ph)
+    assert read == [(y, 1) for y in core.sample_positions(ph, H)]
+
+
+def test_preview_size_keeps_at_least_one_pixel():
+    assert core.preview_size(W, H, 0.25) == (30, 22)
+    assert core.preview_size(W, H, 0.001) == (1, 1)
+
+
+def render(scale, settings, cancelled=None):
+    src, dmap = layer(), layer()
+    dmap.setPixelData(make_canvas(W, H, "U8", W // 3), 0, 0, W, H)
+    pw, ph = core.preview_size(W, H, scale)
+    src_data = core.load_preview_buffer(src, W, H, core.PREVIEW_FORMAT, pw, ph)
+    disp_data = core.load_preview_buffer(dmap, W, H, core.PREVIEW_FORMAT, pw, ph)
+    return src_data, disp_data, pw, ph, core.displace_preview(src_data, disp_data, pw, ph, settings, scale,
+                                                              cancelled)
+
+
+def test_coarse_pass_then_refine_renders_the_requested_scale():
+    settings = make_settings("Both", "Clamp")
+    *_, cpw, cph, coarse = render(COARSE_SCALE, settings)
+    assert len(coarse) == cpw * cph * 4
+    src_data, disp_data, pw, ph, refined = render(0.5, settings)
+    # The refine is the plain preview at that scale, strength scaled like Apply's
+    scaled = dict(settings, scale=settings['scale'] * 0.5)
+    assert bytes(refined) == bytes(core.displace(src_data, disp_data, pw, ph, core.PREVIEW_FORMAT, scaled))
+
+
+def test_a_render_superseded_by_a_newer_generation_stops():
+    # PreviewJob's check once the dialog has started a newer generation
+    generation, latest = 1, 2
+    *_, out = render(0.5, make_settings("Horizontal", "Wrap"), lambda: generation != latest)
+    assert out is None